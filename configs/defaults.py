@@ -20,6 +20,16 @@ _C.val_conf_thres = 0.001
 # _C.workers=8
 _C.local_rank=-1
 _C.save_period=-1
+_C.ema_every=1 #每k次optimizer step做一次EMA(含SSOD的semi_ema)更新, decay取k次的乘积, 减少EMA的耗时
+_C.ema_offload=False #EMA(含SSOD的semi_ema)权重放在pinned host内存, 在后台线程更新, 节省显存
+_C.ema_refresh=1 #ema_offload时SSOD的teacher每k次EMA更新从host拷贝一次到GPU, 越大拷贝越少teacher越旧
+_C.log_period=10 #loss在GPU上累加, 每N次迭代同步一次并刷新进度条
+_C.profile_period=0 #每N次迭代统计一次训练各阶段(data/h2d/forward/loss/backward/optimizer/ema/log)耗时的分位数, 写入step_profile文件并调用on_train_step_profile回调, 0为关闭
+_C.profile_window=200 #耗时分位数统计的滑动窗口(迭代数)
+_C.profile_sync=True #每个阶段计时前同步GPU, 异步执行的耗时计入发起它的阶段
+_C.profile_format='csv' #step_profile文件格式, csv或jsonl
+_C.async_save=True #checkpoint拷贝到内存后在后台线程写盘(临时文件+fsync+rename, best.pt与last.pt相同时硬链接), False则在训练循环中写盘
+_C.iter_save_period=0 #每N次迭代保存weights/iter.pt(模型、EMA、optimizer、dataloader位置、随机数状态等), resume=True且weights指向iter.pt时从下一个batch继续训练, 0为关闭
 _C.weights=''
 _C.freeze_layer_num = 0
 _C.cache=False
@@ -33,7 +43,7 @@ _C.sync_bn=False
 _C.resume=False
 _C.exist_ok=False
 _C.linear_lr=False
-_C.check_datacache=False
+_C.check_datacache=False #逐文件比较size/mtime重新校验标签缓存, 默认只比较目录指纹(无法发现原地修改的标注)
 _C.entity=None
 _C.upload_dataset=False
 _C.bbox_interval=-1
@@ -195,7 +205,17 @@ _C.Dataset.pseudo_ids=False #打开pseudo_ids后，会自动对没有id的标签
 _C.Dataset.names=[] #训练集标签的名称
 _C.Dataset.include_class=[] #只读取部分id的标签
 _C.Dataset.data_name='default_name' #训练集的名称
-_C.Dataset.sampler_type='normal' #训练数据的采样方法, normal|class_balance|dir_balance
+_C.Dataset.sampler_type='normal' #训练数据的采样方法, normal|class_balance|dir_balance|aspect_ratio
+_C.Dataset.ar_buckets=8 #aspect_ratio采样时按长宽比分桶的数量, 桶内和批次间每个epoch重新打乱, 每个批次按自身长宽比letterbox, 不使用mosaic
+_C.Dataset.fast_scan=False #只解析JPEG/PNG/BMP文件头和EXIF获取尺寸, 完整解码推迟到首次读图, 损坏图片记入.quarantine并在下次扫描时重新校验
+_C.Dataset.reduced_decode=False #JPEG按1/2,1/4,1/8的DCT缩放直接解码到不小于img_size的尺寸再resize, 大图读图更快, 像素与全尺寸解码有细微差异
+_C.Dataset.shard_buffer=1000 #训练集为tar分片目录(scripts/make_shards.py生成)时每个worker的shuffle buffer大小, mosaic从buffer中取拼接图片
+_C.Dataset.lru_cache_mb=0 #未开启cache时每个dataloader worker缓存最近解码并resize后图片的内存上限(MB), 0为关闭, 定期打印命中率
+_C.Dataset.lru_mosaic_bias=0.0 #mosaic拼接图片以该概率从worker的LRU缓存中选取, 减少解码次数
+_C.Dataset.fused_mosaic=False #mosaic的4张图各自一次仿射变换直接写入img_size输出, 不生成2倍大小的拼接图, copy_paste开启时不生效
+_C.Dataset.batch_augment=False #worker只做解码/resize/letterbox/mosaic拼接, 非mosaic图片的随机仿射/透视以及所有图片的HSV和翻转在collate后的整个batch上用torch完成(训练设备上); mosaic仍在worker中对2倍大小的拼接图做仿射, 保证scale<1时缩小看到的是拼接图而不是填充
+_C.Dataset.shared_collate=False #训练时worker把图片直接写入预分配的共享内存(锁页)batch环形缓冲区, 队列只传槽位索引和标签, 占用workers*(prefetch+3)个batch的共享内存, rect/quad/aspect_ratio时不生效
+_C.Dataset.prefetch=1 #训练和验证时提前在GPU side stream(CPU时为后台线程)上完成拷贝、转float、归一化和batch_augment的batch数, 0为关闭, 每个epoch打印等待数据的时间占比
 _C.Dataset.norm_scale=255.0 #预处理数值 img/255
 _C.Dataset.debug= False #开启后会将标注渲染到图片上保存本地
 _C.Dataset.val_kp= False #验证时是否计算关键点的AP
@@ -282,11 +302,14 @@ _C.SSOD.pseudo_label_with_obj=False #pseudo label assigner生成伪标签时的
 _C.SSOD.pseudo_label_with_bbox=False #pseudo label assigner是否用uncertain label算bbox loss
 _C.SSOD.pseudo_label_with_cls=False #pseudo label assigner是否用uncertain label算cls loss
 _C.SSOD.epoch_adaptor=True #是否开启epoch_adaptor
+_C.SSOD.joint_loader=False #标注和无标注数据共用一个dataloader和一组workers, 每次迭代产出一对batch, 各自独立打乱, DDP下每个rank分到互不重叠的数据; epoch长度由epoch_adaptor决定(burn-in阶段也相同)
+_C.SSOD.unlabeled_batch_ratio=1.0 #joint_loader时无标注batch大小与标注batch大小之比
 _C.SSOD.teacher_ota_cost=False #是否使用teacher模型的输出来计算ota的cost
 _C.SSOD.iou_type='giou'
 _C.SSOD.cosine_ema=True #是否开启cosine ema方案
 _C.SSOD.imitate_teacher=False #是否开启imitate方案
 _C.SSOD.fixed_accumulate=False #开启时，关闭动态optimizer更新方案
+_C.SSOD.device_strong_view=False #无标签数据只加载weak view, strong view(仿射/HSV/autoaugment/翻转)及其M_s在训练设备上批量生成, cutout不生效
 
 _C.SSOD.ssod_hyp = CN()
 _C.SSOD.ssod_hyp.mosaic=1.0
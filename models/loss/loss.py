@@ -92,6 +92,8 @@ class QFocalLoss(nn.Module):
 
 class ComputeLoss:
     # Compute losses
+    loss_names = ('box', 'obj', 'cls', 'loss')  # keys of the returned loss dict, in order
+
     def __init__(self, model, cfg):
         self.sort_obj_iou = False
         device = next(model.parameters()).device  # get model device
@@ -859,6 +861,8 @@ class IOUloss(nn.Module):
         return loss
 
 class ComputeNanoLoss:
+    loss_names = ('loss_qfl', 'loss_bbox', 'loss_dfl')  # keys of the returned loss dict, in order
+
     def __init__(self, model, cfg):
         super(ComputeNanoLoss, self).__init__()
         det = model.module.head if is_parallel(model) else model.head  # Detect() module
@@ -871,6 +875,8 @@ class ComputeNanoLoss:
 
 class ComputeXLoss:
     # Compute losses
+    loss_names = ('iou_loss', 'obj_loss', 'cls_loss', 'loss', 'num_fg')  # keys of the returned loss dict, in order
+
     def __init__(self, model, cfg):
         super(ComputeXLoss, self).__init__()
         # device = next(model.parameters()).device  # get model device
@@ -906,6 +912,8 @@ class ComputeXLoss:
 
 class ComputeKeyPointsLoss:
     # Compute losses
+    loss_names = ('iou_loss', 'obj_loss', 'cls_loss', 'n_fg', 'lmk_n_fg', 'kp_loss', 'kp_obj', 'loss')  # in order
+
     def __init__(self, model, cfg):
         super(ComputeKeyPointsLoss, self).__init__()
         # device = next(model.parameters()).device  # get model device
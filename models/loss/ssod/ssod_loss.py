@@ -25,6 +25,8 @@ def smooth_BCE(eps=0.1):  # https://github.com/ultralytics/yolov3/issues/238#iss
 # for label match type semi spervised training
 class ComputeStudentMatchLoss():
     # Compute losses
+    loss_names = ('ss_box', 'ss_obj', 'ss_cls')  # keys of the returned loss dict, in order
+
     def __init__(self, model, cfg):
         super(ComputeStudentMatchLoss, self).__init__()
         device = next(model.parameters()).device  # get model device
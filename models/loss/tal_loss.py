@@ -15,6 +15,8 @@ from models.loss.gfocal_loss import VarifocalLoss, BboxLoss
 
 class ComputeTalLoss:
     '''Loss computation func.'''
+    loss_names = ('loss_iou', 'loss_dfl', 'loss_cls', 'loss', 'num_fg')  # keys of the returned loss dict, in order
+
     def __init__(self,
                  model,
                  cfg):
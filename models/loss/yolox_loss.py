@@ -19,6 +19,8 @@ from assigner import SimOTAAssigner
 # os.environ['CUDA_LAUNCH_BLOCKING'] = '1'
 class ComputeFastXLoss:
     # Compute losses
+    loss_names = ('loss_iou', 'loss_obj', 'loss_cls', 'loss')  # keys of the returned loss dict, in order
+
     def __init__(self, model, cfg):
         # super(ComputeFastXLoss, self).__init__()
         # device = next(model.parameters()).device  # get model device
@@ -117,7 +119,7 @@ class ComputeFastXLoss:
 
         total_losses = self.reg_weight * loss_iou + loss_l1 + self.obj_weight * loss_obj + self.cls_weight*loss_cls
         # total_losses = total_losses * batch_size
-        loss_dict = dict(loss_iou = self.reg_weight*loss_iou, loss_obj=self.obj_weight * loss_obj, loss_cls=self.cls_weight*loss_cls, loss=float(total_losses))
+        loss_dict = dict(loss_iou = self.reg_weight*loss_iou, loss_obj=self.obj_weight * loss_obj, loss_cls=self.cls_weight*loss_cls, loss=total_losses.detach())  # no device sync per step
         return total_losses, loss_dict
 
     def preprocess(self, targets, batch_size, scale_tensor):
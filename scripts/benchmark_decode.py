@@ -0,0 +1,84 @@
+#Copyright (c) 2023, Alibaba Group
+"""
+Benchmark single-worker image decode throughput, full-resolution cv2.imread + resize vs reduced-resolution JPEG
+decoding (Dataset.reduced_decode), and report how close the two outputs are
+
+Usage:
+    $ python scripts/benchmark_decode.py --source data/images --img-size 640 --n 200
+"""
+
+import argparse
+import glob
+import os
+import sys
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+FILE = Path(__file__).resolve()
+ROOT = FILE.parents[1]  # EfficientTeacher root directory
+if str(ROOT) not in sys.path:
+    sys.path.append(str(ROOT))  # add ROOT to PATH
+
+from utils.datasets import IMG_FORMATS, imread_reduced
+from utils.image_probe import probe_image
+
+
+def resize(im, wh, img_size):
+    # The load_image() resize from original (w, h) to img_size on the long side
+    w0, h0 = wh
+    r = img_size / max(h0, w0)
+    return cv2.resize(im, (int(w0 * r), int(h0 * r)), interpolation=cv2.INTER_LINEAR) if r != 1 else im
+
+
+def decode_full(path, wh, img_size):
+    return resize(cv2.imread(path), wh, img_size)
+
+
+def decode_reduced(path, wh, img_size):
+    im, f = imread_reduced(path, wh, img_size)
+    return resize(im, wh if f == 1 or im.shape[0] == -(-wh[1] // f) else wh[::-1], img_size)
+
+
+def run(source, img_size=640, n=200, warmup=5):
+    if os.path.isdir(source):
+        files = sorted(glob.glob(os.path.join(source, '**', '*.*'), recursive=True))
+    else:
+        with open(source) as f:
+            files = [x.split(' ')[0] for x in f.read().strip().splitlines()]
+    files = [x for x in files if x.split('.')[-1].lower() in IMG_FORMATS][:n]
+    assert files, f'No images found in {source}'
+    sizes = []
+    for x in files:
+        probed = probe_image(x)
+        sizes.append(probed[1] if probed else cv2.imread(x).shape[1::-1])
+
+    results = {}
+    for name, fn in ('full', decode_full), ('reduced', decode_reduced):
+        for x, wh in list(zip(files, sizes))[:warmup]:
+            fn(x, wh, img_size)  # warm up page cache and codecs
+        t = time.perf_counter()
+        results[name] = [fn(x, wh, img_size) for x, wh in zip(files, sizes)]
+        dt = time.perf_counter() - t
+        print(f'{name:>8}: {len(files) / dt:8.1f} img/s per worker ({dt / len(files) * 1E3:.2f} ms/img)')
+
+    diff = [np.abs(a.astype(np.float32) - b.astype(np.float32)) for a, b in zip(results['full'], results['reduced'])
+            if a.shape == b.shape]
+    mismatched = len(files) - len(diff)
+    print(f'mean abs diff {np.mean([d.mean() for d in diff]):.3f}, max {max(d.max() for d in diff):.0f} (0-255), '
+          f'{mismatched} shape mismatches')
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--source', type=str, required=True, help='image directory or image list file')
+    parser.add_argument('--img-size', type=int, default=640, help='train image size')
+    parser.add_argument('--n', type=int, default=200, help='number of images')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    opt = parse_opt()
+    run(opt.source, opt.img_size, opt.n)
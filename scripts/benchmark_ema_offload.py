@@ -0,0 +1,137 @@
+#Copyright (c) 2023, Alibaba Group
+"""
+Benchmark EMA offloading (ema_offload): device memory saved against teacher staleness and step time
+
+Every setting runs the SSOD update pattern on random images: a teacher forward on the ModelEMA, a student forward,
+backward and SGD step, then ModelEMA.update(student) and SemiSupModelEMA.update(ModelEMA). 'device' keeps both EMAs on
+the GPU, 'offload' keeps them in pinned host memory with a teacher compute copy refreshed every --refresh blends. Peak
+allocated memory and step time are measured first, then a second run keeps an exact on-device ModelEMA next to the
+offloaded one and reports how far the teacher copy is behind it, in updates and as the relative distance
+|teacher - exact| / |exact - student| (0 is exact, 1 is as far as the student).
+
+Usage:
+    $ python scripts/benchmark_ema_offload.py --cfg configs/ssod/custom/yolov5l_custom_ssod.yaml --batch-size 8
+    $ python scripts/benchmark_ema_offload.py --cfg configs/ssod/custom/yolov5l_custom_ssod.yaml --refresh 1 4 16 --every 2
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import torch
+
+FILE = Path(__file__).resolve()
+ROOT = FILE.parents[1]  # EfficientTeacher root directory
+if str(ROOT) not in sys.path:
+    sys.path.append(str(ROOT))  # add ROOT to PATH
+
+from configs.defaults import get_cfg
+from models.detector.yolo_ssod import Model
+from utils.general import set_logging
+from utils.torch_utils import ModelEMA, SemiSupModelEMA, select_device
+
+
+def tensors(x):
+    # Tensors of a nested model output
+    if isinstance(x, torch.Tensor):
+        return [x]
+    if isinstance(x, (list, tuple)):
+        return [t for y in x for t in tensors(y)]
+    return []
+
+
+def distance(a, b):
+    # |a - b| over the floating point state of two modules
+    sa, sb = a.state_dict(), b.state_dict()
+    return sum((sa[k].float() - sb[k].float()).pow(2).sum() for k in sa if sa[k].dtype.is_floating_point).sqrt().item()
+
+
+def build(cfg, device, offload, refresh, every):
+    # Student, ModelEMA and semi EMA of one setting
+    model = Model(cfg).to(device)
+    ema = ModelEMA(model, every=every, offload=device if offload else None, refresh=refresh)
+    semi_ema = SemiSupModelEMA(ema.ema, cfg.SSOD.ema_rate, every=every, offload=device if offload else None)
+    return model, ema, semi_ema
+
+
+def step(model, ema, semi_ema, optimizer, imgs):
+    # One SSOD-like iteration, returns the teacher module it ran
+    teacher = ema.device_model()
+    with torch.no_grad(), torch.cuda.amp.autocast():
+        teacher(imgs, augment=False)
+    with torch.cuda.amp.autocast():
+        loss = sum(t.float().mean() for t in tensors(model(imgs)))
+    loss.backward()
+    optimizer.step()
+    optimizer.zero_grad()
+    ema.update(model)
+    semi_ema.update(ema.ema)
+    return teacher
+
+
+def run(cfg, device='', batch_size=8, img_size=640, n=100, warmup=10, refresh=(1, 4, 16), every=1):
+    device = select_device(device, batch_size=batch_size)
+    assert device.type == 'cuda', 'EMA offloading needs a CUDA device'
+    imgs = torch.rand(batch_size, 3, img_size, img_size, device=device)
+    settings = [('device', 0)] + [('offload', r) for r in refresh]
+    print(f'{"setting":>12} {"refresh":>8} {"peak":>9} {"saved":>9} {"step":>9} {"lag":>7} {"distance":>9}')
+    base = None
+    for name, r in settings:
+        offload = name == 'offload'
+
+        # Memory and step time
+        model, ema, semi_ema = build(cfg, device, offload, r, every)
+        optimizer = torch.optim.SGD(model.parameters(), lr=1E-4, momentum=0.9)
+        for i in range(warmup + n):
+            if i == warmup:
+                torch.cuda.synchronize()
+                torch.cuda.reset_peak_memory_stats(device)
+                t = time.perf_counter()
+            step(model, ema, semi_ema, optimizer, imgs)
+        torch.cuda.synchronize()
+        dt = (time.perf_counter() - t) / n * 1E3
+        ema.wait(), semi_ema.wait()
+        peak = torch.cuda.max_memory_allocated(device) / 1E9
+        base = peak if base is None else base
+        del model, ema, semi_ema, optimizer
+        torch.cuda.empty_cache()
+
+        # Staleness of the teacher copy against an exact device EMA
+        lag, dist = 0.0, 0.0
+        if offload:
+            model, ema, semi_ema = build(cfg, device, offload, r, every)
+            exact = ModelEMA(model, every=every)
+            optimizer = torch.optim.SGD(model.parameters(), lr=1E-4, momentum=0.9)
+            for i in range(warmup + n):
+                teacher = step(model, ema, semi_ema, optimizer, imgs)
+                if i >= warmup:
+                    lag += ema.lag / n
+                    dist += distance(teacher, exact.ema) / max(distance(exact.ema, model), 1E-12) / n
+                exact.update(model)
+            ema.wait(), semi_ema.wait()
+            del model, ema, semi_ema, exact, optimizer
+            torch.cuda.empty_cache()
+        print(f'{name:>12} {r:>8} {peak:8.2f}G {base - peak:8.2f}G {dt:7.1f}ms {lag:7.1f} {dist:9.4f}')
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cfg', type=str, default='', help='config yaml, for the Model and SSOD sections')
+    parser.add_argument('--device', default='', help='cuda device, i.e. 0')
+    parser.add_argument('--batch-size', type=int, default=8, help='batch size')
+    parser.add_argument('--img-size', type=int, default=640, help='image size')
+    parser.add_argument('--n', type=int, default=100, help='measured iterations per setting')
+    parser.add_argument('--warmup', type=int, default=10, help='iterations before measuring')
+    parser.add_argument('--refresh', type=int, nargs='+', default=[1, 4, 16], help='ema_refresh values to compare')
+    parser.add_argument('--every', type=int, default=1, help='ema_every')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    opt = parse_opt()
+    set_logging()
+    cfg = get_cfg()
+    if opt.cfg:
+        cfg.merge_from_file(opt.cfg)
+    run(cfg, opt.device, opt.batch_size, opt.img_size, opt.n, opt.warmup, opt.refresh, opt.every)
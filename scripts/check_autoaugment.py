@@ -0,0 +1,149 @@
+#Copyright (c) 2023, Alibaba Group
+"""
+Statistical equivalence check of the batched AutoAugment v5 policy (utils/autoaugment_batch.py) against the numpy
+distort_image_with_autoaugment() path, and the throughput of both
+
+Every image is augmented --n times by each path and per-sample output statistics are compared with a two-sample
+Kolmogorov-Smirnov test. Background pixels are compared by their change beyond 1 level, the numpy path adds 1 outside
+boxes touched by bbox-only ops (see the utils/autoaugment_batch.py docstring).
+
+Usage:
+    $ python scripts/check_autoaugment.py --n 500
+    $ python scripts/check_autoaugment.py --source data/images --n 200 --device 0
+"""
+
+import argparse
+import glob
+import os
+import sys
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+import torch
+
+FILE = Path(__file__).resolve()
+ROOT = FILE.parents[1]  # EfficientTeacher root directory
+if str(ROOT) not in sys.path:
+    sys.path.append(str(ROOT))  # add ROOT to PATH
+
+from utils.autoaugment_batch import BatchAutoAugment
+from utils.autoaugment_utils import distort_image_with_autoaugment
+from utils.torch_utils import select_device
+
+
+def synthetic_images(k=4, size=320, boxes=3, seed=0):
+    # Gradient images with noisy rectangles, the rectangles are the boxes, (BGR image, [y1, x1, y2, x2, cls] normalized)
+    rng = np.random.default_rng(seed)
+    out = []
+    for _ in range(k):
+        yy, xx = np.mgrid[0:size, 0:size] / size
+        im = np.stack([yy * 200, xx * 200, (yy + xx) * 100], 2) + 20
+        b = []
+        for c in range(boxes):
+            y1, x1 = rng.uniform(0, 0.7, 2)
+            y2, x2 = y1 + rng.uniform(0.1, 0.3), x1 + rng.uniform(0.1, 0.3)
+            im[int(y1 * size):int(y2 * size), int(x1 * size):int(x2 * size)] = rng.uniform(0, 255, 3)
+            b.append([y1, x1, y2, x2, c])
+        im += rng.normal(0, 8, im.shape)
+        out.append((np.clip(im, 0, 255).astype(np.uint8), np.array(b)))
+    return out
+
+
+def file_images(source, k=4, size=320, boxes=3, seed=0):
+    # Images from a directory with random boxes
+    files = sorted(x for x in glob.glob(os.path.join(source, '*.*')) if cv2.imread(x) is not None)[:k]
+    assert files, f'No images found in {source}'
+    rng = np.random.default_rng(seed)
+    out = []
+    for f in files:
+        im = cv2.resize(cv2.imread(f), (size, size))
+        y1, x1 = rng.uniform(0, 0.7, (2, boxes))
+        b = np.stack([y1, x1, y1 + rng.uniform(0.1, 0.3, boxes), x1 + rng.uniform(0.1, 0.3, boxes), np.arange(boxes)], 1)
+        out.append((im, b))
+    return out
+
+
+def statistics(out, x, box_mask):
+    # Per-sample statistics of (k, h, w, 3) float RGB outputs of the (h, w, 3) input x
+    d = np.abs(out - x[None])
+    return {'mean': out.mean((1, 2, 3)),
+            'std': out.std((1, 2, 3)),
+            'box_change': d[:, box_mask].mean((1, 2)),
+            'box_changed': (d[:, box_mask] > 1).mean((1, 2)),
+            'bg_changed': (d[:, ~box_mask] > 1).mean((1, 2))}
+
+
+def ks_2samp(a, b):
+    # Two-sample Kolmogorov-Smirnov statistic
+    v = np.sort(np.concatenate((a, b)))
+    fa = np.searchsorted(np.sort(a), v, side='right') / len(a)
+    fb = np.searchsorted(np.sort(b), v, side='right') / len(b)
+    return np.abs(fa - fb).max()
+
+
+def run(source='', n=500, batch_size=64, device='', alpha_c=1.95):
+    device = select_device(device, batch_size=batch_size)
+    images = file_images(source) if source else synthetic_images()
+    aug = BatchAutoAugment()
+    failed = 0
+    t_np, t_torch = 0.0, 0.0
+    for j, (im, boxes) in enumerate(images):
+        h, w = im.shape[:2]
+        rgb = im[:, :, ::-1].astype(np.float32)
+        box_mask = np.zeros((h, w), dtype=bool)
+        for y1, x1, y2, x2, _ in boxes:
+            box_mask[int(y1 * h):int(y2 * h) + 1, int(x1 * w):int(x2 * w) + 1] = True
+
+        # numpy path, one image at a time
+        t = time.perf_counter()
+        ref = [distort_image_with_autoaugment(im.copy(), boxes.copy(), 'v5')[0][:, :, ::-1] for _ in range(n)]
+        t_np += time.perf_counter() - t
+        ref = np.stack(ref).astype(np.float32)
+
+        # batched path, the same image repeated
+        x = torch.from_numpy(np.ascontiguousarray(rgb.transpose(2, 0, 1))).to(device)
+        yxyx = torch.from_numpy(boxes[:, :4]).float()
+        xywh = torch.stack(((yxyx[:, 1] + yxyx[:, 3]) / 2, (yxyx[:, 0] + yxyx[:, 2]) / 2,
+                            yxyx[:, 3] - yxyx[:, 1], yxyx[:, 2] - yxyx[:, 0]), 1)
+        outs = []
+        t = time.perf_counter()
+        for i in range(0, n, batch_size):
+            k = min(batch_size, n - i)
+            targets = torch.cat((torch.arange(k).repeat_interleave(len(boxes))[:, None].float(),
+                                 torch.zeros(k * len(boxes), 1), xywh.repeat(k, 1)), 1).to(device)
+            outs.append(aug(x[None].repeat(k, 1, 1, 1), targets, torch.ones(k, dtype=torch.bool, device=device)))
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        t_torch += time.perf_counter() - t
+        out = torch.cat(outs).permute(0, 2, 3, 1).cpu().numpy()
+
+        crit = alpha_c * np.sqrt(2 / n)  # KS critical value, alpha=0.001
+        sa, sb = statistics(ref, rgb, box_mask), statistics(out, rgb, box_mask)
+        for name in sa:
+            d = ks_2samp(sa[name], sb[name])
+            ok = d < crit
+            failed += not ok
+            print(f'image {j} {name:>12}: numpy {sa[name].mean():8.3f}  batched {sb[name].mean():8.3f}  '
+                  f'KS {d:.3f} {"ok" if ok else "FAIL"} (< {crit:.3f})')
+
+    total = n * len(images)
+    print(f'numpy   {total / t_np:8.1f} img/s')
+    print(f'batched {total / t_torch:8.1f} img/s on {device}')
+    print('equivalent' if not failed else f'{failed} statistics differ')
+    return failed
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--source', type=str, default='', help='image directory, synthetic images if empty')
+    parser.add_argument('--n', type=int, default=500, help='augmentations per image and path')
+    parser.add_argument('--batch-size', type=int, default=64, help='batched path batch size')
+    parser.add_argument('--device', default='', help='cuda device, i.e. 0 or cpu')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    opt = parse_opt()
+    sys.exit(run(opt.source, opt.n, opt.batch_size, opt.device) > 0)
@@ -0,0 +1,51 @@
+#Copyright (c) 2023, Alibaba Group
+"""
+Convert a dataset spec (txt list, directory, 'a.txt||b.txt*3') into tar shards for sequential streaming. Labels are
+scanned and verified the same way training does, then written once into the shard directory's label index
+
+Usage:
+    $ python scripts/make_shards.py --cfg configs/sup/custom/yolov5l_custom.yaml --data train.txt --out shards/train
+    $ python scripts/make_shards.py --cfg configs/ssod/custom/yolov5l_custom_ssod.yaml --data target.txt \
+        --out shards/target --target
+Then point Dataset.train / Dataset.target at the shard directory.
+"""
+
+import argparse
+import sys
+from pathlib import Path
+
+FILE = Path(__file__).resolve()
+ROOT = FILE.parents[1]  # EfficientTeacher root directory
+if str(ROOT) not in sys.path:
+    sys.path.append(str(ROOT))  # add ROOT to PATH
+
+from configs.defaults import get_cfg
+from utils.datasets import LoadImagesAndLabels
+from utils.datasets_shard import write_shards
+from utils.datasets_ssod import LoadImagesAndFakeLabels
+from utils.general import set_logging
+
+
+def run(cfg, data, out, shard_size=1000, target=False):
+    dataset_cls = LoadImagesAndFakeLabels if target else LoadImagesAndLabels
+    dataset = dataset_cls(data, cfg.Dataset.img_size, augment=False, cfg=cfg, prefix='shards: ')
+    write_shards(dataset, out, shard_size, prefix='shards: ')
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cfg', type=str, default='', help='config yaml, for Dataset.np / num_ids / include_class')
+    parser.add_argument('--data', type=str, required=True, help="dataset spec, i.e. 'a.txt||b.txt*3'")
+    parser.add_argument('--out', type=str, required=True, help='output shard directory')
+    parser.add_argument('--shard-size', type=int, default=1000, help='images per shard')
+    parser.add_argument('--target', action='store_true', help='unlabeled SSOD target dataset')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    opt = parse_opt()
+    set_logging()
+    cfg = get_cfg()
+    if opt.cfg:
+        cfg.merge_from_file(opt.cfg)
+    run(cfg, opt.data, opt.out, opt.shard_size, opt.target)
@@ -0,0 +1,92 @@
+#Copyright (c) 2023, Alibaba Group
+"""
+Measure the memory growth of training dataloader workers over N iterations
+
+Workers are forked from the process holding the dataset. Any per-image Python object they touch (a list of label
+arrays, a list of path strings) gets its refcount written, which copies the parent's page into the worker. The packed
+label store keeps per-image metadata in flat arrays, so a worker's private memory should stay flat after warm-up.
+Private_Dirty of /proc/<pid>/smaps_rollup counts those copied pages; Rss and Pss are reported next to it.
+
+Usage:
+    $ python scripts/worker_rss.py --cfg configs/sup/custom/yolov5l_custom.yaml --data train.txt --n 2000
+    $ python scripts/worker_rss.py --cfg configs/sup/custom/yolov5l_custom.yaml --data train.txt --max-growth 64
+"""
+
+import argparse
+import sys
+from pathlib import Path
+
+import numpy as np
+
+FILE = Path(__file__).resolve()
+ROOT = FILE.parents[1]  # EfficientTeacher root directory
+if str(ROOT) not in sys.path:
+    sys.path.append(str(ROOT))  # add ROOT to PATH
+
+from configs.defaults import get_cfg
+from utils.datasets import create_dataloader
+from utils.general import set_logging
+
+FIELDS = ('Rss', 'Pss', 'Private_Dirty')
+
+
+def memory(pid):
+    # FIELDS of a process in MB
+    out = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            k, v = line.split(':', 1)
+            if k in FIELDS:
+                out[k] = int(v.split()[0]) / 1024
+    return out
+
+
+def batches(loader):
+    # Batches of the loader over as many epochs as needed
+    while True:
+        yield from loader
+
+
+def run(cfg, data, n=2000, interval=100, batch_size=16, workers=8, warmup=100, max_growth=0.0):
+    loader, dataset = create_dataloader(data, cfg.Dataset.img_size, batch_size, 32, hyp=cfg.hyp, augment=True,
+                                        workers=workers, prefix='train: ', cfg=cfg, train=True)
+    print(f'{len(dataset)} images, {loader.num_workers} workers, {n} iterations')
+    samples = []  # (iteration, (workers, len(FIELDS)) MB)
+    for i, _ in enumerate(batches(loader)):
+        if i >= n:
+            break
+        if i % interval == 0 or i == n - 1:
+            pids = [w.pid for w in loader.iterator._workers] if loader.num_workers else []
+            m = np.array([[memory(p)[k] for k in FIELDS] for p in pids]).reshape(-1, len(FIELDS))
+            samples.append((i, m))
+            print(f'{i:8d} ' + '  '.join(f'{k} {m[:, j].mean():8.1f}MB' for j, k in enumerate(FIELDS)) + ' per worker')
+
+    base = next((m for i, m in samples if i >= warmup), samples[0][1])  # after workers opened their files and caches
+    growth = samples[-1][1] - base
+    for w, g in enumerate(growth):
+        print(f'worker {w}: ' + '  '.join(f'{k} {g[j]:+8.1f}MB' for j, k in enumerate(FIELDS)))
+    worst = growth[:, FIELDS.index('Private_Dirty')].max(initial=0.0)
+    print(f'max Private_Dirty growth after warm-up: {worst:.1f}MB')
+    return max_growth > 0 and worst > max_growth
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cfg', type=str, default='', help='config yaml, for the Dataset and hyp sections')
+    parser.add_argument('--data', type=str, required=True, help="dataset spec, i.e. 'a.txt||b.txt*3'")
+    parser.add_argument('--n', type=int, default=2000, help='iterations')
+    parser.add_argument('--interval', type=int, default=100, help='iterations between samples')
+    parser.add_argument('--batch-size', type=int, default=16, help='batch size')
+    parser.add_argument('--workers', type=int, default=8, help='dataloader workers')
+    parser.add_argument('--warmup', type=int, default=100, help='iterations before the growth baseline')
+    parser.add_argument('--max-growth', type=float, default=0.0, help='exit 1 above this Private_Dirty growth (MB)')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    opt = parse_opt()
+    set_logging()
+    cfg = get_cfg()
+    if opt.cfg:
+        cfg.merge_from_file(opt.cfg)
+    sys.exit(run(cfg, opt.data, opt.n, opt.interval, opt.batch_size, opt.workers, opt.warmup, opt.max_growth))
@@ -38,4 +38,5 @@ setuptools.setup(
     ],
     cmdclass={'build_ext': torch.utils.cpp_extension.BuildExtension},
     packages=setuptools.find_packages(),
+    entry_points={'console_scripts': ['compile-manifest=utils.manifest:main']},
 )
\ No newline at end of file
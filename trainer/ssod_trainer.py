@@ -26,9 +26,10 @@ from datetime import timedelta
 # import val # for end-of-epoch mAP
 from models.backbone.experimental import attempt_load
 from utils.autoanchor import check_anchors
+from utils.batch_augment import BatchAugment, StrongView
 from utils.datasets import create_dataloader
 from utils.general import labels_to_class_weights, increment_path, labels_to_image_weights, init_seeds, \
-    strip_optimizer, get_latest_run, check_dataset, check_git_status, check_img_size, check_requirements, \
+    get_latest_run, check_dataset, check_git_status, check_img_size, check_requirements, \
     check_file, check_yaml, check_suffix, print_args, print_mutation, set_logging, one_cycle, colorstr, methods
 from utils.downloads import attempt_download
 from models.loss.loss import DomainLoss, TargetLoss
@@ -40,7 +41,7 @@ from utils.loggers.wandb.wandb_utils import check_wandb_resume
 from utils.metrics import fitness
 # from ..val import run # for end-of-epoch mAP
 from utils.plots import plot_images, plot_labels, plot_results,  plot_images_debug, output_to_target
-from utils.datasets_ssod import create_target_dataloader, augment_hsv, cutout
+from utils.datasets_ssod import create_joint_dataloader, create_target_dataloader, augment_hsv, cutout
 from utils.self_supervised_utils import FairPseudoLabel
 from utils.labelmatch import LabelMatch 
 from utils.self_supervised_utils import check_pseudo_label_with_gt, check_pseudo_label
@@ -69,6 +70,7 @@ class SSODTrainer(Trainer):
             self.pseudo_label_creator = FairPseudoLabel(cfg)
         elif cfg.SSOD.pseudo_label_type == 'LabelMatch':
             self.pseudo_label_creator = LabelMatch(cfg, int(self.unlabeled_dataset.__len__()/self.WORLD_SIZE), self.label_num_per_image, cls_ratio_gt= self.cls_ratio_gt)
+        self.pseudo_label_creator.profiler = self.profiler  # 'nms' lap
 
         self.build_ddp_model(cfg, device)
         self.device = device
@@ -82,6 +84,7 @@ class SSODTrainer(Trainer):
         self.da_loss_weights = cfg.SSOD.da_loss_weights
         self.cosine_ema = cfg.SSOD.cosine_ema
         self.fixed_accumulate = cfg.SSOD.fixed_accumulate
+        self.joint_loader = cfg.SSOD.joint_loader
     
     def build_optimizer(self, cfg, optinit=True, weight_masks=None, ckpt=None):
         super().build_optimizer(cfg, optinit, weight_masks, ckpt)
@@ -120,15 +123,12 @@ class SSODTrainer(Trainer):
                 print(f'freezing {k}')
                 v.requires_grad = False
         # EMA
-        self.ema = ModelEMA(self.model)        
+        self.ema = ModelEMA(self.model, every=cfg.ema_every, offload=self.ema_offload(), refresh=cfg.ema_refresh)
         if self.cfg.hyp.burn_epochs > 0:
             self.semi_ema = None
             # self.ema = ModelEMA(self.model, decay=self.cfg.SSOD.ema_rate)
         else:
-            if self.cosine_ema:
-                self.semi_ema = CosineEMA(self.ema.ema, decay_start=self.cfg.SSOD.ema_rate, total_epoch=self.epochs)
-            else:
-                self.semi_ema = SemiSupModelEMA(self.ema.ema, self.cfg.SSOD.ema_rate)
+            self.semi_ema = self.build_semi_ema(self.epochs)
 
         # Resume
         self.start_epoch = 0
@@ -161,7 +161,12 @@ class SSODTrainer(Trainer):
                 LOGGER.info(f"{weights} has been trained for {ckpt['epoch']} epochs. Fine-tuning for {self.epochs} more epochs.")
                 self.epochs += ckpt['epoch']  # finetune additional epochs
 
+            self.first_epoch = self.start_epoch
+            if cfg.resume and ckpt.get('iter') is not None:
+                self.load_iter_checkpoint(ckpt)
             del ckpt, csd
+        else:
+            self.first_epoch = self.start_epoch
         self.epoch = self.start_epoch
         # self.ema.update_decay(self.epoch, self.cfg.hyp.burn_epochs)
         self.model_type = self.model.model_type
@@ -202,6 +207,14 @@ class SSODTrainer(Trainer):
                 assert len(self.extra_teacher_class_idxs) == len(self.extra_teacher_models)
                 assert len(self.extra_teacher_models) > 0
 
+    def build_semi_ema(self, total_epoch):
+        # Teacher EMA of the ModelEMA, cosine decay over 'total_epoch' epochs or a fixed decay
+        self.ema.wait()
+        if self.cosine_ema:
+            return CosineEMA(self.ema.ema, decay_start=self.cfg.SSOD.ema_rate, total_epoch=total_epoch,
+                             every=self.cfg.ema_every, offload=self.ema_offload())
+        return SemiSupModelEMA(self.ema.ema, self.cfg.SSOD.ema_rate, every=self.cfg.ema_every, offload=self.ema_offload())
+
     def build_dataloader(self, cfg, callbacks):
         # Image sizes
         gs = max(int(self.model.stride.max()), 32)  # grid size (max stride)
@@ -220,17 +233,27 @@ class SSODTrainer(Trainer):
             LOGGER.info('Using SyncBatchNorm()')
 
         # Trainloader
-        self.train_loader, self.dataset = create_dataloader(self.data_dict['train'], self.imgsz, self.batch_size // self.WORLD_SIZE, gs, self.single_cls,
-                                              hyp=cfg.hyp, augment=True, cache=cfg.cache, rect=cfg.rect, rank=self.LOCAL_RANK,
-                                              workers=cfg.Dataset.workers, prefix=colorstr('train: '), cfg=cfg)
+        if self.joint_loader:  # labeled and unlabeled batch pairs from one worker pool
+            self.train_loader, self.dataset, self.unlabeled_dataset = create_joint_dataloader(
+                self.data_dict['train'], self.data_dict['target'], self.imgsz, self.batch_size // self.WORLD_SIZE,
+                cfg.SSOD.unlabeled_batch_ratio, gs, self.single_cls, hyp=cfg.hyp, augment=True, cache=cfg.cache,
+                rank=self.LOCAL_RANK, workers=cfg.Dataset.workers, cfg=cfg, start_epoch=self.first_epoch)
+            self.unlabeled_dataloader = None
+        else:
+            self.train_loader, self.dataset = create_dataloader(self.data_dict['train'], self.imgsz, self.batch_size // self.WORLD_SIZE, gs, self.single_cls,
+                                                  hyp=cfg.hyp, augment=True, cache=cfg.cache, rect=cfg.rect, rank=self.LOCAL_RANK,
+                                                  workers=cfg.Dataset.workers, prefix=colorstr('train: '), cfg=cfg, train=True)
+            # Trainloader for semi supervised training
+            self.unlabeled_dataloader, self.unlabeled_dataset = create_target_dataloader(self.data_dict['target'], self.imgsz, self.batch_size // self.WORLD_SIZE, gs, self.single_cls,
+                                                  hyp=cfg.hyp, augment=True, cache=cfg.cache, rect=cfg.rect, rank=self.LOCAL_RANK,
+                                                  workers=cfg.Dataset.workers, cfg=cfg, prefix=colorstr('target: '))
+        self.batch_augment = BatchAugment(cfg.hyp, cfg.Dataset.np) if cfg.Dataset.batch_augment else None
         self.cls_ratio_gt = self.dataset.cls_ratio_gt 
         self.label_num_per_image = self.dataset.label_num_per_image
-        # Trainloader for semi supervised training 
-        self.unlabeled_dataloader, self.unlabeled_dataset = create_target_dataloader(self.data_dict['target'], self.imgsz, self.batch_size // self.WORLD_SIZE, gs, self.single_cls,
-                                              hyp=cfg.hyp, augment=True, cache=cfg.cache, rect=cfg.rect, rank=self.LOCAL_RANK,
-                                              workers=cfg.Dataset.workers, cfg=cfg, prefix=colorstr('target: '))
+        self.strong_view = StrongView(cfg.SSOD.ssod_hyp) if cfg.SSOD.device_strong_view else None
+        self.side_prefetch = {}  # loader: (prefetcher, iterator) of the loaders drawn with next()
 
-        mlc = int(np.concatenate(self.dataset.labels, 0)[:, 0].max())  # max label class
+        mlc = int(self.dataset.labels.concat()[:, 0].max())  # max label class
         self.nb = len(self.train_loader)  # number of batches
         assert mlc < self.nc, f'Label class {mlc} exceeds nc={self.nc} in {cfg.Dataset.data_name}. Possible class labels are 0-{self.nc - 1}'
 
@@ -242,7 +265,7 @@ class SSODTrainer(Trainer):
                                        prefix=colorstr('val: '), cfg=cfg)[0]
 
             if not cfg.resume:
-                labels = np.concatenate(self.dataset.labels, 0)
+                labels = self.dataset.labels.concat()
                 if self.plots:
                     plot_labels(labels, self.names, self.save_dir)
 
@@ -263,23 +286,11 @@ class SSODTrainer(Trainer):
         self.target_loss = TargetLoss()
     
     def update_train_logger(self):
-        for (imgs, targets, paths, _) in self.train_loader:  # batch -------------------------------------------------------------
-            imgs = imgs.to(self.device, non_blocking=True).float() / self.norm_scale  # uint8 to float32, 0-255 to 0.0-1.0
-            with amp.autocast(enabled=self.cuda):
-                pred, sup_feats = self.model(imgs)  # forward
-                loss, loss_items = self.compute_loss(pred, targets.to(self.device))  # loss scaled by batch_size
-                if self.model_type in ['yolox', 'tal']:
-                    un_sup_loss, un_sup_loss_items = self.compute_un_sup_loss(pred, pred, targets.to(self.device))  
-                else:
-                    un_sup_loss, un_sup_loss_items = self.compute_un_sup_loss(pred, targets.to(self.device))  
-            if self.RANK in [-1, 0]:
-                for loss_key in loss_items.keys():
-                    self.log_contents.append(loss_key)
+        # Loss columns declared by the supervised and unsupervised loss classes, no forward pass needed
+        if self.RANK in [-1, 0]:
+            self.log_contents += list(self.compute_loss.loss_names)
             if (self.epoch >= self.cfg.hyp.burn_epochs):
-                if self.RANK in [-1, 0]:
-                    for loss_key in un_sup_loss_items.keys():
-                        self.log_contents.append(loss_key)
-            break
+                self.log_contents += list(self.compute_un_sup_loss.loss_names)
         if self.cfg.SSOD.train_domain == True and self.epoch >= self.cfg.hyp.burn_epochs:
             if self.RANK in [-1, 0]:
             # self.log_contents.append('hit_miss')
@@ -302,7 +313,7 @@ class SSODTrainer(Trainer):
                 print('burn_in_epoch: {}, cur_epoch: {}'.format(self.cfg.hyp.burn_epochs, self.epoch) )
         else:
             # if self.epoch == self.cfg.hyp.burn_epochs and self.cfg.hyp.burn_epochs > 0:
-            if self.epoch == self.cfg.hyp.burn_epochs:
+            if self.epoch == self.cfg.hyp.burn_epochs and not self.epoch_start_iter():  # not when resumed inside it
                 msd = self.model.module.state_dict() if is_parallel(self.model) else self.model.state_dict()  # model state_dict
                 for k, v in self.ema.ema.state_dict().items():
                     if v.dtype.is_floating_point:
@@ -310,15 +321,12 @@ class SSODTrainer(Trainer):
                     # if self.RANK in [-1, 0]:
                     #     print('ema:', v)
                     #     print('msd:', msd[k])
-                if self.cosine_ema:
-                    self.semi_ema = CosineEMA(self.ema.ema, decay_start=self.cfg.SSOD.ema_rate, total_epoch=self.epochs - self.cfg.hyp.burn_epochs)
-                else:
-                    self.semi_ema = SemiSupModelEMA(self.ema.ema, self.cfg.SSOD.ema_rate)
+                self.semi_ema = self.build_semi_ema(self.epochs - self.cfg.hyp.burn_epochs)
             self.train_with_unlabeled(callbacks)
     
     def after_epoch(self, callbacks, val):
         if self.cfg.SSOD.pseudo_label_type == 'LabelMatch' and self.epoch >= self.cfg.SSOD.dynamic_thres_epoch:
-            self.pseudo_label_creator.update_epoch_cls_thr(self.epoch - self.start_epoch)
+            self.pseudo_label_creator.update_epoch_cls_thr(self.epoch - self.first_epoch)
             self.compute_un_sup_loss.ignore_thres_high = self.pseudo_label_creator.cls_thr_high
             self.compute_un_sup_loss.ignore_thres_low = self.pseudo_label_creator.cls_thr_low
             # print(self.RANK,  self.pseudo_label_creator.cls_thr_high, self.pseudo_label_creator.cls_thr_low)
@@ -331,6 +339,9 @@ class SSODTrainer(Trainer):
             # mAP
             callbacks.run('on_train_epoch_end', epoch=self.epoch)
             self.ema.update_attr(self.model, include=['yaml', 'nc', 'hyp', 'names', 'stride', 'class_weights'])
+            for ema in self.ema, self.semi_ema:
+                if ema:
+                    ema.wait()
             final_epoch = (self.epoch + 1 == self.epochs)
             if not self.noval or final_epoch:  # Calculate mAP
                 val_ssod = self.cfg.SSOD.train_domain
@@ -355,7 +366,7 @@ class SSODTrainer(Trainer):
                     self.results, maps, _, cls_thr = val.run(self.data_dict,
                                            batch_size=self.batch_size // self.WORLD_SIZE * 2,
                                            imgsz=self.imgsz,
-                                           model=self.semi_ema.ema,
+                                           model=self.semi_ema.device_model(fresh=True),
                                            conf_thres=self.cfg.val_conf_thres, 
                                            single_cls=self.single_cls,
                                            dataloader=self.val_loader,
@@ -370,7 +381,7 @@ class SSODTrainer(Trainer):
                     self.results, maps, _, cls_thr = val.run(self.data_dict,
                                            batch_size=self.batch_size // self.WORLD_SIZE * 2,
                                            imgsz=self.imgsz,
-                                           model=self.ema.ema,
+                                           model=self.ema.device_model(fresh=True),
                                            conf_thres=self.cfg.val_conf_thres, 
                                            single_cls=self.single_cls,
                                            dataloader=self.val_loader,
@@ -394,44 +405,123 @@ class SSODTrainer(Trainer):
                 if self.epoch >= self.cfg.hyp.burn_epochs:
                     ckpt = {'epoch': self.epoch,
                         'best_fitness': self.best_fitness,
-                        'model': deepcopy(de_parallel(self.model)).half(),
-                        'ema': deepcopy(self.semi_ema.ema).half(),
+                        'model': de_parallel(self.model),
+                        'ema': self.semi_ema.ema,
                         'updates': self.ema.updates,
                         'optimizer': self.optimizer.state_dict(),
                         'wandb_id':  None}
                 else:
                     ckpt = {'epoch': self.epoch,
                         'best_fitness': self.best_fitness,
-                        'model': deepcopy(de_parallel(self.model)).half(),
-                        'ema': deepcopy(self.ema.ema).half(),
+                        'model': de_parallel(self.model),
+                        'ema': self.ema.ema,
                         'updates': self.ema.updates,
                         'optimizer': self.optimizer.state_dict(),
                         'wandb_id':  None}
 
-                # Save last, best and delete
-                torch.save(ckpt, self.last)
-                if self.best_fitness == fi:
-                    torch.save(ckpt, self.best)
-                if (self.epoch > 0) and (self.save_period > 0) and (self.epoch % self.save_period == 0):
-                    w = self.save_dir / 'weights'  # weights dir
-                    torch.save(ckpt, w / f'epoch{self.epoch}.pt')
-                del ckpt
-                callbacks.run('on_model_save', self.last, self.epoch, final_epoch, self.best_fitness, fi)
+                self.save_checkpoint(ckpt, fi, final_epoch, callbacks)
+
+    def preprocess_unlabeled(self, target_imgs, target_imgs_ori, target_gt, target_M):
+        # Unlabeled batch to the device as float 0.0-1.0 strong and weak views. With SSOD.device_strong_view the loader
+        # ships the weak view only and the strong view, its ground truth and M_s rows are built here
+        if self.strong_view is None:
+            target_imgs = target_imgs.to(self.device, non_blocking=True).float() / 255.0
+            target_imgs_ori = target_imgs_ori.to(self.device, non_blocking=True).float() / 255.0
+            return target_imgs, target_imgs_ori, target_gt, target_M
+        target_imgs_ori = target_imgs.to(self.device, non_blocking=True).float()
+        target_imgs, target_gt, target_M = self.strong_view(target_imgs_ori, target_gt)
+        return target_imgs / 255.0, target_imgs_ori / 255.0, target_gt, target_M
+
+    def preprocess_batch(self, batch):
+        # Labeled batches are scaled by 255 in semi-supervised training
+        imgs, targets, paths, shapes = batch
+        imgs, targets = self.preprocess(imgs, targets, 255.0, shapes)
+        return imgs, targets, paths, shapes
+
+    def preprocess_unlabeled_batch(self, batch):
+        # preprocess_unlabeled() of a collated unlabeled batch, run ahead of compute by the prefetcher
+        target_imgs, target_gt, target_paths, shapes, target_imgs_ori, target_M = batch
+        target_imgs, target_imgs_ori, target_gt, target_M = self.preprocess_unlabeled(target_imgs, target_imgs_ori,
+                                                                                      target_gt, target_M)
+        return target_imgs, target_gt, target_paths, shapes, target_imgs_ori, target_M
+
+    def preprocess_labeled(self, batch):
+        # Labeled part of a train_loader batch, the joint loader yields (labeled, unlabeled) pairs
+        return self.preprocess_batch(batch[0] if self.joint_loader else batch)
+
+    def preprocess_joint(self, batch):
+        # Both parts of a joint loader pair, the unlabeled part is None before it is sampled
+        labeled, unlabeled = batch
+        return self.preprocess_batch(labeled), None if unlabeled is None else self.preprocess_unlabeled_batch(unlabeled)
+
+    def prefetch_next(self, loader, fn):
+        # Prefetcher and iterator over 'loader' repeated forever, for the loader drawn with next() by the other's loop
+        if loader not in self.side_prefetch:
+            p = self.prefetch(loader, fn, forever=True)
+            self.side_prefetch[loader] = p, iter(p)
+        return self.side_prefetch[loader]
+
+    def loaders(self):
+        # Training loaders by name, their positions are saved in iteration checkpoints
+        loaders = super().loaders()
+        if self.unlabeled_dataloader is not None:
+            loaders['target'] = self.unlabeled_dataloader
+        return loaders
+
+    def rank_state(self):
+        # Per-rank part of an iteration checkpoint, LabelMatch statistics are gathered per rank
+        state = super().rank_state()
+        if hasattr(self.pseudo_label_creator, 'resume_state'):
+            state['pseudo_label'] = self.pseudo_label_creator.resume_state()
+        return state
+
+    def iter_checkpoint(self, i, main):
+        ckpt = super().iter_checkpoint(i, main)
+        if self.semi_ema:
+            self.semi_ema.wait()
+            ckpt.update({'semi_ema': self.semi_ema.ema.state_dict(), 'semi_ema_updates': self.semi_ema.updates,
+                         'semi_ema_decay': self.semi_ema.decay, 'semi_ema_fused': self.semi_ema.fused_state()})
+        return ckpt
+
+    def restore_iter_state(self):
+        s = super().restore_iter_state()
+        if s is None:
+            return
+        if s.get('semi_ema') is not None:
+            if not self.semi_ema:  # resumed inside the first epoch after burn-in
+                self.semi_ema = self.build_semi_ema(self.epochs - self.cfg.hyp.burn_epochs)
+            self.semi_ema.ema.load_state_dict(s['semi_ema'])
+            self.semi_ema.updates, self.semi_ema.decay = s['semi_ema_updates'], s['semi_ema_decay']
+            if s.get('semi_ema_fused') is not None:
+                self.semi_ema.load_fused_state(s['semi_ema_fused'])
+        state = s['ranks'][min(max(self.RANK, 0), len(s['ranks']) - 1)]
+        if 'pseudo_label' in state and hasattr(self.pseudo_label_creator, 'load_resume_state'):
+            self.pseudo_label_creator.load_resume_state(state['pseudo_label'])
+            self.compute_un_sup_loss.ignore_thres_high = self.pseudo_label_creator.cls_thr_high
+            self.compute_un_sup_loss.ignore_thres_low = self.pseudo_label_creator.cls_thr_low
+        if self.model_type == 'tal' and self.epoch > self.cfg.hyp.burn_epochs:
+            self.compute_un_sup_loss.cur_epoch = self.epoch - 1 - self.cfg.hyp.burn_epochs
+        return s
 
     def train_without_unlabeled(self, callbacks):
-        pbar = enumerate(self.train_loader)
+        loader = self.prefetch(self.train_loader, self.preprocess_labeled)  # uint8 to float32, 0-255 to 0.0-1.0
+        start = self.epoch_start_iter()
+        pbar = enumerate(loader, start)
         if self.RANK in [-1, 0]:
-            pbar = tqdm(pbar, total=self.nb)  # progress bar
+            pbar = tqdm(pbar, total=self.nb, initial=start)  # progress bar
 
         self.optimizer.zero_grad()
+        self.profiler.start()
         for i, (imgs, targets, paths, _) in pbar:  # batch -------------------------------------------------------------
             ni = i + self.nb * self.epoch  # number integrated batches (since train start)
-            imgs = imgs.to(self.device, non_blocking=True).float() / 255.0  # uint8 to float32, 0-255 to 0.0-1.0
+            self.profiler.lap('data')
             # Forward
             #with torch.autograd.set_detect_anomaly(True):
             with amp.autocast(enabled=self.cuda):
                 pred, sup_feats = self.model(imgs)  # forward
+                self.profiler.lap('forward')
                 loss, loss_items = self.compute_loss(pred, targets.to(self.device))  # loss scaled by batch_size 
+                self.profiler.lap('loss')
 
                 if self.RANK != -1:
                     loss *= self.WORLD_SIZE  # gradient averaged between devices in DDP mode
@@ -441,23 +531,28 @@ class SSODTrainer(Trainer):
                 loss = loss + 0 * (sup_feats[0].mean() + sup_feats[1].mean() + sup_feats[2].mean())
 
             self.update_optimizer(loss, ni) 
+            self.save_iter_checkpoint(i)
 
             # Log
             if self.RANK in [-1, 0]:
                 self.meter.update(loss_items)
-                mloss_count= len(self.meter.meters.items())
-                mem = f'{torch.cuda.memory_reserved() / 1E9 if torch.cuda.is_available() else 0:.3g}G'  # (GB)
-                pbar.set_description(('%10s' * 2 + '%10.4g' * (mloss_count+2)) % (
-                    f'{self.epoch}/{self.epochs - 1}', mem,  targets.shape[0], imgs.shape[-1], *self.meter.get_avg()))
+                if self.log_step(ni):
+                    mloss_count= len(self.meter.meters.items())
+                    mem = f'{torch.cuda.memory_reserved() / 1E9 if torch.cuda.is_available() else 0:.3g}G'  # (GB)
+                    pbar.set_description(('%10s' * 2 + '%10.4g' * (mloss_count+2)) % (
+                        f'{self.epoch}/{self.epochs - 1}', mem,  targets.shape[0], imgs.shape[-1], *self.meter.get_avg()))
                 callbacks.run('on_train_batch_end', ni, self.model, imgs, targets, paths, self.plots, self.sync_bn, self.cfg.Dataset.np)
+            self.profiler.step(ni, callbacks)
         # end batch ------------------------------------------------------------------------------------------------
         # Scheduler
+        self.log_data_wait(loader)
         self.lr = [x['lr'] for x in self.optimizer.param_groups]  # for loggers
         self.scheduler.step()  
 
     def update_optimizer(self, loss, ni):
         # Backward
         self.scaler.scale(loss).backward()
+        self.profiler.lap('backward')
                 
         if self.fixed_accumulate:
             self.accumulate = 1
@@ -482,33 +577,48 @@ class SSODTrainer(Trainer):
             self.scaler.step(self.optimizer)  # optimizer.step
             self.scaler.update()
             self.optimizer.zero_grad()
+            self.profiler.lap('optimizer')
             self.ema.update(self.model)
             if self.semi_ema:
                 self.semi_ema.update(self.ema.ema)
+            self.profiler.lap('ema')
             self.last_opt_step = ni
 
     def train_without_unlabeled_da(self, callbacks):
-        pbar = enumerate(self.train_loader)
+        fn = self.preprocess_joint if self.joint_loader else self.preprocess_batch
+        loader = self.prefetch(self.train_loader, fn)  # uint8 to float32, 0-255 to 0.0-1.0
+        start = self.epoch_start_iter()
+        pbar = enumerate(loader, start)
         if self.RANK in [-1, 0]:
-            pbar = tqdm(pbar, total=self.nb)  # progress bar
+            pbar = tqdm(pbar, total=self.nb, initial=start)  # progress bar
 
         self.optimizer.zero_grad()
-        for i, (imgs, targets, paths, _) in pbar:  # batch -------------------------------------------------------------
+        self.profiler.start()
+        for i, batch in pbar:  # batch -------------------------------------------------------------
             ni = i + self.nb * self.epoch  # number integrated batches (since train start)
-            imgs = imgs.to(self.device, non_blocking=True).float() / 255.0  # uint8 to float32, 0-255 to 0.0-1.0
-            target_imgs, target_targets, target_paths, _, target_imgs_ori, target_M = next(self.unlabeled_dataloader.__iter__())
-            target_imgs_ori = target_imgs_ori.to(self.device, non_blocking=True).float() / 255.0 
+            self.profiler.lap('data')
+            if self.joint_loader:  # the weak view of the pair is on the device already
+                (imgs, targets, paths, _), (_, _, _, _, target_imgs_ori, _) = batch
+            else:
+                imgs, targets, paths, _ = batch
+                target_imgs, target_targets, target_paths, _, target_imgs_ori, target_M = next(self.unlabeled_dataloader.__iter__())
+                if self.strong_view is not None:  # the loader ships the weak view only
+                    target_imgs_ori = target_imgs
+                target_imgs_ori = target_imgs_ori.to(self.device, non_blocking=True).float() / 255.0 
+                self.profiler.lap('h2d')
             total_imgs = torch.cat([imgs, target_imgs_ori], 0)
             n_img, _, _, _ = imgs.shape
             # Forward
             #with torch.autograd.set_detect_anomaly(True):
             with amp.autocast(enabled=self.cuda):
                 total_pred, total_feature = self.model(total_imgs)  # forward
+                self.profiler.lap('forward')
 
                 sup_pred, sup_feature, un_sup_pred, un_sup_feature = self.split_predict_and_feature(total_pred, total_feature, n_img)
                 loss, loss_items = self.compute_loss(sup_pred, targets.to(self.device))  # loss scaled by batch_size 
                 d_loss = self.domain_loss(sup_feature)
                 t_loss = self.target_loss(un_sup_feature) 
+                self.profiler.lap('loss')
 
                 loss = loss + d_loss * self.da_loss_weights + t_loss * self.da_loss_weights + 0 * un_sup_pred[0].mean() + 0 * un_sup_pred[1].mean() + 0 * un_sup_pred[2].mean()
                 # else:
@@ -518,26 +628,30 @@ class SSODTrainer(Trainer):
                     loss *= self.WORLD_SIZE  # gradient averaged between devices in DDP mode
 
             self.update_optimizer(loss, ni) 
+            self.save_iter_checkpoint(i)
 
             # Log
             if self.RANK in [-1, 0]:
                 self.meter.update(loss_items)
-                mloss_count= len(self.meter.meters.items())
-                mem = f'{torch.cuda.memory_reserved() / 1E9 if torch.cuda.is_available() else 0:.3g}G'  # (GB)
-                pbar.set_description(('%10s' * 2 + '%10.4g' * (mloss_count+2)) % (
-                    f'{self.epoch}/{self.epochs - 1}', mem,  targets.shape[0], imgs.shape[-1], *self.meter.get_avg()))
+                if self.log_step(ni):
+                    mloss_count= len(self.meter.meters.items())
+                    mem = f'{torch.cuda.memory_reserved() / 1E9 if torch.cuda.is_available() else 0:.3g}G'  # (GB)
+                    pbar.set_description(('%10s' * 2 + '%10.4g' * (mloss_count+2)) % (
+                        f'{self.epoch}/{self.epochs - 1}', mem,  targets.shape[0], imgs.shape[-1], *self.meter.get_avg()))
                 callbacks.run('on_train_batch_end', ni, self.model, imgs, targets, paths, self.plots, self.sync_bn, self.cfg.Dataset.np)
+            self.profiler.step(ni, callbacks)
         # end batch ------------------------------------------------------------------------------------------------
         # Scheduler
+        self.log_data_wait(loader)
         self.lr = [x['lr'] for x in self.optimizer.param_groups]  # for loggers
         self.scheduler.step()  
 
     def after_train(self, callbacks, val):
         results = (0, 0, 0, 0, 0, 0, 0)  # P, R, mAP@.5, mAP@.5-.95, val_loss(box, obj, clss)
         if self.RANK in [-1, 0]:
+            self.strip_checkpoints()
             for f in self.last, self.best:
                 if f.exists():
-                    strip_optimizer(f)  # strip optimizers
                     if f is self.best:
                         LOGGER.info(f'\nValidating {f}...')
                         # val_ssod = self.cfg.SSOD.train_domain
@@ -596,7 +710,7 @@ class SSODTrainer(Trainer):
             #build pseudo label via pred from teacher model
             with torch.no_grad():
                 if self.model_type in ['yolov5']:
-                    (teacher_pred, train_out), teacher_feature = self.ema.ema(unlabeled_imgs_ori, augment=False)
+                    (teacher_pred, train_out), teacher_feature = self.ema.device_model()(unlabeled_imgs_ori, augment=False)
                 # elif self.model_type == 'tal':
                 #     teacher_pred, teacher_feature = self.ema.ema(unlabeled_imgs_ori, augment=False)
                 # elif self.model_type == 'yoloxkp':
@@ -609,6 +723,7 @@ class SSODTrainer(Trainer):
                     for teacher_model in self.extra_teacher_models:
                         teacher_out = teacher_model(unlabeled_imgs_ori)[0]
                         extra_teacher_outs.append(teacher_out)
+        self.profiler.lap('teacher')
 
         if len(self.extra_teacher_models) > 0 and len(extra_teacher_outs) > 0 :
             unlabeled_targets, unlabeled_imgs, invalid_target_shape = self.pseudo_label_creator.create_pseudo_label_online_with_extra_teachers(teacher_pred, extra_teacher_outs, copy.deepcopy(unlabeled_imgs), unlabeled_M, self.extra_teacher_class_idxs, self.RANK)
@@ -621,11 +736,13 @@ class SSODTrainer(Trainer):
             unlabeled_imgs = unlabeled_imgs.to(self.device)
         else:    
             raise NotImplementedError
+        self.profiler.lap('pseudo_label')
 
         total_imgs = torch.cat([imgs, unlabeled_imgs], 0)
         
         with amp.autocast(enabled=self.cuda):
             total_pred, total_feature = self.model(total_imgs)  # forward
+            self.profiler.lap('forward')
             sup_pred, sup_feature, un_sup_pred, un_sup_feature = self.split_predict_and_feature(total_pred, total_feature, n_img)
             sup_loss, sup_loss_items = self.compute_loss(sup_pred, targets.to(self.device)) 
 
@@ -639,6 +756,7 @@ class SSODTrainer(Trainer):
             # total_t2 = time_sync()
             if self.RANK != -1:
                 sup_loss *= self.WORLD_SIZE  # gradient averaged between devices in DDP mode
+            self.profiler.lap('loss')
             if( invalid_target_shape ): #伪标签生成质量没有达到要求之前不计算loss
                 un_sup_loss = torch.zeros(1, device=self.device) 
                 un_sup_loss_items = dict(ss_box=0, ss_obj=0, ss_cls=0)
@@ -648,6 +766,7 @@ class SSODTrainer(Trainer):
                 # un_sup_loss = un_sup_loss * self.cfg.SSOD.teacher_loss_weight
             if self.RANK != -1:
                 un_sup_loss *= self.WORLD_SIZE
+            self.profiler.lap('unsup_loss')
         loss = sup_loss + un_sup_loss * self.cfg.SSOD.teacher_loss_weight
         # if self.cfg.SSOD.imitate_teacher:
             # loss += loss_imitate
@@ -674,44 +793,71 @@ class SSODTrainer(Trainer):
                 self.meter.update(hit_rate)
 
 
-            mloss_count= len(self.meter.meters.items())
-            mem = f'{torch.cuda.memory_reserved() / 1E9 if torch.cuda.is_available() else 0:.3g}G'  # (GB)
-            pbar.set_description(('%10s' * 2 + '%10.4g' * (mloss_count + 2 )) % (
-                f'{self.epoch}/{self.epochs - 1}', mem, targets.shape[0], imgs.shape[-1], *self.meter.get_avg()))
+            if self.log_step(ni):
+                mloss_count= len(self.meter.meters.items())
+                mem = f'{torch.cuda.memory_reserved() / 1E9 if torch.cuda.is_available() else 0:.3g}G'  # (GB)
+                pbar.set_description(('%10s' * 2 + '%10.4g' * (mloss_count + 2 )) % (
+                    f'{self.epoch}/{self.epochs - 1}', mem, targets.shape[0], imgs.shape[-1], *self.meter.get_avg()))
             
             callbacks.run('on_train_batch_end', ni, self.model, imgs, targets, paths, self.plots, self.sync_bn, self.cfg.Dataset.np)
 
     def train_with_unlabeled(self, callbacks):
         # hit_rate = dict(p_rate=0, r_rate=0); 
 
-        if self.epoch_adaptor:
+        if self.joint_loader:  # paired batches, the epoch length is set by the joint sampler
+            loader = self.prefetch(self.train_loader, self.preprocess_joint)
+            prefetchers = [loader]
+            start = self.epoch_start_iter()
+            pbar = enumerate(loader, start)
+            if self.RANK in [-1, 0]:
+                pbar = tqdm(pbar, total=self.nb, initial=start)  # progress bar
+            self.optimizer.zero_grad()
+            self.profiler.start()
+            for i, ((imgs, targets, paths, _), (target_imgs, target_gt, target_paths, _, target_imgs_ori, target_M)) in pbar:
+                ni = i + self.nb * self.epoch  # number integrated batches (since train start)
+                self.profiler.lap('data')
+                self.train_instance(imgs, targets, paths, target_imgs, target_imgs_ori, target_gt, target_M, ni, pbar,target_paths, callbacks)
+                self.save_iter_checkpoint(i)
+                self.profiler.step(ni, callbacks)
+        elif self.epoch_adaptor:
             self.nb = len(self.unlabeled_dataloader)  # number of batches
-            pbar = enumerate(self.unlabeled_dataloader)
+            loader = self.prefetch(self.unlabeled_dataloader, self.preprocess_unlabeled_batch)
+            side, side_iter = self.prefetch_next(self.train_loader, self.preprocess_batch)
+            prefetchers = [loader, side]
+            start = self.epoch_start_iter()
+            pbar = enumerate(loader, start)
             if self.RANK in [-1, 0]:
-                pbar = tqdm(pbar, total=self.nb)  # progress bar
+                pbar = tqdm(pbar, total=self.nb, initial=start)  # progress bar
             self.optimizer.zero_grad()
+            self.profiler.start()
             for i , (target_imgs, target_gt, target_paths, _, target_imgs_ori, target_M) in pbar:
                 ni = i + self.nb * self.epoch  # number integrated batches (since train start)
-                imgs, targets, paths, _ = next(self.train_loader.__iter__())
-                imgs = imgs.to(self.device, non_blocking=True).float() / 255.0 
-                target_imgs = target_imgs.to(self.device, non_blocking=True).float() / 255.0 
-                target_imgs_ori = target_imgs_ori.to(self.device, non_blocking=True).float() / 255.0 
+                self.profiler.lap('data')
+                imgs, targets, paths, _ = next(side_iter)
                 self.train_instance(imgs, targets, paths, target_imgs, target_imgs_ori, target_gt, target_M, ni, pbar,target_paths, callbacks)
+                self.save_iter_checkpoint(i, main='target')
+                self.profiler.step(ni, callbacks)
         else:
-            pbar = enumerate(self.train_loader)
+            loader = self.prefetch(self.train_loader, self.preprocess_batch)
+            side, side_iter = self.prefetch_next(self.unlabeled_dataloader, self.preprocess_unlabeled_batch)
+            prefetchers = [loader, side]
+            start = self.epoch_start_iter()
+            pbar = enumerate(loader, start)
             if self.RANK in [-1, 0]:
-                pbar = tqdm(pbar, total=self.nb)  # progress bar
+                pbar = tqdm(pbar, total=self.nb, initial=start)  # progress bar
             self.optimizer.zero_grad()
+            self.profiler.start()
             for i , (imgs, targets, paths, _) in pbar:
                 ni = i + self.nb * self.epoch  # number integrated batches (since train start)
-                target_imgs, target_gt, target_paths, _, target_imgs_ori, target_M= next(self.unlabeled_dataloader.__iter__())
-                imgs = imgs.to(self.device, non_blocking=True).float() / 255.0 
-                target_imgs = target_imgs.to(self.device, non_blocking=True).float() / 255.0 
-                target_imgs_ori = target_imgs_ori.to(self.device, non_blocking=True).float() / 255.0 
+                self.profiler.lap('data')
+                target_imgs, target_gt, target_paths, _, target_imgs_ori, target_M = next(side_iter)
                 self.train_instance(imgs, targets, paths, target_imgs, target_imgs_ori, target_gt, target_M, ni, pbar,target_paths, callbacks)
+                self.save_iter_checkpoint(i)
+                self.profiler.step(ni, callbacks)
             
         # end batch ------------------------------------------------------------------------------------------------
         
         # Scheduler
+        self.log_data_wait(*prefetchers)
         self.lr = [x['lr'] for x in self.optimizer.param_groups]  # for loggers
         self.scheduler.step()  
\ No newline at end of file
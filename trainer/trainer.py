@@ -7,8 +7,8 @@ Usage:
 """
 
 import logging
+import os
 import time
-from copy import deepcopy
 from pathlib import Path
 
 import numpy as np
@@ -23,13 +23,17 @@ from tqdm import tqdm
 from models.backbone.experimental import attempt_load
 from models.detector.yolo import Model
 from utils.autoanchor import check_anchors
+from utils.batch_augment import BatchAugment, letterboxed
+from utils.checkpoint_writer import CheckpointWriter, atomic_link, host_snapshot
 from utils.datasets import create_dataloader
 from utils.general import labels_to_class_weights, init_seeds, \
-    strip_optimizer, check_img_size, check_suffix, one_cycle, colorstr, methods
+    strip_optimizer, check_img_size, check_suffix, one_cycle, colorstr, methods, rng_state, set_rng_state
 from utils.downloads import attempt_download
 from models.loss.loss import ComputeLoss, ComputeNanoLoss
 from models.loss.yolox_loss import ComputeFastXLoss
 from utils.plots import plot_labels
+from utils.prefetcher import DevicePrefetcher
+from utils.step_profiler import NullProfiler, StepProfiler
 from utils.torch_utils import ModelEMA, de_parallel, intersect_dicts, torch_distributed_zero_first, is_parallel
 from utils.metrics import MetricMeter, fitness
 from utils.loggers import Loggers
@@ -88,12 +92,13 @@ class Trainer:
         # Trainloader
         self.train_loader, self.dataset = create_dataloader(self.data_dict['train'], self.imgsz, self.batch_size // self.WORLD_SIZE, gs, self.single_cls,
                                               hyp=cfg.hyp, augment=cfg.hyp.use_aug, cache=cfg.cache, rect=cfg.rect, rank=self.LOCAL_RANK,
-                                              workers=cfg.Dataset.workers, prefix=colorstr('train: '),cfg=cfg)
+                                              workers=cfg.Dataset.workers, prefix=colorstr('train: '),cfg=cfg, train=True)
+        self.batch_augment = BatchAugment(cfg.hyp, cfg.Dataset.np) if cfg.Dataset.batch_augment and cfg.hyp.use_aug else None
         # for d in self.train_loader:
         #     print(len(d))
         #     assert 0
         # print('dataset labels:', dataset.labels)
-        mlc = int(np.concatenate(self.dataset.labels, 0)[:, 0].max())  # max label class
+        mlc = int(self.dataset.labels.concat()[:, 0].max())  # max label class
         self.nb = len(self.train_loader)  # number of batches
         assert mlc < self.nc, f'Label class {mlc} exceeds nc={self.nc} in {cfg.Dataset.data_name}. Possible class labels are 0-{self.nc - 1}'
 
@@ -105,7 +110,7 @@ class Trainer:
                                        prefix=colorstr('val: '),cfg=cfg)[0]
 
             if not cfg.resume:
-                labels = np.concatenate(self.dataset.labels, 0)
+                labels = self.dataset.labels.concat()
                 # c = torch.tensor(labels[:, 0])  # classes
                 # cf = torch.bincount(c.long(), minlength=nc) + 1.  # frequency
                 # model._initialize_biases(cf.to(device))
@@ -154,7 +159,7 @@ class Trainer:
                 v.requires_grad = False
         
           # EMA
-        self.ema = ModelEMA(self.model) if self.RANK in [-1, 0] else None
+        self.ema = ModelEMA(self.model, every=cfg.ema_every, offload=self.ema_offload()) if self.RANK in [-1, 0] else None
 
         # Resume
         self.start_epoch = 0
@@ -185,6 +190,9 @@ class Trainer:
                 self.epochs += ckpt['epoch']  # finetune additional epochs
 
             # del ckpt, csd
+        self.first_epoch = self.start_epoch  # epoch this run started at, kept by iteration checkpoints
+        if pretrained and cfg.resume and ckpt.get('iter') is not None:
+            self.load_iter_checkpoint(ckpt)
         self.epoch = self.start_epoch
         self.model_type = self.model.model_type
         self.detect = self.model.head
@@ -268,11 +276,21 @@ class Trainer:
         self.RANK = RANK
         self.WORLD_SIZE = WORLD_SIZE
         self.norm_scale = cfg.Dataset.norm_scale
+        self.prefetch_depth = cfg.Dataset.prefetch
+        self.prefetchers = {}  # loader: its latest DevicePrefetcher
+        self.iter_save_period = cfg.iter_save_period
+        self.log_period = max(cfg.log_period, 1)
+        self.resume_iter = 0  # first batch of the epoch resumed from an iteration checkpoint
+        self.iter_state = None  # iteration checkpoint contents applied by restore_iter_state()
 
         # Directories
         w = self.save_dir / 'weights'  # weights dir
         w.mkdir(parents=True, exist_ok=True)  # make dir
         self.last, self.best = w / 'last.pt', w / 'best.pt'
+        self.profiler = StepProfiler(device, cfg.profile_period, cfg.profile_window, cfg.profile_sync,
+                                     self.save_dir / f'step_profile.{cfg.profile_format}') \
+            if cfg.profile_period > 0 and RANK in [-1, 0] else NullProfiler()
+        self.saver = CheckpointWriter(cfg.async_save)
 
         with open(self.save_dir / 'opt.yaml', 'w') as f:
             with redirect_stdout(f): print(cfg.dump())
@@ -341,19 +359,16 @@ class Trainer:
         log_contents = ['Epoch', 'gpu_mem', 'labels', 'img_size']
 
         self.log_contents = log_contents
-    
+
     def update_train_logger(self):
-        for (imgs, targets, paths, _) in self.train_loader:  # batch -------------------------------------------------------------
-            imgs = imgs.to(self.device, non_blocking=True).float() / self.norm_scale  # uint8 to float32, 0-255 to 0.0-1.0
-            with amp.autocast(enabled=self.cuda):
-                pred = self.model(imgs)  # forward
-                loss, loss_items = self.compute_loss(pred, targets.to(self.device))  # loss scaled by batch_size
-                #TODO loss是否需要scale up需要进行讨论
-            if self.RANK in [-1, 0]:
-                for loss_key in loss_items.keys():
-                    self.log_contents.append(loss_key)
-            break
+        # Loss columns declared by the loss class, no forward pass needed
+        if self.RANK in [-1, 0]:
+            self.log_contents += list(self.compute_loss.loss_names)
         LOGGER.info(('\n' + '%10s' * len(self.log_contents)) % tuple(self.log_contents))
+
+    def log_step(self, ni):
+        # Sync the on-device loss meter for the progress bar every log_period batches and on the last batch
+        return (ni + 1) % self.log_period == 0 or (ni + 1) % self.nb == 0
     
     def before_epoch(self):
         self.model.train()
@@ -367,20 +382,18 @@ class Trainer:
             if self.model_type == 'yolox':
                 self.detect.use_l1 = True
 
-        self.meter = MetricMeter()
+        self.meter = MetricMeter(self.log_contents[4:])
 
         if self.warmup_epochs > 0:
              self.nw = max(round(self.warmup_epochs * self.nb), 1000)  # number of warmup iterations, max(3 epochs, 1k iterations)
-             self.nw = min(self.nw, (self.epochs - self.start_epoch) / 2 * self.nb)
+             self.nw = min(self.nw, (self.epochs - self.first_epoch) / 2 * self.nb)
         else:
              self.nw = -1
-
-        if self.RANK != -1:
-            self.train_loader.sampler.set_epoch(self.epoch)
     
     def update_optimizer(self, loss, ni):
         # Backward
         self.scaler.scale(loss).backward()
+        self.profiler.lap('backward')
                 
         self.accumulate = max(round(64 / self.batch_size), 1) 
 
@@ -399,28 +412,140 @@ class Trainer:
             self.scaler.step(self.optimizer)  # optimizer.step
             self.scaler.update()
             self.optimizer.zero_grad()
+            self.profiler.lap('optimizer')
             if self.ema:
                 self.ema.update(self.model)
+            self.profiler.lap('ema')
             self.last_opt_step = ni
     
-    def train_in_epoch(self, callbacks):
+    def preprocess(self, imgs, targets, scale=None, shapes=None):
+        # Training batch to the device as float 0.0-1.0, Dataset.batch_augment runs on the device before scaling and
+        # warps the images with collated shapes, the mosaics (shapes None) were warped by the workers
+        imgs = imgs.to(self.device, non_blocking=True).float()  # uint8 to float32
+        if self.batch_augment is not None:
+            imgs, targets = self.batch_augment(imgs, targets, None if shapes is None else letterboxed(shapes))
+        return imgs / (scale or self.norm_scale), targets
+
+    def preprocess_batch(self, batch):
+        # preprocess() of a (imgs, targets, paths, shapes) batch, run ahead of compute by the prefetcher
+        imgs, targets, paths, shapes = batch
+        imgs, targets = self.preprocess(imgs, targets, shapes=shapes)
+        return imgs, targets, paths, shapes
+
+    def prefetch(self, loader, fn, forever=False):
+        # Batches of 'loader' preprocessed by 'fn' Dataset.prefetch batches ahead, see utils/prefetcher.py
+        if self.prefetch_depth <= 0 or self.cuda:  # preprocessing runs in this thread, profile it as 'h2d'
+            fn = self.profiler.timed('h2d', fn)
+        self.prefetchers[loader] = DevicePrefetcher(loader, fn, self.device, self.prefetch_depth, forever)
+        return self.prefetchers[loader]
+
+    def ema_offload(self):
+        # Device the EMAs are offloaded from to pinned host memory with cfg.ema_offload, None keeps them on it
+        device = next(self.model.parameters()).device
+        return device if self.cfg.ema_offload and device.type == 'cuda' else None
+
+    def loaders(self):
+        # Training loaders by name, their positions are saved in iteration checkpoints
+        return {'train': self.train_loader}
+
+    def epoch_start_iter(self):
+        # First batch of this epoch, past the batches trained before the iteration checkpoint it was resumed from
+        return self.resume_iter if self.epoch == self.start_epoch else 0
+
+    def rank_state(self):
+        # Per-rank part of an iteration checkpoint
+        return {'rng': rng_state()}
+
+    def iter_checkpoint(self, i, main):
+        # Everything but the per-rank states needed to continue at batch i + 1 of this epoch
+        self.ema.wait()
+        return {'epoch': self.epoch,
+                'iter': i,
+                'first_epoch': self.first_epoch,
+                'best_fitness': self.best_fitness,
+                'model': de_parallel(self.model),
+                'ema': self.ema.ema,
+                'updates': self.ema.updates,
+                'ema_fused': self.ema.fused_state(),
+                'optimizer': self.optimizer.state_dict(),
+                'scaler': self.scaler.state_dict(),
+                'last_opt_step': self.last_opt_step,
+                'loaders': {k: self.prefetchers[v].position() if v in self.prefetchers else getattr(v, 'batches', 0)
+                            for k, v in self.loaders().items() if v is not None},
+                'main': main,
+                'wandb_id': None}
+
+    def save_iter_checkpoint(self, i, main='train'):
+        # Write weights/iter.pt every iter_save_period batches, FP32 so that training resumes exactly
+        if self.iter_save_period <= 0 or (i + 1) % self.iter_save_period or i + 1 >= self.nb:
+            return
+        ranks = [self.rank_state()]
+        if self.RANK != -1:
+            ranks = [None] * self.WORLD_SIZE
+            dist.all_gather_object(ranks, self.rank_state())
+        if self.RANK in [-1, 0]:
+            ckpt = self.iter_checkpoint(i, main)
+            ckpt['ranks'] = ranks
+            self.saver.save(host_snapshot(ckpt, half=False), [self.last.with_name('iter.pt')])
+
+    def load_iter_checkpoint(self, ckpt):
+        # Resume inside epoch ckpt['epoch'] at the batch after ckpt['iter'], model and EMA are loaded by build_model()
+        self.start_epoch = ckpt['epoch']
+        self.first_epoch = ckpt['first_epoch']
+        self.resume_iter = ckpt['iter'] + 1
+        self.iter_state = {k: v for k, v in ckpt.items() if k not in ('model', 'ema')}
+        LOGGER.info(f'Resuming epoch {self.start_epoch} at batch {self.resume_iter}')
+
+    def restore_iter_state(self):
+        # Optimizer, scaler, loader positions and random states of the iteration checkpoint, before the first batch.
+        # Loader passes shuffle with sampler epochs counted from the first epoch of the run, resumed or not
+        s, self.iter_state = self.iter_state, None
+        positions = s['loaders'] if s is not None else {}
+        for k, v in self.loaders().items():
+            if hasattr(v, 'skip'):
+                v.skip(positions.get(k, 0), self.resume_iter if s is not None and k == s['main'] else 0,
+                       first_pass=self.first_epoch)
+            elif k in positions:
+                LOGGER.info(f'WARNING: {k} loader can not skip, its batches restart from the beginning')
+        if s is None:
+            return
+        self.optimizer.load_state_dict(s['optimizer'])
+        self.scaler.load_state_dict(s['scaler'])
+        self.last_opt_step, self.best_fitness = s['last_opt_step'], s['best_fitness']
+        if self.ema and s.get('ema_fused') is not None:
+            self.ema.load_fused_state(s['ema_fused'])
+        set_rng_state(s['ranks'][min(max(self.RANK, 0), len(s['ranks']) - 1)]['rng'])
+        return s
+
+    def log_data_wait(self, *prefetchers):
+        # Share of the epoch spent waiting for input, high values mean training is input-bound
+        if self.RANK in [-1, 0]:
+            stats = [p.stats() for p in prefetchers]
+            wait, t = sum(x[0] for x in stats), max(x[1] for x in stats)
+            LOGGER.info(f'Data wait {wait:.1f}s of {t:.1f}s ({100 * wait / max(t, 1e-6):.1f}%)')
 
-        pbar = enumerate(self.train_loader)
+    def train_in_epoch(self, callbacks):
+        loader = self.prefetch(self.train_loader, self.preprocess_batch)  # uint8 to float32, 0-255 to 0.0-1.0
+        start = self.epoch_start_iter()
+        pbar = enumerate(loader, start)
         if self.RANK in [-1, 0]:
-            pbar = tqdm(pbar, total=self.nb)  # progress bar
+            pbar = tqdm(pbar, total=self.nb, initial=start)  # progress bar
 
         self.optimizer.zero_grad()
+        self.profiler.start()
         for i, (imgs, targets, paths, _) in pbar:  # batch -------------------------------------------------------------
             if i == self.break_iter:
                 break
             ni = i + self.nb * self.epoch  # number integrated batches (since train start)
-            imgs = imgs.to(self.device, non_blocking=True).float() / self.norm_scale  # uint8 to float32, 0-255 to 0.0-1.0
+            self.profiler.lap('data')
 
             # Forward
             # with torch.autograd.set_detect_anomaly(True):
             with amp.autocast(enabled=self.cuda):
                 pred = self.model(imgs)  # forward
+                self.profiler.lap('forward')
                 loss, loss_items = self.compute_loss(pred, targets.to(self.device))  # loss scaled by batch_size
+                self.profiler.lap('loss')
                 #TODO loss是否需要scale up需要进行讨论
                 if self.RANK != -1:
                     loss *= self.WORLD_SIZE  # gradient averaged between devices in DDP mode
@@ -428,17 +553,21 @@ class Trainer:
                     #     loss *= 4.
 
             self.update_optimizer(loss, ni)
+            self.save_iter_checkpoint(i)
 
             # Log
             if self.RANK in [-1, 0]:
                 self.meter.update(loss_items)
-                mloss_count= len(self.meter.meters.items())
-                mem = f'{torch.cuda.memory_reserved() / 1E9 if torch.cuda.is_available() else 0:.3g}G'  # (GB)
-                pbar.set_description(('%10s' * 2 + '%10.4g' * (mloss_count+2)) % (
-                        f'{self.epoch}/{self.epochs - 1}', mem, targets.shape[0], imgs.shape[-1], *self.meter.get_avg()))
+                if self.log_step(ni):
+                    mloss_count= len(self.meter.meters.items())
+                    mem = f'{torch.cuda.memory_reserved() / 1E9 if torch.cuda.is_available() else 0:.3g}G'  # (GB)
+                    pbar.set_description(('%10s' * 2 + '%10.4g' * (mloss_count+2)) % (
+                            f'{self.epoch}/{self.epochs - 1}', mem, targets.shape[0], imgs.shape[-1], *self.meter.get_avg()))
                 callbacks.run('on_train_batch_end', ni, self.model, imgs, targets, paths, self.plots, self.sync_bn, self.cfg.Dataset.np)
+            self.profiler.step(ni, callbacks)
             # end batch ------------------------------------------------------------------------------------------------
             # Scheduler
+        self.log_data_wait(loader)
         self.lr = [x['lr'] for x in self.optimizer.param_groups]  # for loggers
         self.scheduler.step()
 
@@ -447,13 +576,14 @@ class Trainer:
             # mAP
             callbacks.run('on_train_epoch_end', epoch=self.epoch)
             self.ema.update_attr(self.model, include=['yaml', 'nc', 'hyp', 'names', 'stride', 'class_weights'])
+            self.ema.wait()
             final_epoch = (self.epoch + 1 == self.epochs)
             if not self.noval:  # Calculate mAP
                 # val_da = self.cfg.DomainAdaptation.train_domain
                 self.results, maps, _ = val.run(self.data_dict,
                                            batch_size=self.batch_size // self.WORLD_SIZE * 2,
                                            imgsz=self.imgsz,
-                                           model=self.ema.ema,
+                                           model=self.ema.device_model(fresh=True),
                                            single_cls=self.single_cls,
                                            dataloader=self.val_loader,
                                            save_dir=self.save_dir,
@@ -474,28 +604,41 @@ class Trainer:
             if (not self.nosave) or (final_epoch):  # if save
                 ckpt = {'epoch': self.epoch,
                         'best_fitness': self.best_fitness,
-                        'model': deepcopy(de_parallel(self.model)).half(),
-                        'ema': deepcopy(self.ema.ema).half(),
+                        'model': de_parallel(self.model),
+                        'ema': self.ema.ema,
                         'updates': self.ema.updates,
                         'optimizer': self.optimizer.state_dict(),
                         'wandb_id':  None}
 
-                # Save last, best and delete
-                torch.save(ckpt, self.last)
-                if self.best_fitness == fi:
-                    torch.save(ckpt, self.best)
-                if (self.epoch > 0) and (self.save_period > 0) and (self.epoch % self.save_period == 0):
-                    w = self.save_dir / 'weights'  # weights dir
-                    torch.save(ckpt, w / f'epoch{self.epoch}.pt')
-                del ckpt
-                callbacks.run('on_model_save', self.last, self.epoch, final_epoch, self.best_fitness, fi)
+                self.save_checkpoint(ckpt, fi, final_epoch, callbacks)
     
+    def save_checkpoint(self, ckpt, fi, final_epoch, callbacks):
+        # Snapshot ckpt to host memory and write last.pt, best.pt and epochN.pt on the checkpoint writer. The final
+        # epoch writes last.pt (and best.pt) as inference checkpoints in the same pass, after_train() keeps them
+        files = [self.last] + ([self.best] if self.best_fitness == fi else [])
+        files, stripped = ([], files) if final_epoch else (files, [])
+        if (self.epoch > 0) and (self.save_period > 0) and (self.epoch % self.save_period == 0):
+            files.append(self.save_dir / 'weights' / f'epoch{self.epoch}.pt')
+        args = self.last, self.epoch, final_epoch, self.best_fitness, fi
+        self.saver.save(host_snapshot(ckpt), files, stripped, then=lambda: callbacks.run('on_model_save', *args))
+
+    def strip_checkpoints(self):
+        # Wait for the checkpoint writer, strip last.pt and best.pt unless they were written stripped
+        self.saver.wait()
+        linked = self.last.exists() and self.best.exists() and os.path.samefile(self.last, self.best)
+        for f in self.last, self.best:
+            if f.exists() and f not in self.saver.stripped:
+                if f is self.best and linked:
+                    atomic_link(self.last, f)  # best.pt was a link to last.pt, stripped above
+                else:
+                    strip_optimizer(f)  # strip optimizers
+
     def after_train(self, callbacks, val):
         results = (0, 0, 0, 0, 0, 0, 0)  # P, R, mAP@.5, mAP@.5-.95, val_loss(box, obj, clss)
         if self.RANK in [-1, 0]:
+            self.strip_checkpoints()
             for f in self.last, self.best:
                 if f.exists():
-                    strip_optimizer(f)  # strip optimizers
                     if f is self.best:
                         LOGGER.info(f'\nValidating {f}...')
                         # val_da = self.cfg.DomainAdaptation.train_domain
@@ -527,6 +670,7 @@ class Trainer:
         self.last_opt_step = -1
         self.results = (0, 0, 0, 0, 0, 0, 0)  # P, R, mAP@.5, mAP@.5-.95, val_loss(box, obj, clss)
         self.best_fitness = 0
+        self.restore_iter_state()
 
         for self.epoch in range(self.start_epoch, self.epochs):  # epoch ------------------------------------------------------------------
             if self.epoch == self.break_epoch:
@@ -122,18 +122,15 @@ def letterbox(im, new_shape=(640, 640), color=(114, 114, 114), auto=True, scaleF
     im = cv2.copyMakeBorder(im, top, bottom, left, right, cv2.BORDER_CONSTANT, value=color)  # add border
     return im, ratio, (dw, dh)
 
-def random_perspective_keypoints(img, targets=(), segments=(), degrees=10, translate=.1, scale=.1, shear=10, 
-                                perspective=0.0, num_points=0, border=(0, 0)):
-    # torchvision.transforms.RandomAffine(degrees=(-10, 10), translate=(.1, .1), scale=(.9, 1.1), shear=(-10, 10))
-    # targets = [cls, xyxy, x0, y0, x1, y2, x2, y2, x3, y3]
-
-    height = img.shape[0] + border[0] * 2  # shape(h,w,c)
-    width = img.shape[1] + border[1] * 2
+def random_perspective_matrix(shape, degrees=10, translate=.1, scale=.1, shear=10, perspective=0.0, border=(0, 0)):
+    # Random 3x3 warp of an image of (h, w) 'shape', returns M, scale and the (w, h) output size
+    height = shape[0] + border[0] * 2  # shape(h,w,c)
+    width = shape[1] + border[1] * 2
 
     # Center
     C = np.eye(3)
-    C[0, 2] = -img.shape[1] / 2  # x translation (pixels)
-    C[1, 2] = -img.shape[0] / 2  # y translation (pixels)
+    C[0, 2] = -shape[1] / 2  # x translation (pixels)
+    C[1, 2] = -shape[0] / 2  # y translation (pixels)
 
     # Perspective
     P = np.eye(3)
@@ -160,17 +157,24 @@ def random_perspective_keypoints(img, targets=(), segments=(), degrees=10, trans
 
     # Combined rotation matrix
     M = T @ S @ R @ P @ C  # order of operations (right to left) is IMPORTANT
+    return M, s, (width, height)
+
+
+def random_perspective_keypoints(img, targets=(), segments=(), degrees=10, translate=.1, scale=.1, shear=10, 
+                                perspective=0.0, num_points=0, border=(0, 0)):
+    # torchvision.transforms.RandomAffine(degrees=(-10, 10), translate=(.1, .1), scale=(.9, 1.1), shear=(-10, 10))
+    # targets = [cls, xyxy, x0, y0, x1, y2, x2, y2, x3, y3]
+    M, s, (width, height) = random_perspective_matrix(img.shape, degrees, translate, scale, shear, perspective, border)
     if (border[0] != 0) or (border[1] != 0) or (M != np.eye(3)).any():  # image changed
         if perspective:
             img = cv2.warpPerspective(img, M, dsize=(width, height), borderValue=(114, 114, 114))
         else:  # affine
             img = cv2.warpAffine(img, M[:2], dsize=(width, height), borderValue=(114, 114, 114))
+    return img, warp_keypoint_targets(targets, segments, M, s, width, height, perspective, num_points)
 
-    # Visualize
-    # import matplotlib.pyplot as plt
-    # ax = plt.subplots(1, 2, figsize=(12, 6))[1].ravel()
-    # ax[0].imshow(img[:, :, ::-1])  # base
-    # ax[1].imshow(img2[:, :, ::-1])  # warped
+
+def warp_keypoint_targets(targets, segments, M, s, width, height, perspective=0.0, num_points=0):
+    # Apply the random_perspective_matrix() warp M to [cls, xyxy, keypoints] targets, drop degenerate boxes
     check_board = False
     # Transform label coordinates
     n = len(targets)
@@ -264,7 +268,33 @@ def random_perspective_keypoints(img, targets=(), segments=(), degrees=10, trans
         targets[:, 1:5] = new[i]
         # print('after:', targets)
 
-    return img, targets
+    return targets
+
+
+def warp_mosaic(tiles, M, size, perspective=0.0):
+    # Warp mosaic tiles straight into the (w, h) 'size' output of the canvas warp M, without building the 2s x 2s
+    # canvas. tiles are (im, x, y), an image crop and its top-left corner on the canvas. Every tile is interpolated
+    # once, into the band of output rows it covers
+    w, h = size
+    out = np.full((h, w, tiles[0][0].shape[2]), 114, dtype=np.uint8)
+    for im, x, y in tiles:
+        th, tw = im.shape[:2]
+        if not th or not tw:
+            continue
+        A = M @ np.array([[1, 0, x], [0, 1, y], [0, 0, 1]], dtype=np.float64)  # crop to output
+        corners = np.array([[0, 0, 1], [tw, 0, 1], [0, th, 1], [tw, th, 1]], dtype=np.float64) @ A.T
+        ys = corners[:, 1] / corners[:, 2] if perspective else corners[:, 1]
+        y0, y1 = max(math.floor(ys.min()), 0), min(math.ceil(ys.max()), h)
+        if y1 <= y0:  # warped out of the output
+            continue
+        A = np.array([[1, 0, 0], [0, 1, -y0], [0, 0, 1]], dtype=np.float64) @ A  # crop to output rows y0:y1
+        band = out[y0:y1]  # contiguous view, written in place
+        if perspective:
+            cv2.warpPerspective(im, A, (w, y1 - y0), dst=band, borderMode=cv2.BORDER_TRANSPARENT)
+        else:
+            cv2.warpAffine(im, A[:2], (w, y1 - y0), dst=band, borderMode=cv2.BORDER_TRANSPARENT)
+    return out
+
 
 def random_perspective(im, targets=(), segments=(), degrees=10, translate=.1, scale=.1, shear=10, perspective=0.0,
                        border=(0, 0)):
@@ -0,0 +1,212 @@
+# EfficientTeacher by Alibaba Cloud
+"""
+Batched torch implementation of the AutoAugment 'v5' detection policy of utils/autoaugment_utils.py
+
+distort_image_with_autoaugment() augments one numpy image at a time, op by op and box by box. BatchAutoAugment applies
+the same policy to a whole (n, 3, h, w) float RGB 0-255 batch on its device: every image draws its own sub-policy, its
+own fair coin per op (the numpy port ignores the listed op probabilities except as the per-box probability of the
+*_Only_BBoxes ops) and its own level sign, then each op runs once over all images that selected it. Bbox-only ops walk
+the boxes of all images in lockstep, so the boxes of one image are still applied in order. None of the v5 ops moves a
+box, targets pass through unchanged.
+
+Differences to the numpy path, besides uint8 truncation:
+    - bbox-only ops do not add 1 (mod 256) outside the box, a padding bug in _apply_bbox_augmentation()
+    - Color and Contrast use RGB grayscale weights, the numpy path gets BGR images
+Compare both paths with scripts/check_autoaugment.py
+"""
+
+import torch
+import torch.nn.functional as F
+
+from utils.autoaugment_utils import _MAX_LEVEL, policy_v5
+
+REPLACE = 128.0  # fill value of build_and_apply_nas_policy()
+
+
+def level_to_arg(name, level):
+    # (value, randomly negated) of level_to_arg() in autoaugment_utils.py for the ops of the batched policies
+    m = level / _MAX_LEVEL
+    return {'AutoContrast': (0, False),
+            'Equalize': (0, False),
+            'Solarize': (int(m * 256), False),
+            'SolarizeAdd': (int(m * 110), False),
+            'Color': (m * 1.8 + 0.1, False),
+            'Contrast': (m * 1.8 + 0.1, False),
+            'Brightness': (m * 1.8 + 0.1, False),
+            'Sharpness': (m * 1.8 + 0.1, False),
+            'Cutout': (int(m * 100), False),
+            'TranslateY_Only_BBoxes': (m * 120, True),
+            'ShearX_Only_BBoxes': (m * 0.3, True),
+            'Cutout_Only_BBoxes': (int(m * 50), False)}[name]
+
+
+def _blend(a, b, f):
+    # blend(): a + f * (b - a), clipped
+    return (a + f.view(-1, 1, 1, 1) * (b - a)).clamp(0, 255)
+
+
+def _gray(imgs):
+    return (imgs * imgs.new_tensor([0.299, 0.587, 0.114]).view(1, 3, 1, 1)).sum(1, keepdim=True)
+
+
+def color(imgs, f):
+    return _blend(_gray(imgs).round().expand_as(imgs), imgs, f)
+
+
+def contrast(imgs, f):
+    mean = _gray(imgs).mean((1, 2, 3), keepdim=True).add(0.5).floor()  # PIL ImageEnhance.Contrast
+    return _blend(mean.expand_as(imgs), imgs, f)
+
+
+def brightness(imgs, f):
+    return _blend(torch.zeros_like(imgs), imgs, f)
+
+
+def sharpness(imgs, f):
+    k = imgs.new_tensor([[1, 1, 1], [1, 5, 1], [1, 1, 1]]).div(13).view(1, 1, 3, 3).repeat(3, 1, 1, 1)
+    blurred = F.conv2d(F.pad(imgs, (1, 1, 1, 1), mode='reflect'), k, groups=3).floor()  # cv2 BORDER_REFLECT_101
+    return _blend(blurred, imgs, f)
+
+
+def solarize(imgs, threshold):
+    return torch.where(imgs < threshold.view(-1, 1, 1, 1), imgs, 255 - imgs)
+
+
+def solarize_add(imgs, addition, threshold=128):
+    return torch.where(imgs < threshold, (imgs + addition.view(-1, 1, 1, 1)).clamp(0, 255), imgs)
+
+
+def autocontrast(imgs, _):
+    # Scale each channel to 0-255, channels with a single value are left alone
+    lo, hi = imgs.amin((2, 3), keepdim=True), imgs.amax((2, 3), keepdim=True)
+    return torch.where(hi > lo, (imgs - lo) * 255 / (hi - lo).clamp(min=1e-6), imgs)
+
+
+def equalize(imgs, _):
+    # PIL Equalize per channel through 256-bin histograms of all channels at once
+    k, c, h, w = imgs.shape
+    x = imgs.floor().clamp(0, 255).long().view(k * c, -1)
+    hist = torch.zeros(k * c, 256, dtype=torch.long, device=imgs.device).scatter_add_(1, x, torch.ones_like(x))
+    last = ((hist > 0).long() * torch.arange(256, device=imgs.device)).argmax(1, keepdim=True)  # last non-zero bin
+    step = torch.div(hist.sum(1, keepdim=True) - hist.gather(1, last), 255, rounding_mode='floor')
+    lut = torch.div(hist.cumsum(1) + torch.div(step, 2, rounding_mode='floor'), step.clamp(min=1),
+                    rounding_mode='floor')
+    lut = torch.cat((torch.zeros_like(lut[:, :1]), lut[:, :-1]), 1).clamp(0, 255)
+    return torch.where(step > 0, lut.gather(1, x), x).view(k, c, h, w).float()
+
+
+def _grid(h, w, device):
+    return torch.arange(h, device=device).view(1, h, 1), torch.arange(w, device=device).view(1, 1, w)
+
+
+def cutout(imgs, pad):
+    # Fill a (2 * pad) square around a random pixel of every image
+    k, _, h, w = imgs.shape
+    ys, xs = _grid(h, w, imgs.device)
+    cy = (torch.rand(k, 1, 1, device=imgs.device) * h).long()
+    cx = (torch.rand(k, 1, 1, device=imgs.device) * w).long()
+    p = pad.long().view(-1, 1, 1)
+    m = (ys >= cy - p) & (ys < cy + p) & (xs >= cx - p) & (xs < cx + p)
+    return imgs.masked_fill(m[:, None], REPLACE)
+
+
+def box_op(imgs, regions, name, v):
+    # One op inside one pixel region (y1, x1, y2, x2 inclusive) per image, 'v' its per-image value
+    k, c, h, w = imgs.shape
+    ys, xs = _grid(h, w, imgs.device)
+    y1, x1, y2, x2 = (r.view(-1, 1, 1) for r in regions.unbind(1))
+    ch, cw = y2 - y1 + 1, x2 - x1 + 1  # content size
+    inside = (ys >= y1) & (ys <= y2) & (xs >= x1) & (xs <= x2)
+    v = v.view(-1, 1, 1)
+    if name == 'Cutout_Only_BBoxes':
+        cy = y1 + (torch.rand(k, 1, 1, device=imgs.device) * ch).long()
+        cx = x1 + (torch.rand(k, 1, 1, device=imgs.device) * cw).long()
+        p = v.long()
+        m = inside & (ys >= cy - p) & (ys < cy + p) & (xs >= cx - p) & (xs < cx + p)
+        return imgs.masked_fill(m[:, None], REPLACE)
+
+    # PIL nearest affine transform of the content, sampled at pixel centers, REPLACE where it samples outside
+    yc, xc = (ys - y1).float(), (xs - x1).float()
+    if name == 'TranslateY_Only_BBoxes':
+        sy, sx = torch.floor(yc + 0.5 + v), xc
+    else:  # ShearX_Only_BBoxes
+        sy, sx = yc, torch.floor(xc + 0.5 + v * (yc + 0.5))
+    valid = (sy >= 0) & (sy < ch) & (sx >= 0) & (sx < cw)
+    src = (torch.min(sy.clamp(min=0).long(), ch - 1) + y1) * w + torch.min(sx.clamp(min=0).long(), cw - 1) + x1
+    moved = imgs.flatten(2).gather(2, src.view(k, 1, -1).expand(-1, c, -1)).view_as(imgs)
+    moved = torch.where(valid[:, None], moved, moved.new_tensor(REPLACE))
+    return torch.where(inside[:, None], moved, imgs)
+
+
+IMAGE_OPS = {'AutoContrast': autocontrast, 'Equalize': equalize, 'Solarize': solarize, 'SolarizeAdd': solarize_add,
+             'Color': color, 'Contrast': contrast, 'Brightness': brightness, 'Sharpness': sharpness, 'Cutout': cutout}
+BBOX_OPS = ('TranslateY_Only_BBoxes', 'ShearX_Only_BBoxes', 'Cutout_Only_BBoxes')
+
+
+class BatchAutoAugment:
+    """ AutoAugment detection policy (default 'v5') over a batch, see the module docstring """
+
+    def __init__(self, policy=None):
+        self.policy = policy or policy_v5()
+        for sub in self.policy:
+            for name, _, _ in sub:
+                assert name in IMAGE_OPS or name in BBOX_OPS, f'{name} is not implemented for batches'
+
+    def __call__(self, imgs, targets, apply):
+        # Float (n, 3, h, w) RGB 0-255 images, their [image, class, xywh normalized] targets and the (n,) mask of images
+        # to augment. Returns the augmented images
+        n, device = imgs.shape[0], imgs.device
+        imgs = imgs.clone()
+        choice = torch.randint(len(self.policy), (n,), device=device)  # select_and_apply_random_policy()
+        for s in range(max(len(sub) for sub in self.policy)):
+            ops = {}  # op name: [(sub-policy, prob, level)] at slot s
+            for j, sub in enumerate(self.policy):
+                if s < len(sub):
+                    name, prob, level = sub[s]
+                    ops.setdefault(name, []).append((j, prob, level))
+            for name, entries in ops.items():
+                selected = torch.zeros(n, dtype=torch.bool, device=device)
+                v, p = torch.zeros(n, device=device), torch.zeros(n, device=device)
+                for j, prob, level in entries:
+                    m = choice == j
+                    value, negate = level_to_arg(name, level)
+                    selected |= m
+                    v[m], p[m] = float(value), prob
+                gate = selected & apply & (torch.rand(n, device=device) < 0.5)  # _apply_func_with_prob()
+                if not gate.any():
+                    continue
+                if negate:
+                    v = torch.where(torch.rand(n, device=device) < 0.5, -v, v)
+                if name in BBOX_OPS:
+                    imgs = self.bbox_only(imgs, targets, gate, p / 3, name, v)  # _scale_bbox_only_op_probability()
+                else:
+                    i = gate.nonzero(as_tuple=True)[0]
+                    imgs[i] = IMAGE_OPS[name](imgs[i], v[i])
+        return imgs
+
+    @staticmethod
+    def bbox_only(imgs, targets, gate, prob, name, v):
+        # Apply a bbox-only op to every box of the gated images with probability 'prob'. Round r handles the r-th box of
+        # each image, so boxes of one image are applied in order and see each other's results
+        if not len(targets):
+            return imgs
+        n, _, h, w = imgs.shape
+        i = targets[:, 0].long()  # targets are grouped by image after collate
+        chosen = gate[i] & (torch.rand(len(i), device=imgs.device) < prob[i])
+        if not chosen.any():
+            return imgs
+        counts = torch.bincount(i, minlength=n)
+        rank = torch.arange(len(i), device=imgs.device) - (counts.cumsum(0) - counts)[i]
+
+        # _apply_bbox_augmentation() pixel regions of the normalized boxes
+        b = targets[:, 2:6].clamp(0, 1)
+        y1, x1 = ((b[:, 1] - b[:, 3] / 2).clamp(0, 1) * h).long(), ((b[:, 0] - b[:, 2] / 2).clamp(0, 1) * w).long()
+        y2 = ((b[:, 1] + b[:, 3] / 2).clamp(0, 1) * h).long().clamp(max=h - 1)
+        x2 = ((b[:, 0] + b[:, 2] / 2).clamp(0, 1) * w).long().clamp(max=w - 1)
+        regions = torch.stack((y1, x1, torch.max(y2, y1), torch.max(x2, x1)), 1)
+        for r in range(int(rank[chosen].max()) + 1):
+            rows = chosen & (rank == r)
+            if rows.any():
+                ii = i[rows]
+                imgs[ii] = box_op(imgs[ii], regions[rows], name, v[ii])
+        return imgs
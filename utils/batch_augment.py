@@ -0,0 +1,254 @@
+# EfficientTeacher by Alibaba Cloud
+"""
+Batched tensor augmentation, applied to a collated batch on whatever device it lives on
+
+Dataloader workers only decode, resize, letterbox and compose mosaics (Dataset.batch_augment=True); random affine /
+perspective warps, HSV jitter and flips then run here on the whole (n, 3, h, w) batch at once, with the same
+parameter distributions as random_perspective(), augment_hsv() and the flips in LoadImagesAndLabels.get_item().
+Mosaics are still warped by the workers: their warp samples the whole 2 * img_size canvas, a warp of the img_size
+batch image would zoom out of a crop of it into padding. Only letterboxed images are warped here.
+Targets are the collated [image, class, xywh normalized, keypoints normalized..., extra] rows.
+
+StrongView does the same for the SSOD unlabeled stream (SSOD.device_strong_view): workers ship only the weak view and
+the strong view plus the M_s rows that map teacher boxes onto it are built on the device.
+"""
+
+import math
+
+import torch
+import torch.nn.functional as F
+
+from utils.autoaugment_batch import BatchAutoAugment
+
+
+def _uniform(n, a, b, device):
+    return a + (b - a) * torch.rand(n, device=device)
+
+
+def random_affine_matrices(n, size, degrees=10, translate=.1, scale=.1, shear=10, perspective=0.0, device='cpu'):
+    # (n, 3, 3) pixel-space random_perspective() matrices for (h, w) 'size' images and their (n,) scale factors
+    h, w = size
+    eye = torch.eye(3, device=device).repeat(n, 1, 1)
+    C, P, R, S, T = (eye.clone() for _ in range(5))
+    C[:, 0, 2], C[:, 1, 2] = -w / 2, -h / 2  # center
+    P[:, 2, 0] = _uniform(n, -perspective, perspective, device)  # x perspective (about y)
+    P[:, 2, 1] = _uniform(n, -perspective, perspective, device)  # y perspective (about x)
+    a = _uniform(n, -degrees, degrees, device) * math.pi / 180  # rotation
+    s = _uniform(n, 1 - scale, 1 + scale, device)  # scale
+    R[:, 0, 0], R[:, 0, 1] = s * torch.cos(a), s * torch.sin(a)  # cv2.getRotationMatrix2D(a, (0, 0), s)
+    R[:, 1, 0], R[:, 1, 1] = -s * torch.sin(a), s * torch.cos(a)
+    S[:, 0, 1] = torch.tan(_uniform(n, -shear, shear, device) * math.pi / 180)  # x shear
+    S[:, 1, 0] = torch.tan(_uniform(n, -shear, shear, device) * math.pi / 180)  # y shear
+    T[:, 0, 2] = _uniform(n, 0.5 - translate, 0.5 + translate, device) * w  # x translation
+    T[:, 1, 2] = _uniform(n, 0.5 - translate, 0.5 + translate, device) * h  # y translation
+    return T @ S @ R @ P @ C, s
+
+
+def _pixel_to_grid(h, w, device):
+    # Pixel coordinates to grid_sample(align_corners=False) coordinates
+    return torch.tensor([[2 / w, 0, 1 / w - 1], [0, 2 / h, 1 / h - 1], [0, 0, 1]], device=device)
+
+
+def warp_images(imgs, M, perspective=False, fill=114.0):
+    # Warp a float (n, c, h, w) batch by per-image pixel-space matrices M, like cv2.warpAffine/warpPerspective with a
+    # constant 'fill' border and bilinear interpolation
+    n, c, h, w = imgs.shape
+    N = _pixel_to_grid(h, w, imgs.device)
+    Minv = torch.inverse(M.float())  # output pixel -> input pixel
+    if perspective:
+        ys, xs = torch.meshgrid(torch.arange(h, device=imgs.device, dtype=torch.float32),
+                                torch.arange(w, device=imgs.device, dtype=torch.float32))
+        xy1 = torch.stack((xs, ys, torch.ones_like(xs)), -1).view(1, -1, 3)  # output pixels
+        src = xy1 @ (N @ Minv).transpose(1, 2)
+        grid = (src[..., :2] / src[..., 2:3]).view(n, h, w, 2)
+    else:
+        theta = (N @ Minv @ torch.inverse(N))[:, :2]
+        grid = F.affine_grid(theta, (n, c, h, w), align_corners=False)
+    return F.grid_sample(imgs - fill, grid, mode='bilinear', padding_mode='zeros', align_corners=False) + fill
+
+
+def _transform_points(M, xy, perspective=False):
+    # (k, m, 2) points through per-row (k, 3, 3) matrices
+    xy = torch.cat((xy, torch.ones_like(xy[..., :1])), -1) @ M.transpose(1, 2)
+    return xy[..., :2] / xy[..., 2:3] if perspective else xy[..., :2]
+
+
+def warp_targets(targets, M, s, size, num_points=0, perspective=False, wh_thr=2, ar_thr=20, area_thr=0.1, eps=1e-16):
+    # Warp normalized [image, class, xywh, keypoints...] targets of (h, w) 'size' images by per-image matrices M with
+    # scale factors s, dropping boxes that fail box_candidates()
+    if not len(targets):
+        return targets
+    h, w = size
+    t = targets.clone()
+    m = M[t[:, 0].long()].to(t.dtype)
+    x, y, bw, bh = t[:, 2] * w, t[:, 3] * h, t[:, 4] * w, t[:, 5] * h
+    x1, y1, x2, y2 = x - bw / 2, y - bh / 2, x + bw / 2, y + bh / 2
+    xy = _transform_points(m, torch.stack((x1, y1, x2, y2, x1, y2, x2, y1), 1).view(-1, 4, 2), perspective)
+    nx1, nx2 = xy[..., 0].min(1)[0].clamp(0, w), xy[..., 0].max(1)[0].clamp(0, w)
+    ny1, ny2 = xy[..., 1].min(1)[0].clamp(0, h), xy[..., 1].max(1)[0].clamp(0, h)
+    if num_points:
+        k = t[:, 6:6 + num_points * 2].view(-1, num_points, 2)
+        valid = k.gt(0).any(-1, keepdim=True)  # invalid keypoints are collated as 0
+        kw = _transform_points(m, k * k.new_tensor([w, h]), perspective) / k.new_tensor([w, h])
+        t[:, 6:6 + num_points * 2] = torch.where(valid, kw, k).view(-1, num_points * 2).clamp(0, 1)
+
+    # box_candidates()
+    w1, h1 = bw * s[t[:, 0].long()], bh * s[t[:, 0].long()]
+    w2, h2 = nx2 - nx1, ny2 - ny1
+    ar = torch.max(w2 / (h2 + eps), h2 / (w2 + eps))
+    keep = (w2 > wh_thr) & (h2 > wh_thr) & (w2 * h2 / (w1 * h1 + eps) > area_thr) & (ar < ar_thr)
+
+    # xyxy to xywh normalized, clipped like xyxy2xywhn(clip=True, eps=1E-3)
+    nx1, nx2 = nx1.clamp(max=w - 1E-3), nx2.clamp(max=w - 1E-3)
+    ny1, ny2 = ny1.clamp(max=h - 1E-3), ny2.clamp(max=h - 1E-3)
+    t[:, 2], t[:, 3] = (nx1 + nx2) / 2 / w, (ny1 + ny2) / 2 / h
+    t[:, 4], t[:, 5] = (nx2 - nx1) / w, (ny2 - ny1) / h
+    return t[keep]
+
+
+def rgb_to_hsv(x, eps=1e-8):
+    # (n, 3, h, w) RGB in 0-1 to HSV in 0-1
+    r, g, b = x.unbind(1)
+    v, _ = x.max(1)
+    delta = v - x.min(1)[0]
+    s = delta / (v + eps)
+    d = delta + eps
+    hue = torch.where(v == r, (g - b) / d, torch.where(v == g, 2 + (b - r) / d, 4 + (r - g) / d))
+    hue = torch.where(delta > 0, (hue / 6) % 1, torch.zeros_like(hue))
+    return torch.stack((hue, s, v), 1)
+
+
+def hsv_to_rgb(x):
+    # (n, 3, h, w) HSV in 0-1 to RGB in 0-1
+    h, s, v = x[:, 0:1], x[:, 1:2], x[:, 2:3]
+    k = (x.new_tensor([5, 3, 1]).view(1, 3, 1, 1) + h * 6) % 6
+    return v - v * s * torch.clamp(torch.min(k, 4 - k), 0, 1)
+
+
+def random_hsv(imgs, hgain=0.5, sgain=0.5, vgain=0.5):
+    # augment_hsv() on a 0-255 RGB float batch with per-image random gains
+    n = imgs.shape[0]
+    r = (torch.rand(n, 3, device=imgs.device) * 2 - 1) * imgs.new_tensor([hgain, sgain, vgain]) + 1
+    hsv = rgb_to_hsv(imgs / 255)
+    hue = (hsv[:, 0] * r[:, 0, None, None]) % 1
+    sat = (hsv[:, 1] * r[:, 1, None, None]).clamp(0, 1)
+    val = (hsv[:, 2] * r[:, 2, None, None]).clamp(0, 1)
+    return hsv_to_rgb(torch.stack((hue, sat, val), 1)) * 255
+
+
+def keypoint_flip_order(num_points):
+    # Target column order after a left-right flip, swapping mirrored keypoints like LoadImagesAndLabels.get_item()
+    cols = list(range(6 + num_points * 2))
+    pairs = {4: [(0, 1), (2, 3)], 8: [(0, 1), (2, 3), (4, 5), (6, 7)]}.get(num_points, [])
+    for a, b in pairs:
+        for j in range(2):
+            cols[6 + a * 2 + j], cols[6 + b * 2 + j] = 6 + b * 2 + j, 6 + a * 2 + j
+    return cols
+
+
+def random_flip(imgs, targets, p=0.5, dim=3, num_points=0):
+    # Flip each image along 'dim' (3 left-right, 2 up-down) with probability p, and its targets with it. Also returns
+    # the (n,) flip mask
+    flip = torch.rand(imgs.shape[0], device=imgs.device) < p
+    if not flip.any():
+        return imgs, targets, flip
+    imgs = torch.where(flip.view(-1, 1, 1, 1), imgs.flip(dim), imgs)
+    if len(targets):
+        targets = targets.clone()
+        rows = flip[targets[:, 0].long()]
+        c = 2 if dim == 3 else 3  # x or y
+        targets[rows, c] = 1 - targets[rows, c]
+        if num_points:
+            k = targets[:, 6 + c - 2:6 + num_points * 2:2]  # keypoint x or y columns
+            targets[:, 6 + c - 2:6 + num_points * 2:2] = torch.where(rows[:, None] & (k > 0), 1 - k, k)
+            if dim == 3 and num_points in (4, 8):
+                order = keypoint_flip_order(num_points) + list(range(6 + num_points * 2, targets.shape[1]))
+                targets[rows] = targets[rows][:, order]
+    return imgs, targets, flip
+
+
+def letterboxed(shapes):
+    # (n,) mask of the letterboxed images of a collated batch, the mosaics (shapes None) were warped by the workers
+    return torch.tensor([x is not None for x in shapes], dtype=torch.bool)
+
+
+class BatchAugment:
+    """ Random affine / perspective, HSV and flip augmentation of a collated batch, see the module docstring """
+
+    def __init__(self, hyp, num_points=0):
+        self.hyp = hyp
+        self.num_points = num_points
+
+    def __call__(self, imgs, targets, warp=None):
+        # uint8 or float (n, 3, h, w) 0-255 RGB batch and its targets, returns the augmented float batch and targets.
+        # warp is the (n,) mask of the images to warp, see letterboxed(), all of them with None
+        hyp = self.hyp
+        imgs = imgs.float()
+        targets = targets.to(imgs.device)
+        n, _, h, w = imgs.shape
+        warp = torch.ones(n, dtype=torch.bool) if warp is None else torch.as_tensor(warp, dtype=torch.bool).cpu()
+        if (hyp['degrees'] or hyp['translate'] or hyp['scale'] or hyp['shear'] or hyp['perspective']) and warp.any():
+            M, s = random_affine_matrices(n, (h, w), hyp['degrees'], hyp['translate'], hyp['scale'], hyp['shear'],
+                                          hyp['perspective'], device=imgs.device)
+            i = warp.nonzero().view(-1).to(imgs.device)
+            imgs = imgs.index_copy(0, i, warp_images(imgs[i], M[i], perspective=bool(hyp['perspective'])))
+            rows = warp.to(imgs.device)[targets[:, 0].long()]
+            targets = torch.cat((targets[~rows], warp_targets(targets[rows], M, s, (h, w), self.num_points,
+                                                              perspective=bool(hyp['perspective']))))
+        if hyp['hsv_h'] or hyp['hsv_s'] or hyp['hsv_v']:
+            imgs = random_hsv(imgs, hyp['hsv_h'], hyp['hsv_s'], hyp['hsv_v'])
+        imgs, targets, _ = random_flip(imgs, targets, hyp['flipud'], dim=2, num_points=self.num_points)
+        imgs, targets, _ = random_flip(imgs, targets, hyp['fliplr'], dim=3, num_points=self.num_points)
+        return imgs, targets
+
+
+class StrongView:
+    """ SSOD strong view of a weak unlabeled batch, built on the device (SSOD.device_strong_view)
+
+    Applies what LoadImagesAndFakeLabels.get_item() applies to the strong view: random_perspective_with_M(), HSV,
+    AutoAugment v5 and flips, and returns the [image, M (9), s, flipud, fliplr] rows the pseudo label creators map
+    teacher boxes with.
+    """
+
+    def __init__(self, hyp):
+        self.hyp = hyp
+        self.autoaugment = BatchAutoAugment() if hyp['autoaugment'] else None
+
+    def __call__(self, imgs, gt):
+        # Float (n, 3, h, w) 0-255 weak views and their [image, class, xywh normalized] targets, returns the strong
+        # views, the targets in strong view coordinates and the (n, 13) M_s rows
+        hyp = self.hyp
+        n, _, h, w = imgs.shape
+        M, s = random_affine_matrices(n, (h, w), hyp['degrees'], hyp['translate'], hyp['scale'], hyp['shear'],
+                                      hyp['perspective'], device=imgs.device)
+        imgs = warp_images(imgs, M, perspective=bool(hyp['perspective']))
+        if len(gt):  # ground truth is only checked against pseudo labels, keep it on the cpu
+            gt = warp_targets(gt, M.cpu(), s.cpu(), (h, w), perspective=bool(hyp['perspective']))
+        gt = gt.to(imgs.device)
+        imgs = random_hsv(imgs, hyp['hsv_h'], hyp['hsv_s'], hyp['hsv_v'])
+        if self.autoaugment is not None and len(gt):  # like the workers, only images that kept a box
+            apply = (torch.bincount(gt[:, 0].long(), minlength=n) > 0) & \
+                    (torch.rand(n, device=imgs.device) < hyp['autoaugment'])
+            imgs = self.autoaugment(imgs, gt, apply)
+        imgs, gt, ud = random_flip(imgs, gt, hyp['flipud'], dim=2)
+        imgs, gt, lr = random_flip(imgs, gt, hyp['fliplr'], dim=3)
+        i = torch.arange(n, device=imgs.device, dtype=M.dtype)
+        M_s = torch.cat((i[:, None], M.view(n, 9), s[:, None], ud[:, None].to(M), lr[:, None].to(M)), 1)
+        return imgs, gt.cpu(), M_s
+
+
+def warp_pseudo_labels(targets, M_s, size):
+    # Teacher boxes [image, class, xywh pixels, ...] on the weak views to normalized strong view boxes through the M_s
+    # rows of all images at once, like online_label_transform() and the flips in the pseudo label creators
+    h, w = size
+    M_s = M_s.detach().cpu().float()
+    t = torch.as_tensor(targets).float()
+    if not len(t):
+        return t
+    t[:, [2, 4]] /= w
+    t[:, [3, 5]] /= h
+    t = warp_targets(t, M_s[:, 1:10].view(-1, 3, 3), M_s[:, 10], (h, w))  # M_s row i is image i, see collate_fn
+    i = t[:, 0].long()
+    t[:, 3] = torch.where(M_s[i, 11] == 1, 1 - t[:, 3], t[:, 3])
+    t[:, 2] = torch.where(M_s[i, 12] == 1, 1 - t[:, 2], t[:, 2])
+    return t
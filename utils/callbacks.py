@@ -20,6 +20,7 @@ class Callbacks:
         'optimizer_step': [],
         'on_before_zero_grad': [],
         'on_train_batch_end': [],
+        'on_train_step_profile': [],  # (ni, {phase: {'mean', 'p50', 'p90', 'p99'}}) in ms, see utils/step_profiler.py
         'on_train_epoch_end': [],
 
         'on_val_start': [],
@@ -0,0 +1,134 @@
+# EfficientTeacher by Alibaba Cloud
+"""
+Background checkpoint writer
+
+Saving used to deepcopy the model and the EMA on the device, then torch.save the same checkpoint to last.pt, best.pt
+and epochN.pt from the training loop, and strip_optimizer() reloaded and re-saved last.pt and best.pt after training.
+host_snapshot() copies a checkpoint to host memory instead, modules straight to FP16 host modules without a device
+copy, so the loop only waits for the device to host copy. CheckpointWriter serializes the snapshot on a background
+thread. Every file is written to a temporary file, fsynced and renamed over the target, so a crash while writing
+keeps the previous checkpoint. The other targets of the same checkpoint are hard links to the first one (a copy where
+the file system has none). The stripped inference checkpoint of the final epoch is written in the same pass.
+
+One checkpoint is in flight at a time, save() waits for the previous one and re-raises its errors.
+"""
+
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from itertools import chain
+
+import torch
+import torch.nn as nn
+
+
+def host_snapshot(x, half=True):
+    # Copy of a checkpoint (entry) in host memory that training can not modify anymore, modules FP16 with half=True
+    if isinstance(x, nn.Module):
+        memo = {}  # parameters and buffers copied directly to the host, deepcopy copies the rest of the module
+        for t in chain(x.parameters(), x.buffers()):
+            v = t.detach().to('cpu', torch.half if half and t.is_floating_point() else t.dtype, copy=True)
+            memo[id(t)] = nn.Parameter(v, requires_grad=t.requires_grad) if isinstance(t, nn.Parameter) else v
+        return deepcopy(x, memo)
+    if isinstance(x, torch.Tensor):
+        return x.detach().to('cpu', copy=True)
+    if isinstance(x, dict):
+        return type(x)((k, host_snapshot(v, half)) for k, v in x.items())
+    if isinstance(x, (list, tuple)):
+        return type(x)(host_snapshot(v, half) for v in x)
+    return x
+
+
+def fsync_dir(path):
+    # Persist a rename in directory 'path', not supported on every platform
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def atomic_save(obj, f):
+    # torch.save to a temporary file, fsync and rename it to f
+    tmp = f.with_name(f.name + '.tmp')
+    with open(tmp, 'wb') as fh:
+        torch.save(obj, fh)
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.replace(tmp, f)
+    fsync_dir(f.parent)
+
+
+def atomic_link(src, f):
+    # f as a hard link to src (a copy if the file system has no hard links), replaced atomically
+    tmp = f.with_name(f.name + '.tmp')
+    if tmp.exists():
+        tmp.unlink()
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+        with open(tmp, 'rb+') as fh:
+            os.fsync(fh.fileno())
+    os.replace(tmp, f)
+    fsync_dir(f.parent)
+
+
+def strip_checkpoint(x):
+    # Inference checkpoint of training checkpoint x: the EMA as FP16 model without gradients, no optimizer
+    x = dict(x)
+    if x.get('ema'):
+        x['model'] = x['ema']  # replace model with ema
+    for k in 'optimizer', 'training_results', 'wandb_id', 'ema', 'updates':  # keys
+        x[k] = None
+    x['epoch'] = -1
+    x['model'].half()  # to FP16
+    for p in x['model'].parameters():
+        p.requires_grad = False
+    return x
+
+
+class CheckpointWriter:
+    """ Write host checkpoint snapshots to their files, on a background thread with background=True """
+
+    def __init__(self, background=True):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ckpt') if background else None
+        self.job = None
+        self.stripped = set()  # files written as inference checkpoints
+
+    def save(self, ckpt, files=(), stripped=(), then=None):
+        # Write snapshot ckpt to 'files' and its inference checkpoint to 'stripped', then call then()
+        self.wait()
+        files, stripped = list(files), list(stripped)
+        self.stripped.difference_update(files)
+        self.stripped.update(stripped)
+        if self.executor is None:
+            self.write(ckpt, files, stripped, then)
+        else:
+            self.job = self.executor.submit(self.write, ckpt, files, stripped, then)
+
+    def wait(self):
+        # Block until the checkpoint in flight is written
+        if self.job is not None:
+            job, self.job = self.job, None
+            job.result()
+
+    @staticmethod
+    def write(ckpt, files, stripped, then=None):
+        # Serialize each checkpoint once, link the other files to it
+        if files:
+            atomic_save(ckpt, files[0])
+            for f in files[1:]:
+                atomic_link(files[0], f)
+        if stripped:  # after the full checkpoint, stripping changes the EMA in place
+            atomic_save(strip_checkpoint(ckpt), stripped[0])
+            for f in stripped[1:]:
+                atomic_link(stripped[0], f)
+        if then is not None:
+            then()
@@ -11,7 +11,7 @@ import os
 import random
 import shutil
 import time
-from itertools import repeat
+from collections import deque
 from multiprocessing.pool import ThreadPool, Pool
 from pathlib import Path
 from threading import Thread
@@ -26,9 +26,16 @@ from PIL import Image, ExifTags
 from torch.utils.data import Dataset
 from tqdm import tqdm
 
-from utils.augmentations import Albumentations, augment_hsv, copy_paste, letterbox, mixup, random_perspective, random_perspective_keypoints
+from utils.augmentations import Albumentations, augment_hsv, copy_paste, letterbox, mixup, random_perspective, \
+    random_perspective_keypoints, random_perspective_matrix, warp_keypoint_targets, warp_mosaic
 from utils.general import check_dataset, check_requirements, check_yaml, clean_str, segments2boxes, \
     xywh2xyxy, xywhn2xyxy, xyxy2xywhn, xyn2xy, xyn2xy_new, colorstr
+from utils.datasets_shard import create_shard_dataloader, is_shard_dir
+from utils.image_cache import LRUImageCache, disk_cache, ram_cache
+from utils.image_probe import CorruptImageError, probe_image, quarantine_image, read_quarantine
+from utils.label_store import LabelStore, dir_fingerprint, file_stats, pack_labels
+from utils.manifest import is_manifest, load_manifest
+from utils.shared_batch import SharedBatchCollate
 from utils.torch_utils import torch_distributed_zero_first
 import math
 from .autoaugment_utils import distort_image_with_autoaugment
@@ -117,6 +124,97 @@ def get_hash(paths):
     return h.hexdigest()  # return hash
 
 
+def scan_labels(path, img_files, label_files, verify, make_args, old=None, scan='', ncols=5, workers=NUM_THREADS,
+                force=(), prefix=''):
+    # Verify image/label pairs into LabelStore (sections, meta). Pairs whose image and label size/mtime match an entry
+    # of the 'old' store are reused as-is, only added or changed files and images in 'force' go through
+    # verify(make_args(k)) again
+    desc = f"{prefix}Scanning '{path.parent / path.stem}' images and labels..."
+    im_stats, lb_stats = file_stats(img_files, workers), file_stats(label_files, workers)
+    reuse = old.match(img_files, label_files, im_stats, lb_stats) if old is not None else \
+        np.full(len(img_files), -1, dtype=np.int64)
+    old_corrupt = old.meta.get('corrupt', {}) if old is not None else {}
+
+    entries, todo = {}, []  # im_file -> (k, old store index or -1), duplicates collapse like the former dict cache
+    for k, im_file in enumerate(img_files):
+        if im_file in entries:
+            continue
+        c = old_corrupt.get(im_file)
+        if im_file in force:
+            reuse[k] = -1
+            todo.append(k)
+        elif reuse[k] < 0 and not (c and c[:4] == [*im_stats[k].tolist(), *lb_stats[k].tolist()]):
+            todo.append(k)
+        entries[im_file] = (k, int(reuse[k]))
+
+    results = {}
+    if todo:
+        with Pool(workers) as pool:
+            pbar = tqdm(pool.imap(verify, map(make_args, todo)), desc=desc, total=len(todo))
+            for k, r in zip(todo, pbar):
+                results[k] = r
+                pbar.desc = f'{desc}{len(results)}/{len(todo)} new or changed of {len(img_files)}'
+        pbar.close()
+        im_stats[todo] = file_stats([img_files[k] for k in todo], workers)  # corrupt JPEGs may have been re-saved
+
+    # Merge reused and re-verified entries in image order
+    nm, nf, ne, nc = 0, 0, 0, 0  # number missing, found, empty, corrupt
+    old_msgs = old.meta.get('file_msgs', {}) if old is not None else {}
+    old_labels, old_segments = (old.labels, old.segments) if old is not None else (None, None)
+    files, lb_files, labels, shapes, segments, flags, idx, file_msgs, corrupt = [], [], [], [], [], [], [], {}, {}
+    for im_file, (k, i) in entries.items():
+        if k in results:
+            _, l, shape, segs, nm_f, nf_f, ne_f, nc_f, msg = results[k]
+        elif i >= 0:
+            l, shape, segs, msg = old_labels[i], old.shapes[i], old_segments[i], old_msgs.get(im_file, '')
+            nm_f, nf_f, ne_f = (int(old.sections['flags'][i]) >> b & 1 for b in range(3))
+            nc_f = 0
+        else:
+            nm_f, nf_f, ne_f, nc_f, msg = 0, 0, 0, 1, old_corrupt[im_file][4]
+        nm, nf, ne, nc = nm + nm_f, nf + nf_f, ne + ne_f, nc + nc_f
+        if msg:
+            file_msgs[im_file] = msg
+        if nc_f:
+            corrupt[im_file] = [*im_stats[k].tolist(), *lb_stats[k].tolist(), msg]
+            continue
+        files.append(im_file)
+        lb_files.append(label_files[k])
+        labels.append(l)
+        shapes.append(shape)
+        segments.append(segs)
+        flags.append(nm_f | nf_f << 1 | ne_f << 2)
+        idx.append(k)
+    logging.info(f'{prefix}{len(todo)} new or changed of {len(entries)} images verified, '
+                 f'{nf} found, {nm} missing, {ne} empty, {nc} corrupted')
+    msgs = list(file_msgs.values())
+    if msgs and todo:
+        logging.info('\n'.join(msgs))
+
+    sections = pack_labels(files, lb_files, labels, shapes, segments, ncols=ncols)
+    sections['img_stats'] = im_stats[idx].reshape(-1, 2)  # [size, mtime_ns] for incremental re-validation
+    sections['label_stats'] = lb_stats[idx].reshape(-1, 2)
+    sections['flags'] = np.array(flags, dtype=np.uint8)  # bit 0 missing, bit 1 found, bit 2 empty
+    meta = {'fingerprint': dir_fingerprint(img_files, label_files),
+            'scan': scan,  # verify function and label width the store was built with
+            'results': [nf, nm, ne, nc, len(img_files)],
+            'msgs': msgs,  # warnings
+            'file_msgs': file_msgs,
+            'corrupt': corrupt}  # im_file -> [img size, img mtime, label size, label mtime, msg]
+    return sections, meta
+
+
+def imread_reduced(path, wh, img_size):
+    # Decode a JPEG at the largest power-of-two DCT scale (1/2, 1/4, 1/8) whose long side is still >= img_size, using
+    # the (w, h) size known from the label cache. Returns (im, scale), other formats are decoded at full resolution
+    f = 1
+    if path.lower().endswith(('.jpg', '.jpeg')):
+        while f < 8 and max(wh) / (f * 2) >= img_size:
+            f *= 2
+    flag = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4,
+            8: cv2.IMREAD_REDUCED_COLOR_8}[f]
+    return cv2.imread(path, flag), f
+
+
 def exif_size(img):
     # Returns exif-corrected PIL size
     s = img.size  # (width, height)
@@ -131,165 +229,138 @@ def exif_size(img):
 
     return s
 
-class DistributeBalancedBatchSampler(torch.utils.data.distributed.DistributedSampler):
-    def __init__(self, dataset, num_replicas, rank, balance_type='class_balance', labels=None):
-        self.labels = labels
-        self.oridata = dataset
-        self.dataset = dict()
-        self.balanced_max = 0
-        self.balance_type = balance_type
-        # Save all the indices for all the classes
-        # for idx in range(0, len(dataset)):
-        #     label = self._get_label(dataset, idx)
-        #     # print('label:', label)
-        #     if label not in self.dataset:
-        #         self.dataset[label] = list()
-        #     self.dataset[label].append(idx)
-        #     self.balanced_max = len(self.dataset[label]) \
-        #         if len(self.dataset[label]) > self.balanced_max else self.balanced_max
-        for idx in range(0, len(dataset)):
-            label_list = self._get_label(dataset, idx)
-            if label_list is not list and type(label_list) is not np.ndarray:
-                label = label_list
-                if label not in self.dataset:
-                    self.dataset[label] = list()
-                self.dataset[label].append(idx)
-                self.balanced_max = len(self.dataset[label]) \
-                    if len(self.dataset[label]) > self.balanced_max else self.balanced_max
-            else:
-                for label in label_list:
-                    if label not in self.dataset:
-                        self.dataset[label] = list()
-                    self.dataset[label].append(idx)
-                    self.balanced_max = len(self.dataset[label]) \
-                        if len(self.dataset[label]) > self.balanced_max else self.balanced_max
-        # Oversample the classes with fewer elements than the max
-        # pdb.set_trace()
-        #print('balanced_max:', self.balanced_max)
-        for label in self.dataset:
-            while len(self.dataset[label]) < self.balanced_max:
-                self.dataset[label].append(random.choice(self.dataset[label]))
-        self.keys = list(self.dataset.keys())
-        self.currentkey = 0
-        self.indices = [-1 + rank] * len(self.keys)
-        self.num_replicas = num_replicas
-        self.rank = rank
+def balance_groups(dataset, balance_type='class_balance', labels=None):
+    # (sample index, group id) pairs for the balanced samplers. With class_balance a sample belongs to every class it
+    # has labels of, with dir_balance to the first directory below the common root of all images
+    if labels is not None:  # one group id per sample given
+        groups = np.asarray(labels).reshape(-1).astype(np.int64)
+        return np.arange(len(groups)), groups
+    img = np.asarray(getattr(dataset, 'indices', range(len(dataset))), dtype=np.int64)  # image index of every sample
+    if balance_type == 'dir_balance':
+        files = dataset.img_files
+        root = os.path.commonpath([min(files), max(files)]) if len(files) > 1 else os.path.dirname(files[0])
+        keys = [f[len(root):].lstrip(os.sep).split(os.sep) for f in files]
+        _, groups = np.unique([k[0] if len(k) > 1 else '' for k in keys], return_inverse=True)
+        return np.arange(len(img)), groups[img]
+    assert balance_type == 'class_balance', f'unknown balance_type {balance_type}'
+    n = len(dataset.labels)
+    cls = dataset.labels.concat()[:, 0].astype(np.int64)
+    nk = int(cls.max()) + 1 if len(cls) else 1
+    pair = np.unique(np.repeat(np.arange(n), dataset.labels.counts()) * nk + cls)  # unique (image, class)
+    pimg, pcls = pair // nk, pair % nk
+
+    # Expand (image, class) pairs to (sample, class) pairs, images repeated by '*N' appear once per repeat
+    order = img.argsort(kind='stable')
+    cnt = np.bincount(img, minlength=n)
+    rep = cnt[pimg]
+    ramp = np.arange(rep.sum()) - np.repeat(np.cumsum(rep) - rep, rep)
+    return order[np.repeat((np.cumsum(cnt) - cnt)[pimg], rep) + ramp], np.repeat(pcls, rep)
+
+
+class BalancedBatchSampler(torch.utils.data.sampler.Sampler):
+    """ Sampler that draws one sample of every class (or directory) in turn, oversampling the smaller ones
+
+    Built from an inverted index over the packed labels: members[offsets[k]:offsets[k + 1]] are the samples of group
+    keys[k]. Every pass, each group is shuffled and filled up to balanced_max with draws with replacement, using a
+    generator seeded with seed + epoch.
+    """
+
+    def __init__(self, dataset, labels=None, balance_type='dir_balance', seed=0):
+        samples, groups = balance_groups(dataset, balance_type, labels)
+        order = groups.argsort(kind='stable')
+        self.members = samples[order]
+        counts = np.bincount(groups)
+        self.keys = np.flatnonzero(counts)  # group ids present
+        self.counts = counts[self.keys]
+        self.offsets = (np.cumsum(counts) - counts)[self.keys]
+        self.balanced_max = int(self.counts.max()) if len(self.keys) else 0
+        self.num_replicas, self.rank = 1, 0
+        self.seed = seed
         self.epoch = 0
         self.shuffle = True
-        self.seed = 0
-        self.balanced_list = range(self.balanced_max)
-        # self.num_samples = math.ceil((self.balanced_max * len(self.keys) - self.num_replicas) / self.num_replicas)
-        # self.total_size = self.num_samples * self.num_replicas
-        # print('num_samples:', self.num_samples)
-        # print('total_size:', self.total_size)
-        # print('num_replicas:', self.num_replicas)
-        # print('num_keys:', self.keys)
 
-    def __iter__(self):
-        if self.shuffle:
-           g = torch.Generator()
-           g.manual_seed(self.seed + self.epoch)
-           self.random_indices = []
-           for i in range(len(self.keys)):
-                self.random_indices.append(torch.randperm(len(self.balanced_list), generator=g).tolist()) # type: ignore
-        while self.indices[self.currentkey] < self.balanced_max - self.num_replicas:
-            self.indices[self.currentkey] += self.num_replicas
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def balanced_order(self):
+        # This rank's share of every group, interleaved round-robin over groups
+        g = np.random.default_rng(self.seed + self.epoch)  # same on every rank
+        self.epoch += 1  # InfiniteDataLoader iterates again without calling set_epoch()
+        m = self.balanced_max // self.num_replicas  # samples per group and rank
+        out = np.empty((len(self.keys), m), dtype=np.int64)
+        for k, (o, c) in enumerate(zip(self.offsets, self.counts)):
+            x = self.members[o:o + c]
             if self.shuffle:
-                yield self.dataset[self.keys[self.currentkey]][self.random_indices[self.currentkey][self.indices[self.currentkey]]]
+                x = g.permutation(np.concatenate((x, g.choice(x, self.balanced_max - c))))  # oversample
             else:
-                yield self.dataset[self.keys[self.currentkey]][self.indices[self.currentkey]]
-            self.currentkey = (self.currentkey + 1) % len(self.keys)
-        self.indices = [-1 + self.rank] * len(self.keys)
+                x = np.resize(x, self.balanced_max)
+            out[k] = x[self.rank::self.num_replicas][:m]
+        return out.T.reshape(-1)
 
-    def _get_label(self, dataset, idx, labels = None):
-        if self.labels is not None:
-            return self.labels[idx].item()
+    def __iter__(self):
+        yield from map(int, self.balanced_order())
 
-        else:
-            # Trying guessing
-            # img_id = dataset.images[idx]
-            if self.balance_type == 'dir_balance':
-                label_name = dataset.img_files[idx].split('/')[3]
-            elif self.balance_type == 'class_balance':
-                label_name = np.unique(dataset.labels[idx][:, 0])
-            # print('label_name:', label_name)
-            # file_name = dataset.coco.loadImgs(ids=[img_id])[0]['file_name']
-
-            # return re.findall('(<[^>]*>|.)', dataset.labelnames[idx])[0]
-            # print('file_name:', file_name)
-            return label_name
+    def __len__(self):
+        return self.balanced_max * len(self.keys)
+
+
+class DistributeBalancedBatchSampler(BalancedBatchSampler, torch.utils.data.distributed.DistributedSampler):
+    """ BalancedBatchSampler for DDP, every rank takes every num_replicas-th sample of each group """
+
+    def __init__(self, dataset, num_replicas, rank, balance_type='class_balance', labels=None, seed=0):
+        BalancedBatchSampler.__init__(self, dataset, labels, balance_type, seed)
+        self.oridata = dataset
+        self.num_replicas, self.rank = num_replicas, rank
 
     def __len__(self):
-        return int(len(self.oridata)/ self.num_replicas)
+        return int(len(self.oridata) / self.num_replicas)
 
-class BalancedBatchSampler(torch.utils.data.sampler.Sampler):
-    def __init__(self, dataset, labels=None):
-        self.labels = labels
-        self.dataset = dict()
-        self.balanced_max = 0
-        # Save all the indices for all the classes
-        for idx in range(0, len(dataset)):
-            label = self._get_label(dataset, idx)
-            print('label:', label)
-            if label not in self.dataset:
-                self.dataset[label] = list()
-            self.dataset[label].append(idx)
-            self.balanced_max = len(self.dataset[label]) \
-                if len(self.dataset[label]) > self.balanced_max else self.balanced_max
-
-        # Oversample the classes with fewer elements than the max
-        # pdb.set_trace()
-        print('balanced_max:', self.balanced_max)
-        for label in self.dataset:
-            while len(self.dataset[label]) < self.balanced_max:
-                self.dataset[label].append(random.choice(self.dataset[label]))
-        self.keys = list(self.dataset.keys())
-        self.currentkey = 0
-        self.indices = [-1]*len(self.keys)
-
-        self.seed = 0
-        self.balanced_list = range(self.balanced_max)
-        self.shuffle = True
-    def __iter__(self):
-        if(self.shuffle):
-          g = torch.Generator()
-          g.manual_seed(int(torch.empty((), dtype=torch.int64).random_().item()))
-          self.random_indices = []
-          for i in range(len(self.keys)):
-                self.random_indices.append(torch.randperm(len(self.balanced_list), generator=g).tolist()) # type: ignore
-        while self.indices[self.currentkey] < self.balanced_max - 1:
-             self.indices[self.currentkey] += 1
-             if self.shuffle:
-                 #g = torch.Generator()
-                 #g.manual_seed(self.seed + self.epoch)
-                 #random_indices = torch.randperm(len(self.balanced_list), generator=g).tolist()  # type: ignore
-                 #print('indices:', self.random_indices[self.currentkey][self.indices[self.currentkey]])
-                 #print('currentkey:',self.currentkey)
-                 #print('keys:',self.keys)
-                 yield self.dataset[self.keys[self.currentkey]][self.random_indices[self.currentkey][self.indices[self.currentkey]]]
-             else:
-                 #print('indices:', self.indices)
-                 #print('currentkey:',self.currentkey)
-                 #print('keys:',self.keys)
-                 yield self.dataset[self.keys[self.currentkey]][self.indices[self.currentkey]]
-             self.currentkey = (self.currentkey + 1) % len(self.keys)
-        self.indices = [-1]*len(self.keys)
-
-    def _get_label(self, dataset, idx, labels = None):
-        if self.labels is not None:
-            return self.labels[idx].item()
-        else:
-            # Trying guessing
-            # img_id = dataset.images[idx]
-            file_name = dataset.img_files[idx]
-            # file_name = dataset.coco.loadImgs(ids=[img_id])[0]['file_name']
 
-            # return re.findall('(<[^>]*>|.)', dataset.labelnames[idx])[0]
-            # print('file_name:', file_name)
-            return file_name.split('/')[3]
+class AspectRatioBatchSampler(torch.utils.data.sampler.Sampler):
+    """ Shuffled rectangular-training batch sampler
+
+    Samples are split into equal-size aspect ratio buckets, shuffled within each bucket and batched, then the batch
+    order is shuffled, with a new permutation every epoch. Yields lists of (index, (h, w)) with the letterbox shape of
+    the batch, which LoadImagesAndLabels uses instead of its static batch_shapes. Every DDP rank draws the same
+    permutation and takes every num_replicas-th batch.
+    """
+
+    def __init__(self, dataset, batch_size, num_replicas=1, rank=-1, buckets=8, pad=0.0, seed=0):
+        self.batch_size = batch_size
+        self.num_replicas, self.rank = (num_replicas, rank) if rank != -1 else (1, 0)
+        self.seed = seed
+        self.epoch = 0
+        self.img_size, self.stride, self.pad = dataset.img_size, dataset.stride, pad
+        s = np.asarray(dataset.shapes, dtype=np.float64)[np.asarray(dataset.indices)]  # wh of every sample
+        self.ar = s[:, 1] / s[:, 0]  # aspect ratio
+        order = self.ar.argsort(kind='stable')
+        self.buckets = [b for b in np.array_split(order, max(min(buckets, len(order)), 1)) if len(b)]
+        nb = sum(math.ceil(len(b) / batch_size) for b in self.buckets)  # number of batches
+        self.num_batches = math.ceil(nb / self.num_replicas)  # per rank
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        g = np.random.default_rng(self.seed + self.epoch)  # same on every rank
+        self.epoch += 1  # InfiniteDataLoader iterates again without calling set_epoch()
+        batches = []
+        for b in self.buckets:
+            b = g.permutation(b)
+            batches += [b[i:i + self.batch_size] for i in range(0, len(b), self.batch_size)]
+        batches = [batches[i] for i in g.permutation(len(batches))]
+        total = self.num_batches * self.num_replicas
+        batches = (batches * math.ceil(total / len(batches)))[:total]  # equal number of batches on every rank
+        for b in batches[self.rank::self.num_replicas]:
+            ar = self.ar[b]
+            mini, maxi = ar.min(), ar.max()
+            shape = [maxi, 1] if maxi < 1 else [1, 1 / mini] if mini > 1 else [1, 1]
+            h, w = (np.ceil(np.array(shape) * self.img_size / self.stride + self.pad).astype(int) * self.stride).tolist()
+            yield [(int(i), (h, w)) for i in b]
 
     def __len__(self):
-        return self.balanced_max*len(self.keys)
+        return self.num_batches
+
 
 def exif_transpose(image):
     """
@@ -318,7 +389,11 @@ def exif_transpose(image):
 
 
 def create_dataloader(path, imgsz, batch_size, stride, single_cls=False, hyp=None, augment=False, cache=False, pad=0.0,
-                      rect=False, rank=-1, workers=8, image_weights=False, quad=False, prefix='',cfg=None):
+                      rect=False, rank=-1, workers=8, image_weights=False, quad=False, prefix='',cfg=None, train=False):
+    # train=True: training loader, may stream tar shards and collate into a shared batch ring
+    if train and is_shard_dir(path):  # sequential tar-shard streaming, see utils/datasets_shard.py
+        return create_shard_dataloader(path, LoadImagesAndLabels, imgsz, batch_size, int(stride), single_cls, hyp,
+                                       augment, rank, WORLD_SIZE, workers, cfg, prefix)
     # Make sure only the first process in DDP process the dataset first, and the following others can use the cache
     with torch_distributed_zero_first(rank):
         dataset = LoadImagesAndLabels(path, imgsz, batch_size,
@@ -335,6 +410,7 @@ def create_dataloader(path, imgsz, batch_size, stride, single_cls=False, hyp=Non
 
     batch_size = min(batch_size, len(dataset))
     nw = min([os.cpu_count(), batch_size if batch_size > 1 else 0, workers])  # number of workers
+    batch_sampler = None
     if 'train' in prefix:
         print('world_size:', WORLD_SIZE)
         print('rank:', rank)
@@ -342,44 +418,86 @@ def create_dataloader(path, imgsz, batch_size, stride, single_cls=False, hyp=Non
             sampler = torch.utils.data.distributed.DistributedSampler(dataset) if rank != -1 else None
         elif cfg.Dataset.sampler_type=='class_balance':
             print('use banlanced batch sampler')
-            sampler = DistributeBalancedBatchSampler(dataset, WORLD_SIZE,  rank, 'class_balance') if rank != -1 else BalancedBatchSampler(dataset)
+            sampler = DistributeBalancedBatchSampler(dataset, WORLD_SIZE,  rank, 'class_balance') if rank != -1 else BalancedBatchSampler(
+                dataset, balance_type='class_balance')
         elif cfg.Dataset.sampler_type=='dir_balance':
             sampler = DistributeBalancedBatchSampler(dataset, WORLD_SIZE, rank, 'dir_balance') if rank != -1 else BalancedBatchSampler(
-                dataset)
+                dataset, balance_type='dir_balance')
+        elif cfg.Dataset.sampler_type=='aspect_ratio':  # shuffled rectangular batches, no mosaic
+            sampler = None
+            batch_sampler = AspectRatioBatchSampler(dataset, batch_size, WORLD_SIZE, rank, cfg.Dataset.ar_buckets, pad)
         else:
             assert NotImplementedError
 
     else:
         sampler = torch.utils.data.distributed.DistributedSampler(dataset) if rank != -1 else None
     #sampler = torch.utils.data.distributed.DistributedSampler(dataset) if rank != -1 else None
+    collate_fn = LoadImagesAndLabels.collate_fn4 if quad else LoadImagesAndLabels.collate_fn
+    if train and cfg.Dataset.shared_collate and not (rect or quad or batch_sampler):  # fixed size batches
+        collate_fn = SharedBatchCollate(collate_fn, {0: (3, imgsz, imgsz)}, batch_size, nw, held=cfg.Dataset.prefetch + 1,
+                                        pin=True, prefix=prefix)
     loader = torch.utils.data.DataLoader if image_weights else InfiniteDataLoader
     # Use torch.utils.data.DataLoader() if dataset.properties will update during training else InfiniteDataLoader()
     dataloader = loader(dataset,
-                        batch_size=batch_size,
+                        batch_size=1 if batch_sampler else batch_size,
                         num_workers=nw,
                         sampler=sampler,
+                        batch_sampler=batch_sampler,
                         pin_memory=True,
-                        collate_fn=LoadImagesAndLabels.collate_fn4 if quad else LoadImagesAndLabels.collate_fn)
+                        collate_fn=collate_fn)
     return dataloader, dataset
 
 
 class InfiniteDataLoader(torch.utils.data.dataloader.DataLoader):
     """ Dataloader that reuses workers
 
-    Uses same syntax as vanilla DataLoader
+    Uses same syntax as vanilla DataLoader. Counts the batches it hands out, skip() fast-forwards a new loader to such a
+    position by replaying sampler indices only, to resume mid-epoch. With a SharedBatchCollate, fetching a batch lets a
+    worker overwrite the ring slot of an earlier one, copied() registers the device copies that have to finish first
     """
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         object.__setattr__(self, 'batch_sampler', _RepeatSampler(self.batch_sampler))
-        self.iterator = super().__iter__()
+        self.iterator = None  # workers start on the first __iter__(), after a skip()
+        self.resolve = getattr(self.collate_fn, 'resolve', None)  # SharedBatchCollate slots to tensors
+        self.batches = 0  # batches handed out
+        self.remaining = None  # length of the next pass when resuming mid-epoch
+        self.copies = deque()  # (batch, CUDA event of its copy out of the shared ring) not synchronized yet
 
     def __len__(self):
         return len(self.batch_sampler.sampler)
 
+    def skip(self, batches, epoch_offset=0, first_pass=0):
+        # Continue after the first 'batches' batches, the next pass yields the len(self) - epoch_offset rest of an epoch.
+        # Pass k of the stream shuffles with sampler epoch first_pass + k
+        assert self.iterator is None, 'skip() has to be called before iterating'
+        self.batch_sampler.skip = batches
+        self.batch_sampler.first_pass = first_pass
+        self.batches = batches
+        self.remaining = len(self) - epoch_offset
+
+    def copied(self, event):
+        # The device copy of the batch handed out last completes with 'event', its ring slot is only reused after it
+        if self.resolve:
+            self.copies.append((self.batches - 1, event))
+
+    def release(self):
+        # Wait for the copies out of the slots that the batch dispatched by the next fetch can be collated into
+        last = self.batches - self.collate_fn.held * max(self.num_workers, 1)
+        while self.copies and self.copies[0][0] <= last:
+            self.copies.popleft()[1].synchronize()
+
     def __iter__(self):
-        for i in range(len(self)):
-            yield next(self.iterator)
+        if self.iterator is None:
+            self.iterator = super().__iter__()
+        n, self.remaining = len(self) if self.remaining is None else self.remaining, None
+        for i in range(n):
+            if self.resolve:
+                self.release()
+            batch = next(self.iterator)
+            self.batches += 1
+            yield self.resolve(batch) if self.resolve else batch
 
 
 class _RepeatSampler(object):
@@ -391,10 +509,21 @@ class _RepeatSampler(object):
 
     def __init__(self, sampler):
         self.sampler = sampler
+        self.skip = 0  # batches to fast-forward, see InfiniteDataLoader.skip()
+        self.first_pass = 0  # sampler epoch of the first pass
 
     def __iter__(self):
+        s = getattr(self.sampler, 'sampler', self.sampler)  # index sampler behind a BatchSampler
+        passes, skip = self.first_pass, self.skip
         while True:
-            yield from iter(self.sampler)
+            if hasattr(s, 'set_epoch'):
+                s.set_epoch(passes)  # order depends on the first pass and the position only, so a skip() replays it
+            passes += 1
+            for batch in self.sampler:
+                if skip:
+                    skip -= 1
+                    continue
+                yield batch
 
 
 class LoadImages:
@@ -636,119 +765,124 @@ def img2label_paths(img_paths):
     return [x.replace(sa, sb, 1).replace('.' + x.split('.')[-1], '.txt') for x in img_paths]
 
 
+def resolve_dataset_spec(path, prefix=''):
+    # Resolve a 'a.txt||dir*3' dataset spec into sorted unique (img_files, label_files, repeat counts, last path).
+    # Every directory is globbed and every list file read once however often it is repeated, '*N' multiplies the
+    # repeat count of its files instead of duplicating them
+    times = {}  # path -> repeat count
+    for p in path.split('||') if isinstance(path, str) else path:
+        p, n = p.split('*') if '*' in p else (p, 1)
+        p = p.strip()
+        times[p] = times.get(p, 0) + int(n)
+    try:
+        counts = {}  # image file -> repeat count
+        for p, n in times.items():
+            p = Path(p)  # os-agnostic
+            if p.is_dir():  # dir
+                f = glob.glob(str(p / '**' / '*.*'), recursive=True)
+            elif p.is_file():  # file
+                with open(p, 'r') as t:
+                    t = t.read().strip().splitlines()
+                    parent = str(p.parent) + os.sep
+                    f = [x.replace('./', parent) if x.startswith('./') else x for x in t]  # local to global path
+            else:
+                raise Exception(f'{prefix}{p} does not exist')
+            for x in f:
+                if x.split('.')[-1].lower() in IMG_FORMATS + ['txt']:
+                    x = x.replace('/', os.sep)
+                    counts[x] = counts.get(x, 0) + n
+        img_files = sorted(counts)
+        assert img_files, f'{prefix}No images found'
+    except Exception as e:
+        raise Exception(f'{prefix}Error loading data from {path}: {e}\nSee {HELP_URL}')
+    weights = np.array([counts[x] for x in img_files], dtype=np.int32)
+    if img_files[0].endswith('.txt') and len(img_files[0].split(' ')) == 2:
+        label_files = [a.split(' ')[1] for a in img_files]
+        img_files = [a.split(' ')[0] for a in img_files]
+    else:
+        label_files = img2label_paths(img_files)  # labels
+    return img_files, label_files, weights, p
+
+
+def load_dataset_spec(path, prefix=''):
+    # (img_files, label_files, repeat counts, cache location, header (w, h) shapes or None) of a compiled manifest or a
+    # dataset spec
+    if is_manifest(path):
+        img_files, label_files, weights, shapes = load_manifest(path)
+        return img_files, label_files, weights, Path(path), shapes
+    return (*resolve_dataset_spec(path, prefix), None)
+
+
+def scan_fast_arg(shapes, k):
+    # verify_image() 'fast' argument of image k with fast scanning on: its header shape from a compiled manifest, True
+    # to probe the header where the manifest has none
+    return (int(shapes[k][0]), int(shapes[k][1])) if shapes is not None and shapes[k][0] > 0 else True
+
+
+def repeat_indices(weights, img_files, dataset_files):
+    # Dataset index of every sample, images repeated by their '*N' count. 'img_files' and 'weights' are the resolved
+    # spec, 'dataset_files' the images that survived the scan. None when nothing repeats
+    if weights is None or (weights <= 1).all():
+        return None
+    w = dict(zip(img_files, weights.tolist()))
+    return np.repeat(np.arange(len(dataset_files)), [w.get(f, 1) for f in dataset_files])
+
+
 class LoadImagesAndLabels(Dataset):
     # YOLOv5 train_loader/val_loader, loads images and labels for training and validation
-    cache_version = 0.6  # dataset labels *.cache version
+    cache_version = 0.8  # dataset labels *.cache version, 0.8 = LabelStore with per-file stats
 
     def __init__(self, path, img_size=640, batch_size=16, augment=False, hyp=None, rect=False, image_weights=False,
                  cache_images=False, single_cls=False, stride=32, pad=0.0, cfg=None, prefix=''):
-        self.img_size = img_size
-        self.augment = augment
-        self.hyp = hyp
-        self.image_weights = image_weights
-        self.rect = False if image_weights else rect
-        self.mosaic = self.augment and not self.rect  # load 4 images at a time into a mosaic (only during training)
-        self.mosaic_border = [-img_size // 2, -img_size // 2]
-        self.stride = stride
+        self.set_options(img_size, augment, hyp, rect, image_weights, stride, cfg)
         self.path = path
-        self.albumentations = Albumentations() if augment else None
-        self.debug = False
-        self.with_id = False
-        self.pseudo_ids = False
-        if cfg:
-            self.num_points = cfg.Dataset.np
-            if cfg.Dataset.num_ids > 0:
-                self.with_id = True
-            self.pseudo_ids = cfg.Dataset.pseudo_ids
-            self.cfg = cfg
-            self.debug = cfg.Dataset.debug
-            self.nc = cfg.Dataset.nc
-            self.include_class = cfg.Dataset.include_class
-        else:
-            self.num_points = 0
-            self.nc = None
-            self.include_class = []
-        newpath = []
-        path = path.split('||')
-        for p in path:
-            if '*' in p:
-                dirpath,times = p.split('*')
-                for t in range(int(times)):
-                    newpath.append(dirpath)
-            else:
-                newpath.append(p)
-        path = newpath
-        try:
-            f = []  # image files
-            for p in path if isinstance(path, list) else [path]:
-                p = p.strip()
-                p = Path(p)  # os-agnostic
-                if p.is_dir():  # dir
-                    f += glob.glob(str(p / '**' / '*.*'), recursive=True)
-                    # f = list(p.rglob('**/*.*'))  # pathlib
-                elif p.is_file():  # file
-                    with open(p, 'r') as t:
-                        t = t.read().strip().splitlines()
-                        parent = str(p.parent) + os.sep
-                        f += [x.replace('./', parent) if x.startswith('./') else x for x in t]  # local to global path
-                        # f += [p.parent / x.lstrip(os.sep) for x in t]  # local to global path (pathlib)
-                else:
-                    raise Exception(f'{prefix}{p} does not exist')
-            # print(len(f),"******")
-            self.img_files = sorted([x.replace('/', os.sep) for x in f if x.split('.')[-1].lower() in IMG_FORMATS+['txt']])
-            # self.img_files = f
-            # self.img_files = sorted([x for x in f if x.suffix[1:].lower() in img_formats])  # pathlib
-            # assert self.img_files, f'{prefix}No images found'
-        except Exception as e:
-            raise Exception(f'{prefix}Error loading data from {path}: {e}\nSee {HELP_URL}')
-        if self.img_files[0].endswith('.txt') and len(self.img_files[0].split(' ')) == 2:
-            self.label_files = [a.split(' ')[1] for a in self.img_files]
-            self.img_files = [a.split(' ')[0] for a in self.img_files]
-
-        else:
-            # self.label_files = img2label_paths(self.hyp.image_dir, self.hyp.label_dir, self.img_files)  # labels
-            self.label_files = img2label_paths(self.img_files)  # labels
+        self.img_files, self.label_files, weights, p, self.manifest_shapes = load_dataset_spec(path, prefix)
+        spec_files = self.img_files
         # Check cache
         # self.label_files = img2label_paths(self.img_files)  # labels
         # print(self.img_files, "|", self.label_files)
         cache_path = (p if p.is_file() else Path(self.label_files[0]).parent).with_suffix('.cache')
         try:
-            cache, exists = np.load(cache_path, allow_pickle=True).item(), True  # load dict
-            if cfg and cfg.check_datacache:
-                assert cache['version'] == self.cache_version  # same version
-                assert cache['hash'] == get_hash(self.label_files + self.img_files)  # same hash
+            store = LabelStore.open(cache_path)  # memory-mapped packed labels
+            assert store.meta['version'] == self.cache_version  # same version
+            assert store.meta['scan'] == self.scan_key()  # same verify function and label width
         except:
-            cache, exists = self.cache_labels(cache_path, prefix), False  # cache
+            store = None
+        self.quarantine_path = cache_path.with_suffix('.quarantine')  # corrupt images found by load_image()
+        if store is not None and store.meta['fingerprint'] == dir_fingerprint(self.img_files, self.label_files) and \
+                not (cfg and cfg.check_datacache) and not self.quarantine_path.exists():
+            exists = True  # no file added, removed or renamed, trust the cache without stat-ing every file
+        else:
+            store, exists = self.cache_labels(cache_path, prefix, old=store), False  # incremental re-validation
 
         # Display cache
-        nf, nm, ne, nc, n = cache.pop('results')  # found, missing, empty, corrupted, total
+        nf, nm, ne, nc, n = store.meta['results']  # found, missing, empty, corrupted, total
         if exists:
             d = f"Scanning '{cache_path}' images and labels... {nf} found, {nm} missing, {ne} empty, {nc} corrupted"
             tqdm(None, desc=prefix + d, total=n, initial=n)  # display cache results
-            if cache['msgs']:
-                logging.info('\n'.join(cache['msgs']))  # display warnings
+            if store.meta['msgs']:
+                logging.info('\n'.join(store.meta['msgs']))  # display warnings
         assert nf > 0 or not augment, f'{prefix}No labels in {cache_path}. Can not train without labels. See {HELP_URL}'
 
-        # Read cache
-        [cache.pop(k) for k in ('hash', 'version', 'msgs')]  # remove items
-        labels, shapes, self.segments = zip(*cache.values())
-        self.labels = list(labels)
+        # Read cache, every per-image field is a read-only view into the packed store
+        self.labels, self.segments = store.labels, store.segments
         #id逻辑与points逻辑分离开
         if self.with_id:
-            self.ids = [l[:,5] for l in self.labels]
-            self.labels = [l[:,:5] for l in self.labels]
+            self.ids = self.labels.columns(5)
+            self.labels = self.labels.columns(slice(0, 5))
         else:
             if self.num_points==0:
-                self.labels = [l[:,:5] for l in self.labels]
-        self.shapes = np.array(shapes, dtype=np.float64)
-        self.img_files = list(cache.keys())  # update
-        self.label_files = img2label_paths(cache.keys())  # update
-        n = len(shapes)  # number of images
+                self.labels = self.labels.columns(slice(0, 5))
+        self.shapes = store.shapes
+        self.img_files = store.img_files  # update
+        self.label_files = store.label_files  # update
+        n = len(self.shapes)  # number of images
         bi = np.floor(np.arange(n) / batch_size).astype(np.int)  # batch index
         nb = bi[-1] + 1  # number of batches
         self.batch = bi  # batch index of image
         self.n = n
         self.indices = range(n)
+        self.quarantined = set()  # indices found corrupt by load_image() in this process
 
         # Update labels
         # include_class = []  # filter labels to include only these classes (optional)
@@ -758,10 +892,7 @@ class LoadImagesAndLabels(Dataset):
             # self.segments[i][:, 0] = 0
         #计算标注数据集中的各类别的分布
         if self.nc:
-            cls_tmp = np.zeros(self.nc)
-            for label in self.labels:
-                for l in label:
-                    cls_tmp[int(l[0:1])] += 1
+            cls_tmp = np.bincount(self.labels.concat()[:, 0].astype(int), minlength=self.nc)[:self.nc].astype(float)
             self.cls_ratio_gt = cls_tmp/np.sum(cls_tmp)
             self.label_num_per_image = np.sum(cls_tmp) / len(self.img_files)
             info = ' '.join([f'({v:.2f}-{i})' for i, v in enumerate(cls_tmp)])
@@ -774,11 +905,11 @@ class LoadImagesAndLabels(Dataset):
             s = self.shapes  # wh
             ar = s[:, 1] / s[:, 0]  # aspect ratio
             irect = ar.argsort()
-            self.img_files = [self.img_files[i] for i in irect]
-            self.label_files = [self.label_files[i] for i in irect]
-            self.labels = [self.labels[i] for i in irect]
+            self.img_files = self.img_files.take(irect)
+            self.label_files = self.label_files.take(irect)
+            self.labels = self.labels.take(irect)
             if self.with_id:
-                self.ids = [self.ids[i] for i in irect]
+                self.ids = self.ids.take(irect)
             self.shapes = s[irect]  # wh
             ar = ar[irect]
 
@@ -794,103 +925,138 @@ class LoadImagesAndLabels(Dataset):
 
             self.batch_shapes = np.ceil(np.array(shapes) * img_size / stride + pad).astype(np.int) * stride
 
+        # '*N' repeats are sampling weights over unique images, rectangular batches see every image once
+        repeats = None if self.rect else repeat_indices(weights, spec_files, self.img_files)
+        if repeats is not None:
+            self.indices = repeats
+            logging.info(f'{prefix}{n} images sampled {len(repeats)} times per epoch with repeats')
+        del spec_files
+
         # Cache images into memory for faster training (WARNING: large datasets may exceed system RAM)
-        self.imgs, self.img_npy = [None] * n, [None] * n
+        self.imgs = [None] * n
         if cache_images:
-            if cache_images == 'disk':
-                self.im_cache_dir = Path(Path(self.img_files[0]).parent.as_posix() + '_npy')
-                self.img_npy = [self.im_cache_dir / Path(f).with_suffix('.npy').name for f in self.img_files]
-                self.im_cache_dir.mkdir(parents=True, exist_ok=True)
-                print('self im cache dir:', self.im_cache_dir)
-            gb = 0  # Gigabytes of cached images
-            self.img_hw0, self.img_hw = [None] * n, [None] * n
-            results = ThreadPool(NUM_THREADS).imap(lambda x: load_image(*x), zip(repeat(self), range(n)))
-            pbar = tqdm(enumerate(results), total=n)
-            for i, x in pbar:
-                if cache_images == 'disk':
-                    if not self.img_npy[i].exists():
-                        np.save(self.img_npy[i].as_posix(), x[0])
-                    gb += self.img_npy[i].stat().st_size
-                else:
-                    self.imgs[i], self.img_hw0[i], self.img_hw[i] = x  # im, hw_orig, hw_resized = load_image(self, i)
-                    gb += self.imgs[i].nbytes
-                pbar.desc = f'{prefix}Caching images ({gb / 1E9:.1f}GB {cache_images})'
-            pbar.close()
+            if cache_images == 'disk':  # one packed file next to the label cache instead of one .npy per image
+                try:
+                    self.imgs = disk_cache(cache_path.with_suffix('.images'), self.img_files, self.shapes, img_size,
+                                           store.meta['fingerprint'], lambda i: load_image(self, i),
+                                           threads=NUM_THREADS, tag=self.reduced_decode, prefix=prefix)
+                except OSError as e:
+                    logging.info(f'{prefix}WARNING: Cache directory {cache_path.parent} is not writeable: {e}')
+            else:  # one shared-memory copy per node, read zero-copy by all ranks and workers
+                self.imgs = ram_cache(self.img_files, self.shapes, img_size, lambda i: load_image(self, i),
+                                      threads=NUM_THREADS, tag=self.reduced_decode, prefix=prefix)
+            if not isinstance(self.imgs, list):
+                self.img_hw0, self.img_hw = self.imgs.hw0, self.imgs.hw
+        elif self.lru_cache_mb > 0:  # bounded cache of recently decoded images, one per dataloader worker
+            self.lru = LRUImageCache(self.lru_cache_mb, prefix=prefix)
+
+    def set_options(self, img_size=640, augment=False, hyp=None, rect=False, image_weights=False, stride=32, cfg=None):
+        # Loading and augmentation options, shared with the streaming backend in utils/datasets_shard.py
+        self.img_size = img_size
+        self.augment = augment
+        self.hyp = hyp
+        self.image_weights = image_weights
+        self.rect = False if image_weights else rect
+        self.mosaic = self.augment and not self.rect  # load 4 images at a time into a mosaic (only during training)
+        self.mosaic_border = [-img_size // 2, -img_size // 2]
+        self.stride = stride
+        self.albumentations = Albumentations() if augment else None
+        self.debug = False
+        self.with_id = False
+        self.pseudo_ids = False
+        if cfg:
+            self.num_points = cfg.Dataset.np
+            if cfg.Dataset.num_ids > 0:
+                self.with_id = True
+            self.pseudo_ids = cfg.Dataset.pseudo_ids
+            self.cfg = cfg
+            self.debug = cfg.Dataset.debug
+            self.fast_scan = cfg.Dataset.fast_scan
+            self.reduced_decode = cfg.Dataset.reduced_decode
+            self.lru_cache_mb = cfg.Dataset.lru_cache_mb
+            self.lru_mosaic_bias = cfg.Dataset.lru_mosaic_bias
+            self.fused_mosaic = cfg.Dataset.fused_mosaic
+            self.batch_augment = cfg.Dataset.batch_augment
+            self.nc = cfg.Dataset.nc
+            self.include_class = cfg.Dataset.include_class
+        else:
+            self.num_points = 0
+            self.nc = None
+            self.include_class = []
+            self.fast_scan = False
+            self.reduced_decode = False
+            self.lru_cache_mb = 0
+            self.lru_mosaic_bias = 0.0
+            self.fused_mosaic = False
+            self.batch_augment = False
+        self.lru = None
 
     def filter_include_class(self, single_cls):
-        include_class_array = np.array(self.include_class).reshape(1, -1)
-        if self.with_id:
-            for i, (label, segment, ids) in enumerate(zip(self.labels, self.segments, self.ids)):
-                if self.include_class:
-                    j = (label[:, 0:1] == include_class_array).any(1)
-                    self.labels[i] = label[j]
-                    self.ids[i] = ids[j]
-                    #if segment:
-                    #    self.segments[i] = segment[j]
-                if single_cls:  # single-class training, merge all classes into 0
-                    self.labels[i][:, 0] = 0
-        else:
-            for i, (label, segment) in enumerate(zip(self.labels, self.segments)):
-                if self.include_class:
-                    j = (label[:, 0:1] == include_class_array).any(1)
-                    self.labels[i] = label[j]
-                    #if segment:
-                    #    self.segments[i] = segment[j]
-                if single_cls:  # single-class training, merge all classes into 0
-                    self.labels[i][:, 0] = 0
-
-    def cache_labels(self, path=Path('./labels.cache'), prefix=''):
-        # Cache dataset labels, check images and read shapes
-        x = {}  # dict
-        nm, nf, ne, nc, msgs = 0, 0, 0, 0, []  # number missing, found, empty, corrupt, messages
-        desc = f"{prefix}Scanning '{path.parent / path.stem}' images and labels..."
+        # Filter the packed labels (and ids) with one vectorized row mask instead of a per-image loop
+        if self.include_class:
+            keep = np.isin(self.labels.data[:, 0], self.include_class)
+            self.labels = self.labels.filter_rows(keep)
+            if self.with_id:
+                self.ids = self.ids.filter_rows(keep)
+        if single_cls:  # single-class training, merge all classes into 0
+            self.labels = self.labels.replace(fill_cls=0)
+
+    def scan_key(self):
+        # Identifies the verify function and label width a cache was built with
+        return f"{'verify_image_label_with_id' if self.with_id else 'verify_image_label'}:{5 + self.num_points * 2}" + \
+            (':fast' if self.fast_scan else '')
+
+    def cache_labels(self, path=Path('./labels.cache'), prefix='', old=None):
+        # Cache dataset labels, check images and read shapes. Unchanged entries of the 'old' store are reused,
+        # quarantined images are fully verified again
+        quarantined = read_quarantine(self.quarantine_path)
+        fast = lambda k: self.fast_scan and self.img_files[k] not in quarantined and \
+            scan_fast_arg(self.manifest_shapes, k)
         if self.with_id:
+            old = None  # track ids are numbered across all label files, any change renumbers them
             id_list = cal_cur_max_id(self.label_files, self.pseudo_ids)
             print('number of label files:', len(self.label_files))
             print('id_index:', len(id_list))
-        with Pool(NUM_THREADS) as pool:
-            if self.with_id:
-                pbar = tqdm(pool.imap(verify_image_label_with_id, zip(self.img_files, self.label_files, id_list, repeat(prefix))),
-                            desc=desc, total=len(self.img_files))
-            else:
-                pbar = tqdm(pool.imap(verify_image_label, zip(self.img_files, self.label_files, repeat(prefix), repeat(self.num_points))),
-                            desc=desc, total=len(self.img_files))
-            for im_file, l, shape, segments, nm_f, nf_f, ne_f, nc_f, msg in pbar:
-                nm += nm_f
-                nf += nf_f
-                ne += ne_f
-                nc += nc_f
-                if im_file:
-                    x[im_file] = [l, shape, segments]
-                if msg:
-                    msgs.append(msg)
-                pbar.desc = f"{desc}{nf} found, {nm} missing, {ne} empty, {nc} corrupted"
-
-        pbar.close()
-        if msgs:
-            logging.info('\n'.join(msgs))
-        if nf == 0:
+            verify, make_args = verify_image_label_with_id, \
+                lambda k: (self.img_files[k], self.label_files[k], id_list[k], prefix, fast(k))
+        else:
+            verify, make_args = verify_image_label, \
+                lambda k: (self.img_files[k], self.label_files[k], prefix, self.num_points, fast(k))
+        ncols = 6 if self.with_id else 5 + self.num_points * 2
+        sections, meta = scan_labels(path, self.img_files, self.label_files, verify, make_args, old=old,
+                                     scan=self.scan_key(), ncols=ncols, force=quarantined, prefix=prefix)
+        meta['version'] = self.cache_version  # cache version
+        if meta['results'][0] == 0:
             logging.info(f'{prefix}WARNING: No labels found in {path}. See {HELP_URL}')
-        x['hash'] = get_hash(self.label_files + self.img_files)
-        x['results'] = nf, nm, ne, nc, len(self.img_files)
-        x['msgs'] = msgs  # warnings
-        x['version'] = self.cache_version  # cache version
         try:
-            np.save(path, x)  # save cache for next time
-            path.with_suffix('.cache.npy').rename(path)  # remove .npy suffix
+            LabelStore(sections, meta).save(path)  # save cache for next time
             logging.info(f'{prefix}New cache created: {path}')
+            if quarantined:
+                self.quarantine_path.unlink()  # re-verified into the new cache
+            return LabelStore.open(path)  # memory-mapped, shared between ranks and workers
         except Exception as e:
             logging.info(f'{prefix}WARNING: Cache directory {path.parent} is not writeable: {e}')  # path not writeable
-        return x
+        return LabelStore(sections, meta)
 
     def __len__(self):
-        return len(self.img_files)
+        return len(self.indices)  # images, counting '*N' repeats
 
     def __getitem__(self, index):
+        # Corrupt images found at load time are quarantined and the sample is replaced by a random other one. An
+        # (index, (h, w)) pair from AspectRatioBatchSampler is letterboxed to the (h, w) of its batch
+        index, shape = index if isinstance(index, tuple) else (index, None)
+        for _ in range(10):
+            try:
+                return self.get_item(index, shape)
+            except CorruptImageError:
+                index = random.randint(0, self.n - 1)
+        return self.get_item(index, shape)
+
+    def get_item(self, index, shape=None):
         index = self.indices[index]  # linear, shuffled, or image_weights
 
         hyp = self.hyp
-        mosaic = self.mosaic and random.random() < hyp.mosaic
+        mosaic = shape is None and self.mosaic and random.random() < hyp.mosaic  # mosaics are square
         # mosaic = False
         if mosaic:
             # Load mosaic
@@ -906,7 +1072,8 @@ class LoadImagesAndLabels(Dataset):
             img, (h0, w0), (h, w) = load_image(self, index)
 
             # Letterbox
-            shape = self.batch_shapes[self.batch[index]] if self.rect else self.img_size  # final letterboxed shape
+            if shape is None:
+                shape = self.batch_shapes[self.batch[index]] if self.rect else self.img_size  # final letterboxed shape
             img, ratio, pad = letterbox(img, shape, auto=False, scaleup=self.augment)
             shapes = (h0, w0), ((h / h0, w / w0), pad)  # for COCO mAP rescaling
 
@@ -941,7 +1108,7 @@ class LoadImagesAndLabels(Dataset):
                     elif labels.shape[-1] == 5 and self.num_points == 0:
                         labels[:, 1:5] = xywhn2xyxy(labels[:, 1:5], ratio[0] * w, ratio[1] * h, padw=pad[0], padh=pad[1])
             
-            if self.augment:
+            if self.augment and not self.batch_augment:  # batch_augment warps the collated batch instead
             # Augment imagespace
             # if not mosaic:
                 img, labels = random_perspective_keypoints(img, labels,
@@ -974,10 +1141,11 @@ class LoadImagesAndLabels(Dataset):
             nl = len(labels)  # update after albumentations
 
             # HSV color-space
-            augment_hsv(img, hgain=hyp['hsv_h'], sgain=hyp['hsv_s'], vgain=hyp['hsv_v'])
+            if not self.batch_augment:
+                augment_hsv(img, hgain=hyp['hsv_h'], sgain=hyp['hsv_s'], vgain=hyp['hsv_v'])
 
             # Flip up-down
-            if random.random() < hyp['flipud']:
+            if not self.batch_augment and random.random() < hyp['flipud']:
                 img = np.flipud(img)
                 if nl:
                     labels[:, 2] = 1 - labels[:, 2]
@@ -986,7 +1154,7 @@ class LoadImagesAndLabels(Dataset):
                             labels[:, n] = 1 - labels[:, n]
 
             # Flip left-right
-            if random.random() < hyp['fliplr']:
+            if not self.batch_augment and random.random() < hyp['fliplr']:
                 img = np.fliplr(img)
                 if nl:
                     labels[:, 1] = 1 - labels[:, 1]
@@ -1198,38 +1366,67 @@ class LoadImagesAndLabels(Dataset):
 def load_image(self, i):
     # loads 1 image from dataset index 'i', returns im, original hw, resized hw
     im = self.imgs[i]
-    if im is None:  # not cached in ram
-        npy = self.img_npy[i]
-        if npy and npy.exists():  # load npy
-            im = np.load(npy)
-        else:  # read image
-            path = self.img_files[i]
-            im = cv2.imread(path)  # BGR
-            assert im is not None, 'Image Not Found ' + path
+    if im is None:  # not cached
+        x = self.lru.get(i) if self.lru is not None else None  # recently decoded by this worker
+        if x is not None:
+            return x
+        path = self.img_files[i]
+        if i in self.quarantined:
+            raise CorruptImageError(path)
+        w, h = (int(x) for x in self.shapes[i])  # scanned size
+        im, f = imread_reduced(path, (w, h), self.img_size) if self.reduced_decode else (cv2.imread(path), 1)  # BGR
+        if im is None or sorted(im.shape[:2]) != sorted((-(-h // f), -(-w // f))):  # header-only scan missed it
+            self.quarantined.add(i)
+            quarantine_image(self.quarantine_path, path, 'decode failed' if im is None else
+                             f'decoded shape {im.shape[:2]} != scanned shape {(h, w)} / {f}')
+            raise CorruptImageError(path)
         h0, w0 = im.shape[:2]  # orig hw
+        if f > 1:  # decoded at 1/f scale, the original size comes from the label cache
+            h0, w0 = (h, w) if h0 == -(-h // f) else (w, h)
         r = self.img_size / max(h0, w0)  # ratio
         if r != 1:  # if sizes are not equal
             # im = cv2.resize(im, (int(w0 * r), int(h0 * r)), interpolation=cv2.INTER_NEAREST)
             im = cv2.resize(im, (int(w0 * r), int(h0 * r)), interpolation=cv2.INTER_LINEAR)
+        if self.lru is not None:
+            self.lru.put(i, (im, (h0, w0), im.shape[:2]))
         return im, (h0, w0), im.shape[:2]  # im, hw_original, hw_resized
     else:
         return self.imgs[i], self.img_hw0[i], self.img_hw[i]  # im, hw_original, hw_resized
 
 
+def mosaic_warp_hyp(self):
+    # random_perspective() arguments for a mosaic. Also with Dataset.batch_augment, which warps letterboxed images only:
+    # the warp has to sample the whole 2s canvas, a scale < 1 on an img_size crop of it would zoom out into padding
+    hyp = self.hyp
+    return dict(degrees=hyp.degrees, translate=hyp.translate, scale=hyp.scale, shear=hyp.shear,
+                perspective=hyp.perspective)
+
+
+def mosaic_partners(self, k):
+    # k random partner image indices for a mosaic, each drawn from the images in the worker's LRU cache with
+    # probability Dataset.lru_mosaic_bias
+    if self.lru is None or not self.lru_mosaic_bias or not len(self.lru):
+        return random.choices(self.indices, k=k)
+    return [self.lru.random_key() if random.random() < self.lru_mosaic_bias else random.choice(self.indices)
+            for _ in range(k)]
+
+
 def load_mosaic(self, index, num_points):
     # YOLOv5 4-mosaic loader. Loads 1 image + 3 random images into a 4-image mosaic
     labels4, segments4 = [], []
     s = self.img_size
     yc, xc = [int(random.uniform(-x, 2 * s + x)) for x in self.mosaic_border]  # mosaic center x, y
-    indices = [index] + random.choices(self.indices, k=3)  # 3 additional image indices
+    indices = [index] + mosaic_partners(self, 3)  # 3 additional image indices
     random.shuffle(indices)
+    fused = self.fused_mosaic and not self.hyp.copy_paste  # copy_paste needs the full canvas
+    tiles = []  # (crop, x, y) on the canvas for the fused warp
     for i, index in enumerate(indices):
         # Load image
         img, _, (h, w) = load_image(self, index)
 
         # place img in img4
         if i == 0:  # top left
-            img4 = np.full((s * 2, s * 2, img.shape[2]), 114, dtype=np.uint8)  # base image with 4 tiles
+            img4 = None if fused else np.full((s * 2, s * 2, img.shape[2]), 114, dtype=np.uint8)  # base image with 4 tiles
             x1a, y1a, x2a, y2a = max(xc - w, 0), max(yc - h, 0), xc, yc  # xmin, ymin, xmax, ymax (large image)
             x1b, y1b, x2b, y2b = w - (x2a - x1a), h - (y2a - y1a), w, h  # xmin, ymin, xmax, ymax (small image)
         elif i == 1:  # top right
@@ -1242,7 +1439,10 @@ def load_mosaic(self, index, num_points):
             x1a, y1a, x2a, y2a = xc, yc, min(xc + w, s * 2), min(s * 2, yc + h)
             x1b, y1b, x2b, y2b = 0, 0, min(w, x2a - x1a), min(y2a - y1a, h)
 
-        img4[y1a:y2a, x1a:x2a] = img[y1b:y2b, x1b:x2b]  # img4[ymin:ymax, xmin:xmax]
+        if fused:
+            tiles.append((img[y1b:y2b, x1b:x2b], x1a, y1a))
+        else:
+            img4[y1a:y2a, x1a:x2a] = img[y1b:y2b, x1b:x2b]  # img4[ymin:ymax, xmin:xmax]
         padw = x1a - x1b
         padh = y1a - y1b
 
@@ -1297,13 +1497,14 @@ def load_mosaic(self, index, num_points):
     # print('labels4:', labels4)
 
     # Augment
+    warp = mosaic_warp_hyp(self)
+    if fused:  # one interpolation per tile straight into the img_size output
+        M, sc, size = random_perspective_matrix((s * 2, s * 2), **warp, border=self.mosaic_border)
+        img4 = warp_mosaic(tiles, M, size, warp['perspective'])
+        labels4 = warp_keypoint_targets(labels4, segments4, M, sc, *size, warp['perspective'], num_points)
+        return img4, labels4
     img4, labels4, segments4 = copy_paste(img4, labels4, segments4, p=self.hyp.copy_paste)
-    img4, labels4 = random_perspective_keypoints(img4, labels4, segments4,
-                                       degrees=self.hyp.degrees,
-                                       translate=self.hyp.translate,
-                                       scale=self.hyp.scale,
-                                       shear=self.hyp.shear,
-                                       perspective=self.hyp.perspective,
+    img4, labels4 = random_perspective_keypoints(img4, labels4, segments4, **warp,
                                        num_points=num_points,
                                        border=self.mosaic_border)  # border to remove
     # print('labels4:', labels4)
@@ -1315,7 +1516,7 @@ def load_mosaic9(self, index):
     # YOLOv5 9-mosaic loader. Loads 1 image + 8 random images into a 9-image mosaic
     labels9, segments9 = [], []
     s = self.img_size
-    indices = [index] + random.choices(self.indices, k=8)  # 8 additional image indices
+    indices = [index] + mosaic_partners(self, 8)  # 8 additional image indices
     random.shuffle(indices)
     for i, index in enumerate(indices):
         # Load image
@@ -1374,12 +1575,7 @@ def load_mosaic9(self, index):
     # img9, labels9 = replicate(img9, labels9)  # replicate
 
     # Augment
-    img9, labels9 = random_perspective_keypoints(img9, labels9, segments9,
-                                       degrees=self.hyp.degrees,
-                                       translate=self.hyp.translate,
-                                       scale=self.hyp.scale,
-                                       shear=self.hyp.shear,
-                                       perspective=self.hyp.perspective,
+    img9, labels9 = random_perspective_keypoints(img9, labels9, segments9, **mosaic_warp_hyp(self),
                                        num_points=self.num_points,
                                        border=self.mosaic_border)  # border to remove
 
@@ -1495,25 +1691,42 @@ def cal_cur_max_id(lb_files, pseudo_labels=False):
             id_list.append([-1])
     return id_list 
 
+def verify_image(im_file, prefix='', fast=False):
+    # Verify one image, returns exif-corrected (w, h) and a warning message. fast=True only parses JPEG/PNG/BMP headers,
+    # fast=(w, h) takes the header shape compile-manifest probed, the full decode is deferred to load_image() which
+    # quarantines corrupt files
+    msg = ''
+    if isinstance(fast, tuple):
+        probed = 'manifest', fast
+    else:
+        probed = probe_image(im_file) if fast else None
+    if probed is not None:
+        fmt, shape = probed
+        assert (shape[0] > 9) & (shape[1] > 9), f'image size {shape} <10 pixels'
+        return shape, msg
+    im = Image.open(im_file)
+    im.verify()  # PIL verify
+    shape = exif_size(im)  # image size
+    assert (shape[0] > 9) & (shape[1] > 9), f'image size {shape} <10 pixels'
+    assert im.format.lower() in IMG_FORMATS, f'invalid image format {im.format}'
+    if im.format.lower() in ('jpg', 'jpeg'):
+        with open(im_file, 'rb') as f:
+            f.seek(-2, 2)
+            if f.read() != b'\xff\xd9':  # corrupt JPEG
+                Image.open(im_file).save(im_file, format='JPEG', subsampling=0, quality=100)  # re-save image
+                msg = f'{prefix}WARNING: {im_file}: corrupt JPEG restored and saved'
+    return shape, msg
+
+
 def verify_image_label_with_id(args):
     # Verify one image-label pair
-    im_file, lb_file, id_list, prefix = args
+    im_file, lb_file, id_list, prefix, fast = args
     nm, nf, ne, nc, msg, segments = 0, 0, 0, 0, '', []  # number (missing, found, empty, corrupt), message, segments
     length_with_id = 6
     id_key = ''
     try:
         # verify images
-        im = Image.open(im_file)
-        im.verify()  # PIL verify
-        shape = exif_size(im)  # image size
-        assert (shape[0] > 9) & (shape[1] > 9), f'image size {shape} <10 pixels'
-        assert im.format.lower() in IMG_FORMATS, f'invalid image format {im.format}'
-        if im.format.lower() in ('jpg', 'jpeg'):
-            with open(im_file, 'rb') as f:
-                f.seek(-2, 2)
-                if f.read() != b'\xff\xd9':  # corrupt JPEG
-                    Image.open(im_file).save(im_file, format='JPEG', subsampling=0, quality=100)  # re-save image
-                    msg = f'{prefix}WARNING: {im_file}: corrupt JPEG restored and saved'
+        shape, msg = verify_image(im_file, prefix, fast)
 
         # verify labels
         # 在不同文件夹下面的跟踪标注需要进行id的累加
@@ -1570,22 +1783,12 @@ def verify_image_label_with_id(args):
 
 def verify_image_label(args):
     # Verify one image-label pair
-    im_file, lb_file, prefix, num_points = args
+    im_file, lb_file, prefix, num_points, fast = args
     nm, nf, ne, nc, msg, segments = 0, 0, 0, 0, '', []  # number (missing, found, empty, corrupt), message, segments
     length_with_points = 5 + num_points * 2
     try:
         # verify images
-        im = Image.open(im_file)
-        im.verify()  # PIL verify
-        shape = exif_size(im)  # image size
-        assert (shape[0] > 9) & (shape[1] > 9), f'image size {shape} <10 pixels'
-        assert im.format.lower() in IMG_FORMATS, f'invalid image format {im.format}'
-        if im.format.lower() in ('jpg', 'jpeg'):
-            with open(im_file, 'rb') as f:
-                f.seek(-2, 2)
-                if f.read() != b'\xff\xd9':  # corrupt JPEG
-                    Image.open(im_file).save(im_file, format='JPEG', subsampling=0, quality=100)  # re-save image
-                    msg = f'{prefix}WARNING: {im_file}: corrupt JPEG restored and saved'
+        shape, msg = verify_image(im_file, prefix, fast)
 
         # verify labels
         if os.path.isfile(lb_file):
@@ -1698,9 +1901,8 @@ def dataset_stats(path='coco128.yaml', autodownload=False, verbose=False, profil
             continue
         x = []
         dataset = LoadImagesAndLabels(data[split])  # load dataset
-        for label in tqdm(dataset.labels, total=dataset.n, desc='Statistics'):
-            x.append(np.bincount(label[:, 0].astype(int), minlength=data['nc']))
-        x = np.array(x)  # shape(128x80)
+        x = np.zeros((dataset.n, data['nc']), dtype=np.int64)  # shape(128x80)
+        np.add.at(x, (dataset.labels.image_index(), dataset.labels.concat()[:, 0].astype(int)), 1)
         stats[split] = {'instance_stats': {'total': int(x.sum()), 'per_class': x.sum(0).tolist()},
                         'image_stats': {'total': dataset.n, 'unlabelled': int(np.all(x == 0, 1).sum()),
                                         'per_class': (x > 0).sum(0).tolist()},
@@ -0,0 +1,214 @@
+# EfficientTeacher by Alibaba Cloud
+"""
+Tar-shard streaming backend for LoadImagesAndLabels and LoadImagesAndFakeLabels
+
+Shard directory layout:
+    shards.json         {'version', 'shards': [tar names], 'counts': [samples per shard]}
+    labels.cache        LabelStore of every sample in shard order (labels, shapes, original paths)
+    shard-000000.tar    '{index:09d}.{ext}' image files, index into labels.cache
+Each worker reads whole shards sequentially. Shards are split over DDP ranks and dataloader workers, their order is
+reshuffled every pass, and samples are drawn from an in-memory shuffle buffer. The buffer doubles as the map-style
+dataset the existing get_item() / load_mosaic() code runs on, so mosaic partners come from the buffer.
+"""
+
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import tarfile
+from pathlib import Path
+
+import cv2
+import numpy as np
+import torch
+from tqdm import tqdm
+
+from utils.label_store import LabelStore, pack_labels
+
+SHARD_INDEX = 'shards.json'
+SHARD_VERSION = 1
+
+
+def is_shard_dir(path):
+    # True if 'path' is a directory written by write_shards()
+    return isinstance(path, (str, Path)) and os.path.isfile(os.path.join(str(path), SHARD_INDEX))
+
+
+def write_shards(dataset, out, shard_size=1000, prefix=''):
+    # Convert a scanned LoadImagesAndLabels / LoadImagesAndFakeLabels into tar shards plus a label index. Existing
+    # shards are kept, so an interrupted conversion resumes where it stopped
+    out = Path(out)
+    out.mkdir(parents=True, exist_ok=True)
+    n = len(dataset.img_files)
+    labels = list(dataset.labels)
+    if getattr(dataset, 'with_id', False):
+        labels = [np.concatenate((l, i.reshape(-1, 1)), 1) for l, i in zip(labels, dataset.ids)]
+    shards, counts = [], []
+    for s, start in enumerate(tqdm(range(0, n, shard_size), desc=f'{prefix}Writing shards to {out}')):
+        name, end = f'shard-{s:06d}.tar', min(start + shard_size, n)
+        if not (out / name).exists():
+            tmp = out / (name + '.tmp')
+            with tarfile.open(tmp, 'w') as tar:
+                for i in range(start, end):
+                    f = dataset.img_files[i]
+                    tar.add(f, arcname=f'{i:09d}{Path(f).suffix.lower()}')
+            os.replace(tmp, out / name)
+        shards.append(name)
+        counts.append(end - start)
+    ncols = max([l.shape[1] for l in labels if len(l)], default=5)
+    sections = pack_labels(list(dataset.img_files), list(dataset.label_files), labels, dataset.shapes,
+                           list(dataset.segments), ncols=ncols)
+    LabelStore(sections, {'version': SHARD_VERSION}).save(out / 'labels.cache')
+    with open(out / SHARD_INDEX, 'w') as f:
+        json.dump({'version': SHARD_VERSION, 'shards': shards, 'counts': counts}, f)
+    logging.info(f'{prefix}{n} images written to {len(shards)} shards in {out}')
+
+
+class LoadShards(torch.utils.data.IterableDataset):
+    """ Infinite stream of training samples from tar shards, see the module docstring
+
+    len() is the number of samples in all shards, like the map-style datasets; a DDP rank yields len() / world_size
+    samples per epoch.
+    """
+
+    def __init__(self, path, dataset_cls, img_size=640, batch_size=16, augment=False, hyp=None, single_cls=False,
+                 stride=32, cfg=None, buffer_size=1000, rank=-1, world_size=1, seed=0, prefix=''):
+        self.path = Path(path)
+        with open(self.path / SHARD_INDEX) as f:
+            index = json.load(f)
+        assert index['version'] == SHARD_VERSION, f"shard version {index['version']} != {SHARD_VERSION}"
+        self.shards, self.counts = index['shards'], index['counts']
+        self.buffer_size = buffer_size
+        self.rank, self.world_size = max(rank, 0), world_size if rank != -1 else 1
+        self.seed = seed
+        self.img_size = img_size
+        self.batch_size = batch_size
+
+        # Per-sample decoding and augmentation runs on a map-style view over the shuffle buffer
+        self.view = dataset_cls.__new__(dataset_cls)
+        self.view.set_options(img_size, augment, hyp, False, False, stride, cfg)  # no rectangular batches in a stream
+        self.reduced_decode = self.view.reduced_decode
+
+        # Whole-dataset fields for autoanchor, class weights and label statistics
+        store = LabelStore.open(self.path / 'labels.cache')
+        self.labels, self.segments, self.shapes = store.labels, store.segments, store.shapes
+        self.img_files, self.label_files = store.img_files, store.label_files
+        self.ids = None
+        if getattr(self.view, 'with_id', False):
+            self.ids = self.labels.columns(5)
+            self.labels = self.labels.columns(slice(0, 5))
+        elif getattr(self.view, 'num_points', 0) == 0:
+            self.labels = self.labels.columns(slice(0, 5))
+        if single_cls:
+            self.labels = self.labels.replace(fill_cls=0)
+        self.n = len(self.shapes)
+        nc = getattr(self.view, 'nc', None)
+        if nc:
+            cls_tmp = np.bincount(self.labels.concat()[:, 0].astype(int), minlength=nc)[:nc].astype(float)
+            self.cls_ratio_gt = cls_tmp / np.sum(cls_tmp)
+            self.label_num_per_image = np.sum(cls_tmp) / self.n
+        logging.info(f'{prefix}Streaming {self.n} images from {len(self.shards)} shards in {self.path}')
+
+    def __len__(self):
+        return self.n
+
+    @property
+    def mosaic(self):
+        return self.view.mosaic
+
+    @mosaic.setter
+    def mosaic(self, value):
+        self.view.mosaic = value
+
+    def decode(self, i, data):
+        # Decode image bytes the way load_image() does, returns im, original hw, resized hw
+        w, h = (int(x) for x in self.shapes[i])
+        f = 1
+        if self.reduced_decode:
+            while f < 8 and max(w, h) / (f * 2) >= self.img_size:
+                f *= 2
+        flag = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4,
+                8: cv2.IMREAD_REDUCED_COLOR_8}[f]
+        im = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flag)  # BGR
+        if im is None:
+            return None
+        h0, w0 = im.shape[:2]  # orig hw
+        if f > 1:
+            h0, w0 = (h, w) if h0 == -(-h // f) else (w, h)
+        r = self.img_size / max(h0, w0)  # ratio
+        if r != 1:
+            im = cv2.resize(im, (int(w0 * r), int(h0 * r)), interpolation=cv2.INTER_LINEAR)
+        return im, (h0, w0), im.shape[:2]
+
+    def read(self, shards):
+        # Sequentially read and decode every image of the given shards
+        for s in shards:
+            with tarfile.open(self.path / self.shards[s], 'r|') as tar:  # stream mode, no seeks
+                for m in tar:
+                    if not m.isfile():
+                        continue
+                    i = int(m.name.split('.')[0])
+                    x = self.decode(i, tar.extractfile(m).read())
+                    if x is None:
+                        logging.info(f'WARNING: {self.img_files[i]}: ignoring corrupt image in {self.shards[s]}')
+                        continue
+                    yield (i, *x)
+
+    def __iter__(self):
+        info = torch.utils.data.get_worker_info()
+        wid, nw = (info.id, info.num_workers) if info is not None else (0, 1)
+        gid, total = self.rank * nw + wid, self.world_size * nw  # global worker id
+        rng = random.Random(self.seed + gid)
+
+        # Buffer view, mutated in place
+        v = self.view
+        v.imgs, v.img_hw0, v.img_hw, v.labels, v.segments, v.img_files = [], [], [], [], [], []
+        v.ids, v.quarantined, v.indices, v.n = [], set(), range(0), 0
+        for epoch in itertools.count():
+            order = list(range(len(self.shards)))
+            random.Random(self.seed + epoch).shuffle(order)  # same shard order on every worker
+            mine = order[gid::total] or [order[gid % len(order)]]  # fewer shards than workers, share some
+            for i, im, hw0, hw in self.read(mine):
+                sample = (im, hw0, hw, self.labels[i], self.segments[i], self.img_files[i],
+                          self.ids[i] if self.ids is not None else None)
+                if v.n < self.buffer_size:  # fill the buffer before sampling from it
+                    for field, x in zip((v.imgs, v.img_hw0, v.img_hw, v.labels, v.segments, v.img_files, v.ids), sample):
+                        field.append(x)
+                    v.n = len(v.imgs)
+                    v.indices = range(v.n)
+                    continue
+                j = rng.randrange(v.n)
+                yield type(v).get_item(v, j)
+                for field, x in zip((v.imgs, v.img_hw0, v.img_hw, v.labels, v.segments, v.img_files, v.ids), sample):
+                    field[j] = x  # replace the sample just used with the incoming one
+
+
+class ShardDataLoader(torch.utils.data.DataLoader):
+    """ DataLoader over a LoadShards stream that reuses workers, len(dataset) / world_size samples per epoch """
+
+    def __init__(self, dataset, *args, **kwargs):
+        super().__init__(dataset, *args, **kwargs)
+        self.iterator = super().__iter__()
+
+    def __len__(self):
+        return math.ceil(len(self.dataset) / self.dataset.world_size / self.batch_size)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield next(self.iterator)
+
+
+def create_shard_dataloader(path, dataset_cls, imgsz, batch_size, stride, single_cls=False, hyp=None, augment=False,
+                            rank=-1, world_size=1, workers=8, cfg=None, prefix=''):
+    dataset = LoadShards(path, dataset_cls, imgsz, batch_size, augment=augment, hyp=hyp, single_cls=single_cls,
+                         stride=stride, cfg=cfg, buffer_size=cfg.Dataset.shard_buffer if cfg else 1000, rank=rank,
+                         world_size=world_size, prefix=prefix)
+    nw = min([os.cpu_count(), batch_size if batch_size > 1 else 0, workers])  # number of workers
+    dataloader = ShardDataLoader(dataset,
+                                 batch_size=batch_size,
+                                 num_workers=nw,
+                                 pin_memory=True,
+                                 collate_fn=dataset_cls.collate_fn)
+    return dataloader, dataset
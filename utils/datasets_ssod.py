@@ -8,8 +8,6 @@ import os
 import random
 import shutil
 import time
-from itertools import repeat
-from multiprocessing.pool import ThreadPool,Pool
 from pathlib import Path
 from threading import Thread
 
@@ -22,8 +20,15 @@ from torch.utils.data import Dataset
 from tqdm import tqdm
 
 from utils.general import xyxy2xywh, xywh2xyxy, xywhn2xyxy, xyn2xy, segment2box, segments2boxes, resample_segments, \
-    clean_str
+    clean_str, colorstr
 from utils.torch_utils import torch_distributed_zero_first
+from utils.datasets import NUM_THREADS, InfiniteDataLoader, LoadImagesAndLabels, imread_reduced, load_dataset_spec, \
+    mosaic_partners, repeat_indices, scan_fast_arg, scan_labels, verify_image
+from utils.datasets_shard import create_shard_dataloader, is_shard_dir
+from utils.image_cache import LRUImageCache, disk_cache, ram_cache
+from utils.image_probe import CorruptImageError, quarantine_image, read_quarantine
+from utils.label_store import LabelStore, dir_fingerprint
+from utils.shared_batch import SharedBatchCollate
 import torchvision.transforms as transforms
 import copy
 import pdb
@@ -66,6 +71,9 @@ def exif_size(img):
 
 def create_target_dataloader(path, imgsz, batch_size, stride, single_cls=False, hyp=None, augment=False, cache=False, pad=0.0,
                       rect=False, rank=-1, workers=8, image_weights=False, quad=False, cfg=None, prefix=''):
+    if is_shard_dir(path):  # sequential tar-shard streaming, see utils/datasets_shard.py
+        return create_shard_dataloader(path, LoadImagesAndFakeLabels, imgsz, batch_size, int(stride), single_cls, hyp,
+                                       augment, rank, int(os.getenv('WORLD_SIZE', 1)), workers, cfg, prefix)
     # Make sure only the first process in DDP process the dataset first, and the following others can use the cache
     with torch_distributed_zero_first(rank):
         # if world_size > 0 and rank != 0:
@@ -85,6 +93,11 @@ def create_target_dataloader(path, imgsz, batch_size, stride, single_cls=False,
     batch_size = min(batch_size, len(dataset))
     nw = min([os.cpu_count(), batch_size if batch_size > 1 else 0, workers])  # number of workers
     sampler = torch.utils.data.distributed.DistributedSampler(dataset) if rank != -1 else None
+    collate_fn = LoadImagesAndFakeLabels.collate_fn4 if quad else LoadImagesAndFakeLabels.collate_fn
+    if cfg.Dataset.shared_collate and not (rect or quad):  # fixed size strong and weak views
+        shapes = {0: (3, imgsz, imgsz)} if cfg.SSOD.device_strong_view else {0: (3, imgsz, imgsz), 4: (3, imgsz, imgsz)}
+        collate_fn = SharedBatchCollate(collate_fn, shapes, batch_size, nw, held=cfg.Dataset.prefetch + 1, pin=True,
+                                        prefix=prefix)
     loader = torch.utils.data.DataLoader if image_weights else InfiniteDataLoader
     # Use torch.utils.data.DataLoader() if dataset.properties will update during training else InfiniteDataLoader()
     dataloader = loader(dataset,
@@ -92,41 +105,105 @@ def create_target_dataloader(path, imgsz, batch_size, stride, single_cls=False,
                         num_workers=nw,
                         sampler=sampler,
                         pin_memory=True,
-                        collate_fn=LoadImagesAndFakeLabels.collate_fn4 if quad else LoadImagesAndFakeLabels.collate_fn)
+                        collate_fn=collate_fn)
     return dataloader, dataset
 
-class InfiniteDataLoader(torch.utils.data.dataloader.DataLoader):
-    """ Dataloader that reuses workers
 
-    Uses same syntax as vanilla DataLoader
-    """
-
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        object.__setattr__(self, 'batch_sampler', _RepeatSampler(self.batch_sampler))
-        self.iterator = super().__iter__()
+def create_joint_dataloader(path, target_path, imgsz, batch_size, unlabeled_ratio, stride, single_cls=False, hyp=None,
+                            augment=False, cache=False, rank=-1, workers=8, cfg=None, start_epoch=0):
+    # One loader and worker pool for the labeled and unlabeled training sets, yields (labeled, unlabeled) batch pairs
+    with torch_distributed_zero_first(rank):
+        dataset = LoadImagesAndLabels(path, imgsz, batch_size, augment=augment, hyp=hyp, cache_images=cache,
+                                      single_cls=single_cls, stride=int(stride), cfg=cfg, prefix=colorstr('train: '))
+        unlabeled_dataset = LoadImagesAndFakeLabels(target_path, imgsz, batch_size, augment=augment, hyp=hyp,
+                                                    cache_images=cache, single_cls=single_cls, stride=int(stride),
+                                                    cfg=cfg, prefix=colorstr('target: '))
+
+    batch_sizes = (min(batch_size, len(dataset)), min(max(round(batch_size * unlabeled_ratio), 1), len(unlabeled_dataset)))
+    nw = min([os.cpu_count(), sum(batch_sizes), workers])  # number of workers
+    world_size, global_rank = (torch.distributed.get_world_size(), torch.distributed.get_rank()) if rank != -1 else (1, -1)
+    batch_sampler = JointBatchSampler((len(dataset), len(unlabeled_dataset)), batch_sizes, world_size, global_rank,
+                                      by_unlabeled=cfg.SSOD.epoch_adaptor)
+    burn_in = 0 if cfg.SSOD.with_da_loss else cfg.hyp.burn_epochs  # da loss trains on unlabeled images from the start
+    batch_sampler.step = start_epoch * len(batch_sampler)
+    batch_sampler.unlabeled_from = burn_in * len(batch_sampler)
+    dataloader = InfiniteDataLoader(JointDataset(dataset, unlabeled_dataset),
+                                    num_workers=nw,
+                                    batch_sampler=batch_sampler,
+                                    pin_memory=True,
+                                    collate_fn=JointDataset.collate_fn)
+    return dataloader, dataset, unlabeled_dataset
+
+
+class JointDataset(Dataset):
+    """ Labeled and unlabeled dataset behind one worker pool, indexed by (stream, index), stream 0 is the labeled one """
+
+    def __init__(self, labeled, unlabeled):
+        self.datasets = (labeled, unlabeled)
 
     def __len__(self):
-        return len(self.batch_sampler.sampler)
+        return sum(len(d) for d in self.datasets)
 
-    def __iter__(self):
-        for i in range(len(self)):
-            yield next(self.iterator)
+    def __getitem__(self, index):
+        stream, i = index
+        return stream, self.datasets[stream][i]
 
+    @staticmethod
+    def collate_fn(batch):
+        # (labeled batch, unlabeled batch), the unlabeled batch is None while it is not sampled (burn-in)
+        labeled = [x for stream, x in batch if stream == 0]
+        unlabeled = [x for stream, x in batch if stream == 1]
+        return LoadImagesAndLabels.collate_fn(labeled), LoadImagesAndFakeLabels.collate_fn(unlabeled) if unlabeled else None
 
-class _RepeatSampler(object):
-    """ Sampler that repeats forever
 
-    Args:
-        sampler (Sampler)
+class JointBatchSampler(torch.utils.data.sampler.Sampler):
+    """ Batches of batch_sizes[0] labeled and batch_sizes[1] unlabeled (stream, index) pairs
+
+    Each stream walks its own shuffled permutation and draws the next one (seed, stream, pass) when it runs out, so the
+    shorter stream wraps around within an epoch. An epoch is one pass over the unlabeled stream with by_unlabeled
+    (SSOD.epoch_adaptor), over the labeled stream otherwise. Every DDP rank draws the same permutations and takes every
+    num_replicas-th index of them, so ranks see disjoint shards of both streams. Unlabeled indices are drawn from step
+    'unlabeled_from' on, burn-in batches are labeled only.
     """
 
-    def __init__(self, sampler):
-        self.sampler = sampler
+    def __init__(self, sizes, batch_sizes, num_replicas=1, rank=-1, by_unlabeled=False, seed=0):
+        self.sizes, self.batch_sizes = sizes, batch_sizes
+        self.num_replicas, self.rank = (num_replicas, rank) if rank != -1 else (1, 0)
+        assert min(sizes) >= self.num_replicas, f'every rank needs samples of both streams, got {sizes}'
+        self.seed = seed
+        self.step = 0  # batches drawn
+        self.unlabeled_from = 0
+        self.passes = [0, 0]  # permutations drawn per stream
+        self.pos = [0, 0]  # position in the current permutation shard of each stream
+        self.perms = [None, None]
+        s = int(by_unlabeled)
+        self.num_batches = math.ceil(math.ceil(sizes[s] / self.num_replicas) / batch_sizes[s])  # per rank
+
+    def draw(self, stream, n):
+        # Next n (stream, index) pairs of this rank's shard of the stream
+        out = []
+        while len(out) < n:
+            if self.perms[stream] is None or self.pos[stream] >= len(self.perms[stream]):
+                g = np.random.default_rng([self.seed, stream, self.passes[stream]])  # same on every rank
+                self.perms[stream] = g.permutation(self.sizes[stream])[self.rank::self.num_replicas]
+                self.passes[stream] += 1
+                self.pos[stream] = 0
+            i = self.pos[stream]
+            k = min(n - len(out), len(self.perms[stream]) - i)
+            out += [(stream, int(x)) for x in self.perms[stream][i:i + k]]
+            self.pos[stream] += k
+        return out
 
     def __iter__(self):
-        while True:
-            yield from iter(self.sampler)
+        for _ in range(self.num_batches):
+            batch = self.draw(0, self.batch_sizes[0])
+            if self.step >= self.unlabeled_from:
+                batch += self.draw(1, self.batch_sizes[1])
+            self.step += 1
+            yield batch
+
+    def __len__(self):
+        return self.num_batches
 
 
 class LoadImages:  # for inference
@@ -219,21 +296,11 @@ def img2label_paths(img_paths):
 
 def fake_image_label(args):
     # Verify one image-label pair
-    im_file, lb_file, prefix = args
+    im_file, lb_file, prefix, fast = args
     nm, nf, ne, nc, msg, segments = 0, 0, 0, 0, '', []  # number (missing, found, empty, corrupt), message, segments
     try:
         # verify images
-        im = Image.open(im_file)
-        im.verify()  # PIL verify
-        shape = exif_size(im)  # image size
-        assert (shape[0] > 9) & (shape[1] > 9), f'image size {shape} <10 pixels'
-        assert im.format.lower() in IMG_FORMATS, f'invalid image format {im.format}'
-        if im.format.lower() in ('jpg', 'jpeg'):
-            with open(im_file, 'rb') as f:
-                f.seek(-2, 2)
-                if f.read() != b'\xff\xd9':  # corrupt JPEG
-                    Image.open(im_file).save(im_file, format='JPEG', subsampling=0, quality=100)  # re-save image
-                    msg = f'{prefix}WARNING: {im_file}: corrupt JPEG restored and saved'
+        shape, msg = verify_image(im_file, prefix, fast)
 
         l = np.zeros((1, 5), dtype=np.float32)
         nf += 1
@@ -244,92 +311,51 @@ def fake_image_label(args):
         return [None, None, None, None, nm, nf, ne, nc, msg]
 
 class LoadImagesAndFakeLabels(Dataset):  # for training/testing
-    cache_version = 0.6  # dataset labels *.cache version
+    cache_version = 0.8  # dataset labels *.cache version, 0.8 = LabelStore with per-file stats
     def __init__(self, path, img_size=640, batch_size=16, augment=False, hyp=None, rect=False, image_weights=False,
                  cache_images=False, single_cls=False, stride=32, pad=0.0, cfg=None, prefix=''):
-        self.img_size = img_size
-        self.augment = augment
-
-        self.albumentations = Albumentations() if augment else None
-        # self.hyp = hyp
-        self.hyp = cfg.SSOD.ssod_hyp
-        self.image_weights = image_weights
-        self.rect = False if image_weights else rect
-        #self.mosaic = self.augment and not self.rect  # load 4 images at a time into a mosaic (only during training)
-        self.mosaic = True # load 4 images at a time into a mosaic (only during training)
-        self.mosaic_border = [-img_size // 2, -img_size // 2]
-        self.stride = stride
+        self.set_options(img_size, augment, hyp, rect, image_weights, stride, cfg)
         self.path = path
-        self.with_gt = cfg.SSOD.ssod_hyp.with_gt
-       
-        try:
-            f = []  # image files
-            for p in path if isinstance(path, list) else [path]:
-                p = Path(p)  # os-agnostic
-                if p.is_dir():  # dir
-                    f += glob.glob(str(p / '**' / '*.*'), recursive=True)
-                    # f = list(p.rglob('**/*.*'))  # pathlib
-                elif p.is_file():  # file
-                    with open(p, 'r') as t:
-                        t = t.read().strip().splitlines()
-                        parent = str(p.parent) + os.sep
-                        f += [x.replace('./', parent) if x.startswith('./') else x for x in t]  # local to global path
-                        # f += [p.parent / x.lstrip(os.sep) for x in t]  # local to global path (pathlib)
-                else:
-                    raise Exception(f'{prefix}{p} does not exist')
-            self.img_files = sorted([x.replace('/', os.sep) for x in f if x.split('.')[-1].lower() in img_formats+['txt']])
-            # self.img_files = sorted([x for x in f if x.suffix[1:].lower() in img_formats])  # pathlib
-            assert self.img_files, f'{prefix}No images found'
-        except Exception as e:
-            raise Exception(f'{prefix}Error loading data from {path}: {e}\nSee {help_url}')
-
-        # Check cache
-        if self.img_files[0].endswith('.txt') and len(self.img_files[0].split(' ')) == 2:
-            self.label_files = [a.split(' ')[1] for a in self.img_files]
-            self.img_files = [a.split(' ')[0] for a in self.img_files]
-        else:
-            self.label_files = img2label_paths(self.img_files)  # labels
+        self.img_files, self.label_files, weights, p, self.manifest_shapes = load_dataset_spec(path, prefix)
+        spec_files = self.img_files
         #print('sefl.label_files', self.label_files)
         #print('sefl.img_files', self.img_files)
         cache_path = (p if p.is_file() else Path(self.label_files[0]).parent).with_suffix('.cache')  # cached labels
         try:
-           cache, exists = np.load(cache_path, allow_pickle=True).item(), True  # load dict
-           assert cache['version'] == self.cache_version  # same version
-           assert cache['hash'] == get_hash(self.label_files + self.img_files)  # same hash
+            store = LabelStore.open(cache_path)  # memory-mapped packed labels
+            assert store.meta['version'] == self.cache_version  # same version
+            assert store.meta['scan'] == self.scan_key()  # same verify function, never reuse a supervised cache
         except:
-           cache, exists = self.cache_labels(cache_path, prefix), False  # cache
-        # if cache_path.is_file():
-        #      cache, exists = torch.load(cache_path), True  # load
-        #      if cache['hash'] != get_hash(self.label_files + self.img_files) or 'version' not in cache:  # changed
-        #          cache, exists = self.cache_labels(cache_path, prefix), False  # re-cache
-        # else:
-        #      cache, exists = self.cache_labels(cache_path, prefix), False  # cache
+            store = None
+        self.quarantine_path = cache_path.with_suffix('.quarantine')  # corrupt images found by load_image()
+        if store is not None and store.meta['fingerprint'] == dir_fingerprint(self.img_files, self.label_files) and \
+                not (cfg and cfg.check_datacache) and not self.quarantine_path.exists():
+            exists = True  # no file added, removed or renamed, trust the cache without stat-ing every file
+        else:
+            store, exists = self.cache_labels(cache_path, prefix, old=store), False  # incremental re-validation
 
         # Display cache
-        nf, nm, ne, nc, n = cache.pop('results')  # found, missing, empty, corrupted, total
+        nf, nm, ne, nc, n = store.meta['results']  # found, missing, empty, corrupted, total
         if exists:
             d = f"Scanning '{cache_path}' for images and labels... {nf} found, {nm} missing, {ne} empty, {nc} corrupted"
             tqdm(None, desc=prefix + d, total=n, initial=n)  # display cache results
         assert nf > 0 or not augment, f'{prefix}No labels in {cache_path}. Can not train without labels. See {help_url}'
 
-        # Read cache
-        [cache.pop(k) for k in ('hash', 'version', 'msgs')]  # remove items
-        labels, shapes, self.segments = zip(*cache.values())
-
-        self.labels = list(labels)
-        self.shapes = np.array(shapes, dtype=np.float64)
-        self.img_files = list(cache.keys())  # update
-        self.label_files = img2label_paths(cache.keys())  # update
+        # Read cache, every per-image field is a read-only view into the packed store
+        self.labels, self.segments = store.labels.columns(slice(0, 5)), store.segments
+        self.shapes = store.shapes
+        self.img_files = store.img_files  # update
+        self.label_files = store.label_files  # update
         if single_cls:
-            for x in self.labels:
-                x[:, 0] = 0
+            self.labels = self.labels.replace(fill_cls=0)
 
-        n = len(shapes)  # number of images
+        n = len(self.shapes)  # number of images
         bi = np.floor(np.arange(n) / batch_size).astype(np.int)  # batch index
         nb = bi[-1] + 1  # number of batches
         self.batch = bi  # batch index of image
         self.n = n
         self.indices = range(n)
+        self.quarantined = set()  # indices found corrupt by load_image() in this process
 
         # Rectangular Training
         if self.rect:
@@ -337,9 +363,9 @@ class LoadImagesAndFakeLabels(Dataset):  # for training/testing
             s = self.shapes  # wh
             ar = s[:, 1] / s[:, 0]  # aspect ratio
             irect = ar.argsort()
-            self.img_files = [self.img_files[i] for i in irect]
-            self.label_files = [self.label_files[i] for i in irect]
-            self.labels = [self.labels[i] for i in irect]
+            self.img_files = self.img_files.take(irect)
+            self.label_files = self.label_files.take(irect)
+            self.labels = self.labels.take(irect)
             self.shapes = s[irect]  # wh
             ar = ar[irect]
 
@@ -355,69 +381,78 @@ class LoadImagesAndFakeLabels(Dataset):  # for training/testing
 
             self.batch_shapes = np.ceil(np.array(shapes) * img_size / stride + pad).astype(np.int) * stride
 
+        # '*N' repeats are sampling weights over unique images, rectangular batches see every image once
+        repeats = None if self.rect else repeat_indices(weights, spec_files, self.img_files)
+        if repeats is not None:
+            self.indices = repeats
+            logging.info(f'{prefix}{n} images sampled {len(repeats)} times per epoch with repeats')
+        del spec_files
+
         # Cache images into memory for faster training (WARNING: large datasets may exceed system RAM)
-        self.imgs, self.img_npy = [None] * n, [None] * n
+        self.imgs = [None] * n
         if cache_images:
-            if cache_images == 'disk':
-                self.im_cache_dir = Path(Path(self.img_files[0]).parent.as_posix() + '_npy')
-                self.img_npy = [self.im_cache_dir / Path(f).with_suffix('.npy').name for f in self.img_files]
-                self.im_cache_dir.mkdir(parents=True, exist_ok=True)
-                print('self target im cache dir:', self.im_cache_dir)
-            gb = 0  # Gigabytes of cached images
-            self.img_hw0, self.img_hw = [None] * n, [None] * n
-            #results = ThreadPool(8).imap(lambda x: load_image(*x), zip(repeat(self), range(n)))  # 8 threads
-            results = ThreadPool(64).imap(lambda x: load_image(*x), zip(repeat(self), range(n)))  # 32 threads
-            pbar = tqdm(enumerate(results), total=n)
-            for i, x in pbar:
-                if cache_images == 'disk':
-                    if not self.img_npy[i].exists():
-                        np.save(self.img_npy[i].as_posix(), x[0])
-                    gb += self.img_npy[i].stat().st_size
-                else:
-                    self.imgs[i], self.img_hw0[i], self.img_hw[i] = x  # img, hw_original, hw_resized = load_image(self, i)
-                    gb += self.imgs[i].nbytes
-                pbar.desc = f'{prefix}Caching images ({gb / 1E9:.1f}GB)'
-            pbar.close()
+            if cache_images == 'disk':  # one packed file next to the label cache instead of one .npy per image
+                try:
+                    self.imgs = disk_cache(cache_path.with_suffix('.images'), self.img_files, self.shapes, img_size,
+                                           store.meta['fingerprint'], lambda i: load_image(self, i),
+                                           threads=NUM_THREADS, tag=self.reduced_decode, prefix=prefix)
+                except OSError as e:
+                    logging.info(f'{prefix}WARNING: Cache directory {cache_path.parent} is not writeable: {e}')
+            else:  # one shared-memory copy per node, read zero-copy by all ranks and workers
+                self.imgs = ram_cache(self.img_files, self.shapes, img_size, lambda i: load_image(self, i),
+                                      threads=NUM_THREADS, tag=self.reduced_decode, prefix=prefix)
+            if not isinstance(self.imgs, list):
+                self.img_hw0, self.img_hw = self.imgs.hw0, self.imgs.hw
+        elif self.lru_cache_mb > 0:  # bounded cache of recently decoded images, one per dataloader worker
+            self.lru = LRUImageCache(self.lru_cache_mb, prefix=prefix)
+
+    def set_options(self, img_size=640, augment=False, hyp=None, rect=False, image_weights=False, stride=32, cfg=None):
+        # Loading and augmentation options, shared with the streaming backend in utils/datasets_shard.py
+        self.img_size = img_size
+        self.augment = augment
 
-    def cache_labels(self, path=Path('./labels.cache'), prefix=''):
-       # Cache dataset labels, check images and read shapes
-        x = {}  # dict
-        nm, nf, ne, nc, msgs = 0, 0, 0, 0, []  # number missing, found, empty, corrupt, messages
-        desc = f"{prefix}Scanning '{path.parent / path.stem}' images and labels..."
-        with Pool(32) as pool:
-            if self.with_gt:
-                pbar = tqdm(pool.imap(verify_image_label, zip(self.img_files, self.label_files, repeat(prefix))),
-                        desc=desc, total=len(self.img_files))
-            else:
-                pbar = tqdm(pool.imap(fake_image_label, zip(self.img_files, self.label_files, repeat(prefix))),
-                        desc=desc, total=len(self.img_files))
-            for im_file, l, shape, segments, nm_f, nf_f, ne_f, nc_f, msg in pbar:
-                nm += nm_f
-                nf += nf_f
-                ne += ne_f
-                nc += nc_f
-                if im_file:
-                    x[im_file] = [l, shape, segments]
-                if msg:
-                    msgs.append(msg)
-                pbar.desc = f"{desc}{nf} found, {nm} missing, {ne} empty, {nc} corrupted"
-
-        pbar.close()
-        if msgs:
-            logging.info('\n'.join(msgs))
-        if nf == 0:
-            logging.info(f'{prefix}WARNING: No labels found in {path}. See {HELP_URL}')
-        x['hash'] = get_hash(self.label_files + self.img_files)
-        x['results'] = nf, nm, ne, nc, len(self.img_files)
-        x['msgs'] = msgs  # warnings
-        x['version'] = self.cache_version  # cache version
+        self.albumentations = Albumentations() if augment else None
+        # self.hyp = hyp
+        self.hyp = cfg.SSOD.ssod_hyp
+        self.image_weights = image_weights
+        self.rect = False if image_weights else rect
+        #self.mosaic = self.augment and not self.rect  # load 4 images at a time into a mosaic (only during training)
+        self.mosaic = True # load 4 images at a time into a mosaic (only during training)
+        self.mosaic_border = [-img_size // 2, -img_size // 2]
+        self.stride = stride
+        self.with_gt = cfg.SSOD.ssod_hyp.with_gt
+        self.fast_scan = cfg.Dataset.fast_scan
+        self.reduced_decode = cfg.Dataset.reduced_decode
+        self.lru_cache_mb = cfg.Dataset.lru_cache_mb
+        self.lru_mosaic_bias = cfg.Dataset.lru_mosaic_bias
+        self.device_strong_view = cfg.SSOD.device_strong_view
+        self.lru = None
+
+    def scan_key(self):
+        # Identifies the verify function a cache was built with
+        return ('ssod_verify_image_label:5' if self.with_gt else 'fake_image_label:5') + (':fast' if self.fast_scan else '')
+
+    def cache_labels(self, path=Path('./labels.cache'), prefix='', old=None):
+        # Cache dataset labels, check images and read shapes. Unchanged entries of the 'old' store are reused,
+        # quarantined images are fully verified again
+        quarantined = read_quarantine(self.quarantine_path)
+        verify = verify_image_label if self.with_gt else fake_image_label
+        make_args = lambda k: (self.img_files[k], self.label_files[k], prefix, self.fast_scan and
+                               self.img_files[k] not in quarantined and scan_fast_arg(self.manifest_shapes, k))
+        sections, meta = scan_labels(path, self.img_files, self.label_files, verify, make_args, old=old,
+                                     scan=self.scan_key(), workers=32, force=quarantined, prefix=prefix)
+        meta['version'] = self.cache_version  # cache version
+        if meta['results'][0] == 0:
+            logging.info(f'{prefix}WARNING: No labels found in {path}. See {help_url}')
         try:
-            np.save(path, x)  # save cache for next time
-            path.with_suffix('.cache.npy').rename(path)  # remove .npy suffix
+            LabelStore(sections, meta).save(path)  # save cache for next time
             logging.info(f'{prefix}New cache created: {path}')
+            if quarantined:
+                self.quarantine_path.unlink()  # re-verified into the new cache
+            return LabelStore.open(path)  # memory-mapped, shared between ranks and workers
         except Exception as e:
             logging.info(f'{prefix}WARNING: Cache directory {path.parent} is not writeable: {e}')  # path not writeable
-        return x
+        return LabelStore(sections, meta)
 
     def cache_labels_old(self, path=Path('./labels.cache'), prefix=''):
         # Cache dataset labels, check images and read shapes
@@ -479,7 +514,7 @@ class LoadImagesAndFakeLabels(Dataset):  # for training/testing
 
 
     def __len__(self):
-        return len(self.img_files)
+        return len(self.indices)  # images, counting '*N' repeats
 
     # def __iter__(self):
     #     self.count = -1
@@ -488,6 +523,15 @@ class LoadImagesAndFakeLabels(Dataset):  # for training/testing
     #     return self
 
     def __getitem__(self, index):
+        # Corrupt images found at load time are quarantined and the sample is replaced by a random other one
+        for _ in range(10):
+            try:
+                return self.get_item(index)
+            except CorruptImageError:
+                index = random.randint(0, self.n - 1)
+        return self.get_item(index)
+
+    def get_item(self, index):
         index = self.indices[index]  # linear, shuffled, or image_weights
 
         hyp = self.hyp
@@ -518,6 +562,18 @@ class LoadImagesAndFakeLabels(Dataset):  # for training/testing
             if labels.size:  # normalized xywh to pixel xyxy format
                 labels[:, 1:] = xywhn2xyxy(labels[:, 1:], ratio[0] * w, ratio[1] * h, padw=pad[0], padh=pad[1])
 
+        if self.augment and self.device_strong_view:
+            # Weak view only, the trainer builds the strong view and its M_s on the device (utils/batch_augment.py)
+            nL = len(labels)
+            labels_out = torch.zeros((nL, 6))
+            if nL:
+                labels[:, 1:5] = xyxy2xywh(labels[:, 1:5])  # convert xyxy to xywh
+                labels[:, [2, 4]] /= img.shape[0]  # normalized height 0-1
+                labels[:, [1, 3]] /= img.shape[1]  # normalized width 0-1
+                labels_out[:, 1:] = torch.from_numpy(labels)
+            img = np.ascontiguousarray(img[:, :, ::-1].transpose(2, 0, 1))  # BGR to RGB, HWC to CHW
+            return torch.from_numpy(img), labels_out, self.img_files[index], shapes, torch.zeros(0), torch.zeros(1)
+
         if self.augment:
             # Augment imagespace
             if not mosaic:
@@ -629,21 +685,11 @@ class LoadImagesAndFakeLabels(Dataset):  # for training/testing
 
 def verify_image_label(args):
     # Verify one image-label pair
-    im_file, lb_file, prefix = args
+    im_file, lb_file, prefix, fast = args
     nm, nf, ne, nc, msg, segments = 0, 0, 0, 0, '', []  # number (missing, found, empty, corrupt), message, segments
     try:
         # verify images
-        im = Image.open(im_file)
-        im.verify()  # PIL verify
-        shape = exif_size(im)  # image size
-        assert (shape[0] > 9) & (shape[1] > 9), f'image size {shape} <10 pixels'
-        assert im.format.lower() in IMG_FORMATS, f'invalid image format {im.format}'
-        if im.format.lower() in ('jpg', 'jpeg'):
-            with open(im_file, 'rb') as f:
-                f.seek(-2, 2)
-                if f.read() != b'\xff\xd9':  # corrupt JPEG
-                    Image.open(im_file).save(im_file, format='JPEG', subsampling=0, quality=100)  # re-save image
-                    msg = f'{prefix}WARNING: {im_file}: corrupt JPEG restored and saved'
+        shape, msg = verify_image(im_file, prefix, fast)
 
         # verify labels
         if os.path.isfile(lb_file):
@@ -685,19 +731,29 @@ def load_image(self, index):
     # loads 1 image from dataset, returns img, original hw, resized hw
     img = self.imgs[index]
     if img is None:  # not cached
-        npy = self.img_npy[index]
-        if npy and npy.exists():  # load npy
-            img = np.load(npy)
-        else:  # read image
-            path = self.img_files[index]
-            img = cv2.imread(path)  # BGR
-        assert img is not None, 'Image Not Found ' + path
+        x = self.lru.get(index) if self.lru is not None else None  # recently decoded by this worker
+        if x is not None:
+            return x
+        path = self.img_files[index]
+        if index in self.quarantined:
+            raise CorruptImageError(path)
+        w, h = (int(x) for x in self.shapes[index])  # scanned size
+        img, f = imread_reduced(path, (w, h), self.img_size) if self.reduced_decode else (cv2.imread(path), 1)  # BGR
+        if img is None or sorted(img.shape[:2]) != sorted((-(-h // f), -(-w // f))):
+            self.quarantined.add(index)
+            quarantine_image(self.quarantine_path, path, 'decode failed' if img is None else
+                             f'decoded shape {img.shape[:2]} != scanned shape {(h, w)} / {f}')
+            raise CorruptImageError(path)
         h0, w0 = img.shape[:2]  # orig hw
+        if f > 1:  # decoded at 1/f scale, the original size comes from the label cache
+            h0, w0 = (h, w) if h0 == -(-h // f) else (w, h)
         r = self.img_size / max(h0, w0)  # resize image to img_size
         if r != 1:  # always resize down, only resize up if training with augmentation
             #interp = cv2.INTER_AREA if r < 1 and not self.augment else cv2.INTER_LINEAR
             interp =cv2.INTER_LINEAR
             img = cv2.resize(img, (int(w0 * r), int(h0 * r)), interpolation=interp)
+        if self.lru is not None:
+            self.lru.put(index, (img, (h0, w0), img.shape[:2]))
         return img, (h0, w0), img.shape[:2]  # img, hw_original, hw_resized
     else:
         return self.imgs[index], self.img_hw0[index], self.img_hw[index]  # img, hw_original, hw_resized
@@ -735,7 +791,7 @@ def load_mosaic_with_M(self, index):
     labels4, segments4 = [], []
     s = self.img_size
     yc, xc = [int(random.uniform(-x, 2 * s + x)) for x in self.mosaic_border]  # mosaic center x, y
-    indices = [index] + random.choices(self.indices, k=3)  # 3 additional image indices
+    indices = [index] + mosaic_partners(self, 3)  # 3 additional image indices
     random.shuffle(indices)
    
     for i, index in enumerate(indices):
@@ -779,6 +835,8 @@ def load_mosaic_with_M(self, index):
     height = img4.shape[0] + self.mosaic_border[0] * 2  # shape(h,w,c)
     width = img4.shape[1] + self.mosaic_border[1] * 2
     img4 = cv2.resize(img4, (height, width))
+    if self.device_strong_view:  # weak view only, warped on the device
+        return img4, labels4, None, None
     img4_ori = copy.deepcopy(img4)
     # print('copy deepcopy:', img4.shape)
     # Augment
@@ -798,7 +856,7 @@ def load_mosaic(self, index):
     labels4, segments4 = [], []
     s = self.img_size
     yc, xc = [int(random.uniform(-x, 2 * s + x)) for x in self.mosaic_border]  # mosaic center x, y
-    indices = [index] + random.choices(self.indices, k=3)  # 3 additional image indices
+    indices = [index] + mosaic_partners(self, 3)  # 3 additional image indices
     random.shuffle(indices)
     for i, index in enumerate(indices):
         # Load image
@@ -0,0 +1,248 @@
+# EfficientTeacher by Alibaba Cloud
+"""
+Packed image cache, one uint8 arena of resized images plus an offset index in a single file, and a bounded per-worker
+LRU cache of recently decoded images for datasets that are not cached in full
+
+File layout (little endian):
+    MAGIC | 4 KiB JSON header | offsets int64 (n + 1) | hw0 int32 (n, 2) | hw int32 (n, 2) | done uint8 (n) | data
+Slot sizes come from the label cache shapes, so the file is allocated once and filled in place. Readers map it with
+np.memmap and slice images out zero-copy. Put in /dev/shm (cache=ram), every DDP rank and dataloader worker on a node shares the
+same pages instead of holding its own copy of the decoded dataset. Next to the label cache (cache=disk), one
+append-in-place file replaces a directory of per-image .npy files and later epochs are served from page cache.
+"""
+
+import atexit
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import random
+import tempfile
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from pathlib import Path
+
+import numpy as np
+from tqdm import tqdm
+
+MAGIC = b'ETIMGCCH'
+HEADER = 4096
+PAGE = 4096
+
+
+def _align(n, a=PAGE):
+    return (n + a - 1) // a * a
+
+
+def resized_hw(shapes, img_size):
+    # (n, 2) int64 hw of every image after the load_image() resize, from (n, 2) wh label cache shapes
+    wh = np.asarray(shapes, dtype=np.float64).reshape(-1, 2)
+    r = img_size / wh.max(1)
+    return np.stack((wh[:, 1] * r, wh[:, 0] * r), 1).astype(np.int64)
+
+
+def cache_key(img_files, img_size, *extra):
+    # Identifies the image order and resize a cache was built for
+    h = hashlib.md5(f'{img_size}:{extra}'.encode())
+    h.update('\n'.join(img_files).encode('utf-8', 'surrogateescape'))
+    return h.hexdigest()
+
+
+def shm_dir():
+    # Node-local RAM backed directory
+    return Path('/dev/shm') if os.path.isdir('/dev/shm') else Path(tempfile.gettempdir())
+
+
+class ImageCache:
+    """ Read view of a packed image cache, cache[i] is a read-only (h, w, c) uint8 array or None if not cached """
+
+    def __init__(self, path, mode='r'):
+        self.path = Path(path)
+        with open(self.path, 'rb') as f:
+            assert f.read(len(MAGIC)) == MAGIC, f'{path} is not a packed image cache'
+            self.meta = json.loads(f.read(HEADER - len(MAGIC)).rstrip(b'\0').decode())
+        n = self.meta['n']
+        o = HEADER
+        self.offsets = np.memmap(path, dtype=np.int64, mode=mode, offset=o, shape=(n + 1,))
+        o += self.offsets.nbytes
+        self.hw0 = np.memmap(path, dtype=np.int32, mode=mode, offset=o, shape=(n, 2))
+        o += self.hw0.nbytes
+        self.hw = np.memmap(path, dtype=np.int32, mode=mode, offset=o, shape=(n, 2))
+        o += self.hw.nbytes
+        self.done = np.memmap(path, dtype=np.uint8, mode=mode, offset=o, shape=(n,))
+        self.base = _align(o + n)
+        self.data = np.memmap(path, dtype=np.uint8, mode=mode, offset=self.base, shape=(max(int(self.offsets[-1]), 1),))
+
+    def __len__(self):
+        return len(self.done)
+
+    def __getitem__(self, i):
+        if not self.done[i]:
+            return None
+        h, w = self.hw[i]
+        return self.data[self.offsets[i]:self.offsets[i + 1]][:h * w * 3].reshape(h, w, 3)
+
+    @property
+    def complete(self):
+        return self.meta.get('complete', False)
+
+    @staticmethod
+    def create(path, key, capacity_hw, channels=3):
+        # Allocate a sparse cache file with one slot of h * w * channels bytes per image
+        n = len(capacity_hw)
+        offsets = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.prod(np.asarray(capacity_hw, dtype=np.int64), 1) * channels, out=offsets[1:])
+        header = MAGIC + json.dumps({'key': key, 'n': n, 'complete': False}).encode()
+        assert len(header) <= HEADER, 'image cache header too long'
+        base = _align(HEADER + offsets.nbytes + 2 * n * 2 * 4 + n)
+        with open(path, 'wb') as f:
+            f.write(header.ljust(HEADER, b'\0'))
+            f.write(offsets.tobytes())
+            f.truncate(base + max(int(offsets[-1]), 1))  # zero-filled, only written slots take memory/disk
+
+    def set_meta(self, **kwargs):
+        self.meta.update(kwargs)
+        header = MAGIC + json.dumps(self.meta).encode()
+        with open(self.path, 'r+b') as f:
+            f.write(header.ljust(HEADER, b'\0'))
+
+    def fill(self, load_fn, threads=8, prefix=''):
+        # Decode every missing image with load_fn(i) -> (im, hw_original, hw_resized) into its slot, resumable
+        todo = np.flatnonzero(self.done == 0)
+        gb, flushed = 0, 0
+        def load(i):
+            try:
+                return load_fn(i)
+            except Exception:  # corrupt or missing, left uncached for load_image() to report
+                return None, None, None
+
+        with ThreadPool(threads) as pool:
+            pbar = tqdm(zip(todo, pool.imap(load, todo)), total=len(todo))
+            for i, (im, hw0, hw) in pbar:
+                if im is None:
+                    continue
+                im = np.ascontiguousarray(im)
+                if im.ndim == 2 or im.shape[2] != 3 or im.nbytes > self.offsets[i + 1] - self.offsets[i]:
+                    continue  # does not fit its slot (unexpected shape), load_image() decodes it from disk
+                self.data[self.offsets[i]:self.offsets[i] + im.nbytes] = im.reshape(-1)
+                self.hw0[i], self.hw[i] = hw0, hw
+                self.done[i] = 1
+                gb += im.nbytes
+                if gb - flushed > 1E9:  # bound the work lost if the build is interrupted, slots before flags
+                    self.flush()
+                    flushed = gb
+                pbar.desc = f'{prefix}Caching images ({gb / 1E9:.1f}GB {self.path.parent})'
+            pbar.close()
+        self.flush()
+        self.set_meta(complete=True)
+
+    def flush(self):
+        for x in (self.data, self.hw0, self.hw, self.done):
+            x.flush()
+
+    @classmethod
+    def open_or_build(cls, path, key, capacity_hw, load_fn, threads=8, prefix='', unlink_at_exit=False):
+        # Attach to a complete cache with the same key, else build (or resume) it under an exclusive file lock so
+        # that only the first process on a node decodes images and the others wait and then share the result
+        path = Path(path)
+        lock = open(path.with_name(path.name + '.lock'), 'w')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                cache = cls(path, mode='r+')
+                assert cache.meta['key'] == key and len(cache) == len(capacity_hw)
+            except Exception:
+                cls.create(path, key, capacity_hw)
+                cache = cls(path, mode='r+')
+            if not cache.complete:
+                if unlink_at_exit:
+                    atexit.register(cache.unlink)  # the builder removes the RAM backed file, mappings stay valid
+                logging.info(f'{prefix}Caching {int((cache.done == 0).sum())} images into {path}')
+                cache.fill(load_fn, threads, prefix)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
+        return cls(path, mode='r')
+
+    def unlink(self):
+        for p in (self.path, self.path.with_name(self.path.name + '.lock')):
+            try:
+                p.unlink()
+            except OSError:
+                pass
+
+
+def ram_cache(img_files, shapes, img_size, load_fn, threads=8, tag='', prefix=''):
+    # Node-local cache in /dev/shm shared by all DDP ranks and dataloader workers, one copy per node. 'tag' keys
+    # anything else that changes the decoded pixels, i.e. reduced-resolution decoding
+    key = cache_key(img_files, img_size, tag)
+    path = shm_dir() / f'efficientteacher_{key[:16]}.imgs'
+    return ImageCache.open_or_build(path, key, resized_hw(shapes, img_size), load_fn, threads, prefix,
+                                    unlink_at_exit=True)
+
+
+def disk_cache(path, img_files, shapes, img_size, fingerprint, load_fn, threads=8, tag='', prefix=''):
+    # Persistent cache file next to the label cache, rebuilt when the label cache fingerprint changes and resumed
+    # when a previous build was interrupted
+    key = cache_key(img_files, img_size, fingerprint, tag)
+    return ImageCache.open_or_build(path, key, resized_hw(shapes, img_size), load_fn, threads, prefix)
+
+
+class LRUImageCache:
+    """ Bounded least-recently-used cache of load_image() results, keyed by dataset index
+
+    Each dataloader worker process holds its own copy. Mosaic partners can be drawn from the cached keys with
+    random_key(), and the hit rate is logged every 'report' lookups.
+    """
+
+    def __init__(self, capacity_mb, report=10000, prefix=''):
+        self.capacity = int(capacity_mb * 2 ** 20)  # bytes
+        self.items = OrderedDict()  # index -> (im, hw_original, hw_resized), least recently used first
+        self.keys, self.pos = [], {}  # cached indices for O(1) random picks
+        self.nbytes = 0
+        self.hits, self.misses = 0, 0
+        self.report = report
+        self.prefix = prefix
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, i):
+        x = self.items.get(i)
+        if x is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.items.move_to_end(i)
+        if self.report and (self.hits + self.misses) % self.report == 0:
+            logging.info(f'{self.prefix}{self}')
+        return x
+
+    def put(self, i, x):
+        im = x[0]
+        if i in self.items or im.nbytes > self.capacity:
+            return
+        im.setflags(write=False)  # shared by later lookups, like the read-only packed cache
+        self.items[i] = x
+        self.pos[i] = len(self.keys)
+        self.keys.append(i)
+        self.nbytes += im.nbytes
+        while self.nbytes > self.capacity:
+            j, (old, _, _) = self.items.popitem(last=False)
+            self.nbytes -= old.nbytes
+            k = self.pos.pop(j)  # swap-remove from keys
+            last = self.keys.pop()
+            if last != j:
+                self.keys[k] = last
+                self.pos[last] = k
+
+    def random_key(self):
+        return random.choice(self.keys)
+
+    def hit_rate(self):
+        return self.hits / max(self.hits + self.misses, 1)
+
+    def __str__(self):
+        return f'LRU image cache (pid {os.getpid()}): {self.hit_rate():.1%} hit rate over {self.hits + self.misses} ' \
+               f'lookups, {len(self)} images, {self.nbytes / 2 ** 20:.0f}/{self.capacity / 2 ** 20:.0f} MB'
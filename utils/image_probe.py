@@ -0,0 +1,110 @@
+# EfficientTeacher by Alibaba Cloud
+"""
+Header-only image probing and load-time quarantine of corrupt images
+
+probe_image() reads the (w, h) size and EXIF orientation of JPEG, PNG and BMP files from their headers without
+decoding pixel data, so a first-run dataset scan costs a few small reads per image instead of a full decode. Images
+that turn out to be corrupt when they are first decoded are appended to a quarantine list next to the label cache and
+fully re-verified by the next scan.
+"""
+
+import logging
+import os
+import struct
+
+JPEG_SOF = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}  # start of frame markers
+
+
+class CorruptImageError(Exception):
+    """ Raised by load_image() for an image that can not be decoded or does not match its cached shape """
+    pass
+
+
+def _exif_orientation(tiff):
+    # Orientation tag (0x0112) of IFD0 in a TIFF/EXIF block, 1 if absent
+    endian = {b'II': '<', b'MM': '>'}.get(tiff[:2])
+    if endian is None or len(tiff) < 8:
+        return 1
+    ifd = struct.unpack(endian + 'I', tiff[4:8])[0]
+    if ifd + 2 > len(tiff):
+        return 1
+    n = struct.unpack(endian + 'H', tiff[ifd:ifd + 2])[0]
+    for i in range(n):
+        entry = tiff[ifd + 2 + 12 * i:ifd + 14 + 12 * i]
+        if len(entry) < 12:
+            break
+        tag, typ = struct.unpack(endian + 'HH', entry[:4])
+        if tag == 0x0112:
+            return struct.unpack(endian + 'H', entry[8:10])[0] if typ == 3 else 1
+    return 1
+
+
+def _probe_jpeg(f):
+    # Walk the JPEG markers up to the first start of frame, reading APP1 EXIF on the way
+    orientation = 1
+    while True:
+        b = f.read(1)
+        while b == b'\xff':  # fill bytes
+            b = f.read(1)
+        if not b:
+            raise ValueError('truncated JPEG header')
+        marker = b[0]
+        if marker in (0x01, *range(0xD0, 0xD8)):  # standalone markers
+            continue
+        if marker in (0xD9, 0xDA):
+            raise ValueError('no JPEG start of frame before image data')
+        size = struct.unpack('>H', f.read(2))[0]
+        if marker in JPEG_SOF:
+            h, w = struct.unpack('>xHH', f.read(5))
+            return w, h, orientation
+        if marker == 0xE1:
+            data = f.read(size - 2)
+            if data[:6] == b'Exif\0\0':
+                orientation = _exif_orientation(data[6:])
+        else:
+            f.seek(size - 2, os.SEEK_CUR)
+        if f.read(1) != b'\xff':
+            raise ValueError('invalid JPEG marker')
+
+
+def probe_image(path):
+    # Returns (format, (w, h) exif-corrected) from the file header, None for formats that are not parsed here
+    with open(path, 'rb') as f:
+        head = f.read(26)
+        if head[:3] == b'\xff\xd8\xff':
+            f.seek(3)
+            w, h, orientation = _probe_jpeg(f)
+            if orientation in (5, 6, 7, 8):  # rotated 90 or 270 degrees
+                w, h = h, w
+            return 'jpeg', (w, h)
+        if head[:8] == b'\x89PNG\r\n\x1a\n' and head[12:16] == b'IHDR':
+            f.seek(16)
+            w, h = struct.unpack('>II', f.read(8))
+            return 'png', (w, h)
+        if head[:2] == b'BM':
+            header_size = struct.unpack('<I', head[14:18])[0]
+            if header_size == 12:  # BITMAPCOREHEADER
+                w, h = struct.unpack('<HH', head[18:22])
+            else:
+                w, h = struct.unpack('<ii', head[18:26])
+            return 'bmp', (abs(w), abs(h))
+    return None
+
+
+def read_quarantine(path):
+    # Image files listed in a quarantine file, empty set if there is none
+    try:
+        with open(path, 'r') as f:
+            return {line.split('\t')[0] for line in f.read().splitlines() if line}
+    except OSError:
+        return set()
+
+
+def quarantine_image(path, im_file, reason, prefix=''):
+    # Append im_file to the quarantine list, safe to call from any dataloader worker
+    logging.info(f'{prefix}WARNING: {im_file}: quarantined corrupt image: {reason}')
+    try:
+        with open(path, 'a') as f:
+            f.write(f'{im_file}\t{reason}\n')  # one short O_APPEND write per image, atomic between processes
+    except OSError:
+        pass
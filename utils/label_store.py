@@ -0,0 +1,327 @@
+# EfficientTeacher by Alibaba Cloud
+"""
+Packed label store, a memory-mapped replacement for the pickled *.cache dict
+
+File layout (all sections 64-byte aligned, little endian):
+    MAGIC | uint64 header length | JSON header | section 0 | section 1 | ...
+The JSON header holds the store version, free-form dataset meta (fingerprint, results, msgs, cache version) and the
+offset/dtype/shape of every section. Sections are opened read-only with np.memmap, so opening a store is O(1) in
+dataset size and all DDP ranks and dataloader workers on a node share the same page-cache pages.
+"""
+
+import hashlib
+import json
+import os
+from multiprocessing.pool import ThreadPool
+from pathlib import Path
+
+import numpy as np
+
+MAGIC = b'ETLSTORE'
+STORE_VERSION = 1
+ALIGN = 64
+
+
+def _align(n):
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+
+def pack_strings(strings):
+    # Pack a list of str into (uint8 bytes, int64 offsets[n + 1])
+    encoded = [s.encode('utf-8', 'surrogateescape') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8).copy(), offsets
+
+
+def pack_labels(img_files, label_files, labels, shapes, segments, ncols=5):
+    # Pack per-image labels (list of (n_i, ncols) arrays), wh shapes and segments into flat section arrays
+    n = len(img_files)
+    counts = np.array([len(l) for l in labels], dtype=np.int64)
+    label_offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(counts, out=label_offsets[1:])
+    if n and label_offsets[-1]:
+        ncols = max(l.shape[1] for l in labels if len(l))
+    flat = np.zeros((int(label_offsets[-1]), ncols), dtype=np.float32)
+    for l, a, b in zip(labels, label_offsets[:-1], label_offsets[1:]):
+        if b > a:
+            flat[a:b, :l.shape[1]] = l
+
+    # segments: image -> segment offsets, segment -> point offsets
+    seg_points = [np.asarray(s, dtype=np.float32).reshape(-1, 2) for segs in segments for s in segs]
+    image_segment_offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum([len(segs) for segs in segments], out=image_segment_offsets[1:])
+    segment_offsets = np.zeros(len(seg_points) + 1, dtype=np.int64)
+    np.cumsum([len(s) for s in seg_points], out=segment_offsets[1:])
+    points = np.concatenate(seg_points, 0) if seg_points else np.zeros((0, 2), dtype=np.float32)
+
+    paths, path_offsets = pack_strings(img_files)
+    label_paths, label_path_offsets = pack_strings(label_files)
+    return {'labels': flat,
+            'label_offsets': label_offsets,
+            'shapes': np.asarray(shapes, dtype=np.float64).reshape(-1, 2),
+            'paths': paths,
+            'path_offsets': path_offsets,
+            'label_paths': label_paths,
+            'label_path_offsets': label_path_offsets,
+            'segments': points,
+            'segment_offsets': segment_offsets,
+            'image_segment_offsets': image_segment_offsets}
+
+
+def write_label_store(path, sections, meta):
+    # Write sections + meta to 'path' atomically (temp file + rename)
+    path = Path(path)
+    layout, offset = {}, 0
+    for k, v in sections.items():
+        v = np.ascontiguousarray(v)
+        layout[k] = {'offset': offset, 'dtype': v.dtype.str, 'shape': list(v.shape)}
+        offset = _align(offset + v.nbytes)
+    header = json.dumps({'version': STORE_VERSION, 'meta': meta, 'sections': layout}).encode()
+    base = _align(len(MAGIC) + 8 + len(header))
+
+    tmp = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+    with open(tmp, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.uint64(len(header)).tobytes())
+        f.write(header)
+        for k, v in sections.items():
+            f.seek(base + layout[k]['offset'])
+            f.write(np.ascontiguousarray(v).tobytes())
+        f.truncate(base + offset)
+    os.replace(tmp, path)
+
+
+def _stat(path):
+    try:
+        st = os.stat(path)
+        return st.st_size, st.st_mtime_ns
+    except OSError:
+        return -1, -1
+
+
+def file_stats(paths, threads=8):
+    # (n, 2) int64 [size, mtime_ns] of every path, [-1, -1] for missing files. Threaded for network filesystems
+    with ThreadPool(threads) as pool:
+        stats = pool.map(_stat, paths, chunksize=4096)
+    return np.array(stats, dtype=np.int64).reshape(-1, 2)
+
+
+def dir_fingerprint(*path_lists):
+    # Cheap fingerprint of file lists: md5 of the paths plus the mtime of every parent directory. Adding, removing or
+    # renaming files changes the directory mtime, so this needs one stat per directory instead of one per file.
+    # Files rewritten in place keep their directory mtime, use file_stats() to catch those
+    h, dirs = hashlib.md5(), set()
+    for paths in path_lists:
+        h.update('\n'.join(paths).encode('utf-8', 'surrogateescape'))
+        dirs.update(map(os.path.dirname, paths))
+    for d in sorted(dirs):
+        h.update(f'{d}:{_stat(d)[1]}'.encode('utf-8', 'surrogateescape'))
+    return h.hexdigest()
+
+
+def is_label_store(path):
+    # True if 'path' starts with the packed label store magic
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+
+class PackedArrays:
+    """ Read-only sequence of per-image arrays backed by one flat array plus int64 offsets
+
+    Supports len(), indexing, iteration and np.concatenate() like the list of arrays it replaces. Reordering and
+    column selection return new views; the underlying flat array is never copied.
+    """
+
+    def __init__(self, data, offsets, order=None, cols=None, fill_cls=None):
+        self.data = data  # (N, ncols) flat rows
+        self.offsets = offsets  # (n + 1,) row offsets per image
+        self.order = order  # optional (n,) int64 index map, i.e. rect sort
+        self.cols = cols  # optional column selection
+        self.fill_cls = fill_cls  # optional constant written into column 0 on access, i.e. single_cls
+
+    def __len__(self):
+        return len(self.order) if self.order is not None else len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        j = self.order[i] if self.order is not None else i
+        x = self.data[self.offsets[j]:self.offsets[j + 1]]
+        if self.fill_cls is not None:
+            x = x.copy()
+            x[:, 0] = self.fill_cls
+        return x if self.cols is None else x[:, self.cols]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def replace(self, **kwargs):
+        # Copy of this view with some attributes replaced, i.e. labels.replace(fill_cls=0)
+        args = dict(data=self.data, offsets=self.offsets, order=self.order, cols=self.cols, fill_cls=self.fill_cls)
+        args.update(kwargs)
+        return PackedArrays(**args)
+
+    def take(self, index):
+        # Reordered view, index into the current order
+        index = np.asarray(index, dtype=np.int64)
+        return self.replace(order=index if self.order is None else self.order[index])
+
+    def columns(self, cols):
+        # Column-selected view, i.e. labels.columns(slice(0, 5))
+        return self.replace(cols=cols)
+
+    def filter_rows(self, keep):
+        # New in-memory view keeping only flat rows where keep (bool mask over self.data rows) is True
+        image = np.repeat(np.arange(len(self.offsets) - 1), np.diff(self.offsets))  # image index of every row
+        offsets = np.zeros_like(self.offsets)
+        np.cumsum(np.bincount(image[keep], minlength=len(self.offsets) - 1), out=offsets[1:])
+        return self.replace(data=np.ascontiguousarray(self.data[keep]), offsets=offsets)
+
+    def counts(self):
+        # Number of rows per image in the current order
+        n = np.diff(self.offsets)
+        return n if self.order is None else n[self.order]
+
+    def image_index(self):
+        # Image index (in the current order) of every row of concat()
+        return np.repeat(np.arange(len(self)), self.counts())
+
+    def concat(self):
+        # All rows as one array in the current order, equivalent to np.concatenate(self, 0) without a Python loop
+        if self.order is None:
+            x = self.data[self.offsets[0]:self.offsets[-1]]
+        else:
+            n = self.counts()
+            start = np.asarray(self.offsets)[self.order] - np.concatenate(([0], np.cumsum(n)[:-1]))
+            x = self.data[np.repeat(start, n) + np.arange(n.sum())]
+        if self.fill_cls is not None:
+            x = x.copy()
+            x[:, 0] = self.fill_cls
+        return x if self.cols is None else x[:, self.cols]
+
+
+class PackedStrings:
+    """ Read-only sequence of str backed by a uint8 string table plus int64 offsets """
+
+    def __init__(self, data, offsets, order=None):
+        self.data = data
+        self.offsets = offsets
+        self.order = order
+
+    def __len__(self):
+        return len(self.order) if self.order is not None else len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        j = self.order[i] if self.order is not None else i
+        return self.data[self.offsets[j]:self.offsets[j + 1]].tobytes().decode('utf-8', 'surrogateescape')
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __add__(self, other):
+        return list(self) + list(other)
+
+    def __radd__(self, other):
+        return list(other) + list(self)
+
+    def take(self, index):
+        index = np.asarray(index, dtype=np.int64)
+        return PackedStrings(self.data, self.offsets, index if self.order is None else self.order[index])
+
+
+class PackedSegments:
+    """ Read-only sequence of per-image segment lists, each segment a (k, 2) float32 array """
+
+    def __init__(self, points, segment_offsets, image_segment_offsets, order=None):
+        self.points = points
+        self.segment_offsets = segment_offsets
+        self.image_segment_offsets = image_segment_offsets
+        self.order = order
+
+    def __len__(self):
+        return len(self.order) if self.order is not None else len(self.image_segment_offsets) - 1
+
+    def __getitem__(self, i):
+        j = self.order[i] if self.order is not None else i
+        so = self.segment_offsets
+        return [self.points[so[k]:so[k + 1]] for k in range(self.image_segment_offsets[j], self.image_segment_offsets[j + 1])]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def take(self, index):
+        index = np.asarray(index, dtype=np.int64)
+        return PackedSegments(self.points, self.segment_offsets, self.image_segment_offsets,
+                              index if self.order is None else self.order[index])
+
+
+class LabelStore:
+    """ Packed, versioned label store. Use LabelStore.open(path) for the memory-mapped on-disk form """
+
+    def __init__(self, sections, meta):
+        self.sections = sections
+        self.meta = meta
+
+    @classmethod
+    def open(cls, path):
+        with open(path, 'rb') as f:
+            assert f.read(len(MAGIC)) == MAGIC, f'{path} is not a packed label store'
+            n = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+            header = json.loads(f.read(n).decode())
+        assert header['version'] == STORE_VERSION, f"label store version {header['version']} != {STORE_VERSION}"
+        base = _align(len(MAGIC) + 8 + n)
+        sections = {}
+        for k, s in header['sections'].items():
+            dtype, shape = np.dtype(s['dtype']), tuple(s['shape'])
+            if int(np.prod(shape)) == 0:
+                sections[k] = np.zeros(shape, dtype=dtype)  # np.memmap() can not map 0 bytes
+            else:
+                sections[k] = np.memmap(path, dtype=dtype, mode='r', offset=base + s['offset'], shape=shape)
+        return cls(sections, header['meta'])
+
+    def save(self, path):
+        write_label_store(path, self.sections, self.meta)
+
+    def __len__(self):
+        return len(self.sections['label_offsets']) - 1
+
+    def match(self, img_files, label_files, img_stats, label_stats):
+        # Index into this store of every (image, label) pair whose files are unchanged since it was written, else -1
+        index = {f: i for i, f in enumerate(self.img_files)}
+        old_label_files = self.label_files
+        out = np.full(len(img_files), -1, dtype=np.int64)
+        for k, (im_file, lb_file) in enumerate(zip(img_files, label_files)):
+            i = index.get(im_file, -1)
+            if i >= 0 and old_label_files[i] == lb_file:
+                out[k] = i
+        ok = out >= 0
+        same = (self.sections['img_stats'][out[ok]] == img_stats[ok]).all(1) & \
+               (self.sections['label_stats'][out[ok]] == label_stats[ok]).all(1)
+        out[np.flatnonzero(ok)[~same]] = -1
+        return out
+
+    @property
+    def labels(self):
+        return PackedArrays(self.sections['labels'], self.sections['label_offsets'])
+
+    @property
+    def shapes(self):
+        return self.sections['shapes']
+
+    @property
+    def img_files(self):
+        return PackedStrings(self.sections['paths'], self.sections['path_offsets'])
+
+    @property
+    def label_files(self):
+        return PackedStrings(self.sections['label_paths'], self.sections['label_path_offsets'])
+
+    @property
+    def segments(self):
+        return PackedSegments(self.sections['segments'], self.sections['segment_offsets'],
+                              self.sections['image_segment_offsets'])
@@ -22,11 +22,12 @@ import torchvision
 import cv2
 import numpy as np
 import random
-from utils.general import clip_coords, xyxy2xywh, xywh2xyxy, xywhn2xyxy, non_max_suppression, box_iou
+from utils.batch_augment import warp_pseudo_labels
+from utils.general import clip_coords, xyxy2xywh, xywhn2xyxy, non_max_suppression, box_iou
 from utils.general import non_max_suppression_ssod
 from utils.plots import plot_images_ssod, plot_images, plot_labels,  output_to_target_ssod
+from utils.step_profiler import NullProfiler
 from utils.torch_utils import time_sync
-from utils.self_supervised_utils import online_label_transform
 import copy
 import matplotlib.pyplot as plt
 import sklearn.mixture as skm
@@ -54,6 +55,9 @@ def concat_all_gather(tensor, dim=0):
     return output
 
 class LabelMatch(nn.Module):
+    RESUME_ATTRS = ('score_list', 'score_list_epoch', 'start_update', 'cls_thr_high', 'cls_thr_low', 'cls_num_list',
+                    'count', 'pse_count', 'cls_tmp', 'cls_num_total')  # running state besides the buffers
+
     def __init__(self, cfg, target_data_len, label_num_per_img, cls_ratio_gt):
         super().__init__()
         self.nc = cls_ratio_gt.shape[0]
@@ -94,9 +98,20 @@ class LabelMatch(nn.Module):
 
         self.cls_tmp = np.zeros(self.nc)
         self.cls_num_total = np.zeros(self.nc)
+        self.profiler = NullProfiler()  # the trainer's StepProfiler when profiling
         # print('total pseudo label numb:', target_data_len * label_num_per_img, 'pos_high:', self.pos_location_high)
         # print(self.pos_location_low)
     
+    def resume_state(self):
+        # Queues, score lists and class statistics of the running epoch, for iteration checkpoints
+        return {'buffers': {k: v.cpu() for k, v in self.state_dict().items()},
+                **{k: deepcopy(getattr(self, k)) for k in self.RESUME_ATTRS}}
+
+    def load_resume_state(self, state):
+        self.load_state_dict(state['buffers'])
+        for k in self.RESUME_ATTRS:
+            setattr(self, k, state[k])
+
     def _dequeue_and_enqueue(self, score):
         """update score queue"""
         print('check device:', score[0, :])
@@ -127,11 +142,8 @@ class LabelMatch(nn.Module):
         # self.val = val
         self.count += n
         self.pse_count += pse_n
-        for l in labels:
-            # for l in label:
-                # self.cls_tmp[int(l[0:1])] += 1
-            # print(l)
-            self.cls_tmp[int(l[1:2])] += 1
+        cls = torch.as_tensor(labels)[:, 1].long().cpu().numpy()  # one device sync instead of one per label
+        self.cls_tmp += np.bincount(cls, minlength=self.nc)[:self.nc]
         # label_num_per_img = np.sum(self.cls_tmp) / self.count
         # print('label_num_per_img:', label_num_per_img)
     
@@ -277,6 +289,7 @@ class LabelMatch(nn.Module):
         # 利用非极大值抑制在线计算可靠的过滤阈值
         pseudo_out = non_max_suppression_ssod(out, conf_thres=self.nms_conf_thres, iou_thres=self.nms_iou_thres,\
              labels=lb, num_points=self.num_points, multi_label=self.multi_label)
+        self.profiler.lap('nms')
 
         refine_out = []
         score_list_batch = [[] for _ in range(self.nc)]
@@ -315,33 +328,8 @@ class LabelMatch(nn.Module):
             return target_out_targets_perspective, invalid_target_shape
 
         if(target_shape[0] > 0 and target_shape[1] > 6):
-            for i, img in enumerate(target_imgs_ori):
-                image_targets = refine_out[refine_out[:, 0] == i]
-                if isinstance(image_targets, torch.Tensor):
-                    image_targets = image_targets.cpu().numpy()
-                image_targets[:, 2:6] = xywh2xyxy(image_targets[:, 2:6])
-                M_select = M_s[M_s[:, 0] == i, :]  # image targets
-                M = M_select[0][1:10].reshape([3,3]).cpu().numpy()
-                s = float(M_select[0][10])
-                ud = int(M_select[0][11])
-                lr = int(M_select[0][12])
-                # img, image_targets_random = self.online_label_transform_with_image(img, copy.deepcopy(image_targets[:, 1:]),  M, s, ud, lr)
-                img, image_targets_random = online_label_transform(img, copy.deepcopy(image_targets[:, 1:]),  M, s)
-                # img_list.append(img)
-               
-                image_targets = np.array(image_targets_random)
-                if image_targets.shape[0] != 0:
-                    image_targets = np.concatenate((np.array(np.ones([image_targets.shape[0], 1]) * i), np.array(image_targets)), 1)
-                    image_targets[:, 2:6] = xyxy2xywh(image_targets[:, 2:6])  # convert xyxy to xywh
-                    image_targets[:, [3, 5]] /= height # normalized height 0-1
-                    image_targets[:, [2, 4]] /= width # normalized width 0-1
-                    image_targets[:, 2:6] = image_targets[:, 2:6].clip(0, 1)
-                    if ud == 1:
-                        image_targets[:, 3] = 1 - image_targets[:, 3]
-                    if lr == 1:
-                        image_targets[:, 2] = 1 - image_targets[:, 2]
-                    target_out_targets_perspective.extend(image_targets.tolist())
-            target_out_targets_perspective = torch.from_numpy(np.array(target_out_targets_perspective))
+            # one batched transform through every image's M_s row instead of a loop over images
+            target_out_targets_perspective = warp_pseudo_labels(refine_out, M_s, (height, width))
         # img_list = torch.stack(img_list, 0)
         # if self.RANK in [-1, 0]:
             # print('total time cost:', time_sync() - total_t1)
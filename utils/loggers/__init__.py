@@ -92,6 +92,12 @@ class Loggers():
                 files = sorted(self.save_dir.glob('train*.jpg'))
                 self.wandb.log({'Mosaics': [wandb.Image(str(f), caption=f.name) for f in files if f.exists()]})
 
+    def on_train_step_profile(self, ni, stats):
+        # Callback runs every profile_period train batches with the step phase percentiles (ms)
+        if self.tb:
+            for phase, v in stats.items():
+                self.tb.add_scalars(f'profile/{phase}', v, ni)
+
     def on_train_epoch_end(self, epoch):
         # Callback runs on train epoch end
         if self.wandb:
@@ -0,0 +1,89 @@
+# EfficientTeacher by Alibaba Cloud
+"""
+Compiled dataset manifests for the 'a.txt||dir*3' dataset spec syntax
+
+A manifest is a LabelStore file (see utils/label_store.py) holding the resolved spec once: deduplicated image paths
+in sorted order, their label paths, '*N' repeat counts as per-image sampling weights and header-probed (w, h) image
+shapes (-1 where the header could not be read). Pass the manifest file as Dataset.train / val / target and every rank
+maps it instead of re-globbing directories, re-reading list files and sorting duplicated path strings. With
+Dataset.fast_scan the label scan takes the image shapes from the manifest instead of probing the headers again, so
+recompile the manifest after replacing images.
+
+Usage:
+    $ compile-manifest 'data/a.txt||data/images*3' data/train.manifest
+    $ python -m utils.manifest 'data/a.txt||data/images*3' data/train.manifest
+"""
+
+import argparse
+import logging
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+from tqdm import tqdm
+
+from utils.general import set_logging
+from utils.image_probe import probe_image
+from utils.label_store import LabelStore, PackedStrings, is_label_store, pack_strings
+
+MANIFEST_KIND = 'manifest'
+MANIFEST_VERSION = 1
+
+
+def is_manifest(path):
+    # True if 'path' is a file written by write_manifest()
+    try:
+        return is_label_store(path) and LabelStore.open(path).meta.get('kind') == MANIFEST_KIND
+    except Exception:
+        return False
+
+
+def write_manifest(path, img_files, label_files, weights, shapes, spec=''):
+    paths, path_offsets = pack_strings(img_files)
+    label_paths, label_path_offsets = pack_strings(label_files)
+    sections = {'paths': paths, 'path_offsets': path_offsets,
+                'label_paths': label_paths, 'label_path_offsets': label_path_offsets,
+                'weights': np.asarray(weights, dtype=np.int32),  # '*N' repeat count of every image
+                'shapes': np.asarray(shapes, dtype=np.int32).reshape(-1, 2)}  # wh, -1 if unknown
+    LabelStore(sections, {'kind': MANIFEST_KIND, 'version': MANIFEST_VERSION, 'spec': spec}).save(path)
+
+
+def load_manifest(path):
+    # Returns (img_files, label_files, weights, shapes) of a manifest
+    store = LabelStore.open(path)
+    assert store.meta['version'] == MANIFEST_VERSION, f"manifest version {store.meta['version']} != {MANIFEST_VERSION}"
+    s = store.sections
+    img_files = list(PackedStrings(s['paths'], s['path_offsets']))
+    label_files = list(PackedStrings(s['label_paths'], s['label_path_offsets']))
+    return img_files, label_files, np.asarray(s['weights']), np.asarray(s['shapes'])
+
+
+def _probe(path):
+    try:
+        return probe_image(path)[1]
+    except Exception:  # unreadable or a format without a parsed header
+        return -1, -1
+
+
+def compile_manifest(spec, out, threads=8, prefix=''):
+    # Resolve 'spec' once and write it to the manifest file 'out'
+    from utils.datasets import resolve_dataset_spec  # utils.datasets loads manifests, import here to avoid a cycle
+    img_files, label_files, weights, _ = resolve_dataset_spec(spec, prefix)
+    with ThreadPool(threads) as pool:
+        shapes = list(tqdm(pool.imap(_probe, img_files, chunksize=256), desc=f'{prefix}Probing image headers',
+                           total=len(img_files)))
+    write_manifest(out, img_files, label_files, weights, shapes, spec=spec if isinstance(spec, str) else '||'.join(spec))
+    logging.info(f'{prefix}{len(img_files)} images ({int(weights.sum())} with repeats) written to {out}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compile a dataset spec, i.e. 'a.txt||dir*3', into a manifest file")
+    parser.add_argument('spec', type=str, help="dataset spec, list files and directories joined by '||', '*N' repeats")
+    parser.add_argument('out', type=str, help='output manifest file')
+    parser.add_argument('--threads', type=int, default=8, help='header probing threads')
+    opt = parser.parse_args()
+    set_logging()
+    compile_manifest(opt.spec, opt.out, opt.threads, prefix='manifest: ')
+
+
+if __name__ == '__main__':
+    main()
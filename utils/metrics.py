@@ -350,13 +350,12 @@ def plot_mc_curve(px, py, save_dir='mc_curve.png', names=(), xlabel='Confidence'
     plt.close()
 
 class AverageMeter:
-    """Computes and stores the average and current value"""
+    """Computes and stores the average and current value, tensors are accumulated on their device"""
     def __init__(self):
         self.reset()
 
     def reset(self):
         self.val = 0
-        self.avg = 0
         self.sum = 0
         self.count = 0
 
@@ -364,7 +363,10 @@ class AverageMeter:
         self.val = val
         self.sum += val * n
         self.count += n
-        self.avg = self.sum / self.count
+
+    @property
+    def avg(self):
+        return self.sum / max(self.count, 1)
 
 
 class MetricMeter(object):
@@ -382,8 +384,10 @@ class MetricMeter(object):
         >>> print(str(metric))
     """
 
-    def __init__(self, delimiter='\t'):
+    def __init__(self, names=(), delimiter='\t'):
         self.meters = defaultdict(AverageMeter)
+        for name in names:  # declared columns first, in order
+            self.meters[name]
         self.delimiter = delimiter
 
     def update(self, input_dict):
@@ -397,21 +401,24 @@ class MetricMeter(object):
 
         for k, v in input_dict.items():
             if isinstance(v, torch.Tensor):
-                v = v.item()
+                v = v.detach().sum()  # stays on the device, synced by get_avg()
             self.meters[k].update(v)
 
     def __str__(self):
         output_str = []
         for name, meter in self.meters.items():
             output_str.append(
-                '{} {:.4f} ({:.4f})'.format(name, meter.val, meter.avg)
+                '{} {:.4f} ({:.4f})'.format(name, float(meter.val), float(meter.avg))
             )
         return self.delimiter.join(output_str)
     
     def get_avg(self):
-        res = []
-        for name, meter in self.meters.items():
-            res.append(meter.avg)
+        # Averages as floats, one device sync for all tensor meters
+        res = [meter.avg for meter in self.meters.values()]
+        t = [i for i, x in enumerate(res) if isinstance(x, torch.Tensor)]
+        if t:
+            for i, x in zip(t, torch.stack([res[i].float().to(res[t[0]].device) for i in t]).tolist()):
+                res[i] = x
         return res
 
 def poly2hbb(polys):
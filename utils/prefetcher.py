@@ -0,0 +1,132 @@
+# EfficientTeacher by Alibaba Cloud
+"""
+Device prefetcher, stages the next batches on the device while the current one is being computed
+
+The training and validation loops used to copy every batch with .to(device, non_blocking=True).float() / 255 right
+before the forward pass, so the copy and the conversion serialized with compute. DevicePrefetcher runs a preprocessing
+function (copy, uint8 to float, norm_scale, batched augmentation) 'depth' batches ahead: on a side CUDA stream on GPU,
+on a background thread on CPU. The time the loop spends waiting for data is accumulated, a high share of the epoch
+means training is input-bound. position() is the number of loader batches the loop has actually received, the loader
+itself is ahead by the staged batches. On GPU a CUDA event marking the end of fn(batch) is passed to loader.copied()
+where the loader has it, so that the loader reuses the host memory of the batch only after the copy.
+"""
+
+import queue
+import threading
+import time
+from collections import deque
+
+import torch
+
+
+class DevicePrefetcher:
+    """ Iterate fn(batch) over the batches of 'loader' (over and over with forever=True), staged 'depth' batches ahead,
+    depth=0 runs fn inline """
+
+    def __init__(self, loader, fn, device, depth=1, forever=False):
+        self.loader, self.fn, self.depth, self.forever = loader, fn, depth, forever
+        self.stream = torch.cuda.Stream(device) if device.type == 'cuda' and depth > 0 else None
+        self.copied = getattr(loader, 'copied', None) if device.type == 'cuda' else None  # InfiniteDataLoader.copied()
+        self.wait, self.t0 = 0.0, time.time()
+        self.base, self.handed = None, 0  # loader position when iteration started, batches handed to the loop since
+
+    def position(self):
+        # Batches of the loader consumed by the loop, InfiniteDataLoader.skip() resumes from here
+        return getattr(self.loader, 'batches', 0) if self.base is None else self.base + self.handed
+
+    def stats(self, reset=True):
+        # (seconds waited for data, seconds elapsed) since the last reset
+        s = self.wait, time.time() - self.t0
+        if reset:
+            self.wait, self.t0 = 0.0, time.time()
+        return s
+
+    def __iter__(self):
+        self.base, self.handed = getattr(self.loader, 'batches', 0), 0
+        if self.depth <= 0:
+            return self._inline()
+        return self._streamed() if self.stream is not None else self._threaded()
+
+    def _batches(self):
+        while True:
+            yield from self.loader
+            if not self.forever:
+                return
+
+    def _next(self, it):
+        t = time.time()
+        batch = next(it, None)
+        self.wait += time.time() - t
+        return batch
+
+    def _inline(self):
+        it = self._batches()
+        while True:
+            batch = self._next(it)
+            if batch is None:
+                return
+            batch = self.fn(batch)
+            if self.copied is not None:
+                event = torch.cuda.Event()
+                event.record()
+                self.copied(event)
+            self.handed += 1
+            yield batch
+
+    def _stage(self, it, staged):
+        # Preprocess the next batch on the side stream, an event marks its completion
+        batch = self._next(it)
+        if batch is not None:
+            with torch.cuda.stream(self.stream):
+                batch = self.fn(batch)
+                event = torch.cuda.Event()
+                event.record(self.stream)
+            if self.copied is not None:
+                self.copied(event)
+            staged.append((event, batch))
+
+    def _streamed(self):
+        it, staged = self._batches(), deque()
+        for _ in range(self.depth):
+            self._stage(it, staged)
+        while staged:
+            event, batch = staged.popleft()
+            stream = torch.cuda.current_stream()
+            stream.wait_event(event)
+            for x in batch:
+                if isinstance(x, torch.Tensor) and x.is_cuda:
+                    x.record_stream(stream)  # allocated on the side stream, used on the compute stream
+            self._stage(it, staged)  # queued before the consumer's compute, overlaps with it
+            self.handed += 1
+            yield batch
+
+    def _threaded(self):
+        q, stop, done = queue.Queue(maxsize=self.depth), threading.Event(), object()
+
+        def work():
+            try:
+                for batch in self._batches():
+                    q.put(self.fn(batch))
+                    if stop.is_set():
+                        break
+            except Exception as e:
+                q.put(e)
+            if not stop.is_set():
+                q.put(done)
+
+        threading.Thread(target=work, daemon=True).start()
+        try:
+            while True:
+                t = time.time()
+                x = q.get()
+                self.wait += time.time() - t
+                if x is done:
+                    return
+                if isinstance(x, Exception):
+                    raise x
+                self.handed += 1
+                yield x
+        finally:  # consumer stopped early, unblock the worker
+            stop.set()
+            while not q.empty():
+                q.get_nowait()
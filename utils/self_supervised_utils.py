@@ -23,9 +23,11 @@ import torchvision
 import cv2
 import numpy as np
 import random
-from utils.general import clip_coords, xyxy2xywh, xywh2xyxy, xywhn2xyxy, non_max_suppression, box_iou
+from utils.batch_augment import warp_pseudo_labels
+from utils.general import clip_coords, xywh2xyxy, xywhn2xyxy, non_max_suppression, box_iou
 from utils.general import non_max_suppression_ssod
 from utils.plots import plot_images_ssod, plot_images, plot_labels,  output_to_target_ssod
+from utils.step_profiler import NullProfiler
 from utils.torch_utils import time_sync
 import copy
 
@@ -59,6 +61,7 @@ class FairPseudoLabel:
         self.multi_label = cfg.SSOD.multi_label
         self.names = cfg.Dataset.names
         self.num_points = cfg.Dataset.np
+        self.profiler = NullProfiler()  # the trainer's StepProfiler when profiling
 
     def online_label_transform_with_image(self, img, targets, M, s, ud, lr, segments=(), border=(0, 0), perspective=0.0):
         if isinstance(img, torch.Tensor):
@@ -200,36 +203,14 @@ class FairPseudoLabel:
         out = non_max_suppression_ssod(out, conf_thres=self.nms_conf_thres, iou_thres=self.nms_iou_thres, \
                                        num_points=self.num_points, multi_label=self.multi_label, labels=lb)
         out = [out_tensor.detach() for out_tensor in out]
+        self.profiler.lap('nms')
         target_out_np = output_to_target_ssod(out)
         target_out_targets = torch.tensor(target_out_np)
         target_shape = target_out_targets.shape
 
         if(target_shape[0] > 0 and target_shape[1] > 6):
-            for i, img in enumerate(target_imgs_ori):
-                # image_targets = target_out_targets[target_out_targets[:, 0] == i]
-                image_targets = target_out_np[target_out_np[:, 0] == i]
-                if isinstance(image_targets, torch.Tensor):
-                    image_targets = image_targets.cpu().numpy()
-                image_targets[:, 2:6] = xywh2xyxy(image_targets[:, 2:6])
-                M_select = M_s[M_s[:, 0] == i, :]  # image targets
-                M = M_select[0][1:10].reshape([3,3]).cpu().numpy()
-                s = float(M_select[0][10])
-                ud = int(M_select[0][11])
-                lr = int(M_select[0][12])
-                img, image_targets_random = online_label_transform(img, copy.deepcopy(image_targets[:, 1:]),  M, s)
-               
-                image_targets = np.array(image_targets_random)
-                if image_targets.shape[0] != 0:
-                    image_targets = np.concatenate((np.array(np.ones([image_targets.shape[0], 1]) * i), np.array(image_targets)), 1)
-                    image_targets[:, 2:6] = xyxy2xywh(image_targets[:, 2:6])  # convert xyxy to xywh
-                    image_targets[:, [3, 5]] /= height # normalized height 0-1
-                    image_targets[:, [2, 4]] /= width # normalized width 0-1
-                    if ud == 1:
-                        image_targets[:, 3] = 1 - image_targets[:, 3]
-                    if lr == 1:
-                        image_targets[:, 2] = 1 - image_targets[:, 2]
-                    target_out_targets_perspective.extend(image_targets.tolist())
-            target_out_targets_perspective = torch.from_numpy(np.array(target_out_targets_perspective))
+            # one batched transform through every image's M_s row instead of a loop over images
+            target_out_targets_perspective = warp_pseudo_labels(target_out_np, M_s, (height, width))
         # img_list = torch.stack(img_list, 0)
         # if self.RANK in [-1, 0]:
             # print('total time cost:', time_sync() - total_t1)
@@ -254,44 +235,18 @@ class FairPseudoLabel:
         out = non_max_suppression_ssod(out, conf_thres=self.nms_conf_thres, iou_thres=self.nms_iou_thres, \
                                        num_points=self.num_points, multi_label=self.multi_label, labels=lb)
         out = [out_tensor.detach() for out_tensor in out]
+        self.profiler.lap('nms')
         target_out_np = output_to_target_ssod(out)
         target_out_targets = torch.tensor(target_out_np)
         target_shape = target_out_targets.shape
 
         if(target_shape[0] > 0 and target_shape[1] > 6):
-            for i, img in enumerate(target_imgs_ori):
-                # image_targets = target_out_targets[target_out_targets[:, 0] == i]
-                image_targets = target_out_np[target_out_np[:, 0] == i]
-                if isinstance(image_targets, torch.Tensor):
-                    image_targets = image_targets.cpu().numpy()
-                image_targets[:, 2:6] = xywh2xyxy(image_targets[:, 2:6])
-                M_select = M_s[M_s[:, 0] == i, :]  # image targets
-                M = M_select[0][1:10].reshape([3,3]).cpu().numpy()
-                s = float(M_select[0][10])
-                ud = int(M_select[0][11])
-                lr = int(M_select[0][12])
-                img, image_targets_random = online_label_transform(img, copy.deepcopy(image_targets[:, 1:]),  M, s)
-               
-                image_targets = np.array(image_targets_random)
-                if image_targets.shape[0] != 0:
-                    image_targets = np.concatenate((np.array(np.ones([image_targets.shape[0], 1]) * i), np.array(image_targets)), 1)
-                    image_targets[:, 2:6] = xyxy2xywh(image_targets[:, 2:6])  # convert xyxy to xywh
-                    image_targets[:, [3, 5]] /= height # normalized height 0-1
-                    image_targets[:, [2, 4]] /= width # normalized width 0-1
-                    if ud == 1:
-                        image_targets[:, 3] = 1 - image_targets[:, 3]
-                    if lr == 1:
-                        image_targets[:, 2] = 1 - image_targets[:, 2]
-                        
-                    # 通过 tar_path 路径中的标签类型改写标签
-                    pic_label_str=tar_path[i].split('/')[-2].upper()
-                    # 替换标签(不推荐)
-                    # image_targets[:,1]=str_id_mapping[pic_label_str]
-                    # 过滤标签
-                    image_targets=image_targets[image_targets[:,1]==str_id_mapping[pic_label_str]]
-                    
-                    target_out_targets_perspective.extend(image_targets.tolist())
-            target_out_targets_perspective = torch.from_numpy(np.array(target_out_targets_perspective))
+            # one batched transform through every image's M_s row instead of a loop over images
+            target_out_targets_perspective = warp_pseudo_labels(target_out_np, M_s, (height, width))
+            # 通过 tar_path 路径中的标签类型过滤标签
+            keep_cls = torch.tensor([str_id_mapping[x.split('/')[-2].upper()] for x in tar_path])
+            t = target_out_targets_perspective
+            target_out_targets_perspective = t[t[:, 1] == keep_cls[t[:, 0].long()]]
         # img_list = torch.stack(img_list, 0)
         # if self.RANK in [-1, 0]:
             # print('total time cost:', time_sync() - total_t1)
@@ -319,6 +274,7 @@ class FairPseudoLabel:
         # 提高阈值 再次筛选
         out = non_max_suppression(out, conf_thres=self.nms_conf_thres, iou_thres=self.nms_iou_thres, labels=lb, multi_label=self.multi_label)
         out = [out_tensor.detach() for out_tensor in out]
+        self.profiler.lap('nms')
         for teacher_idx, teacher_out in enumerate(extra_teacher_outs): #each teacher
             teacher_pseudo_out = non_max_suppression(teacher_out, conf_thres=self.nms_conf_thres, iou_thres=self.nms_iou_thres, labels=lb, multi_label=self.multi_label)
             for i, o in enumerate(out): #batch i
@@ -341,32 +297,8 @@ class FairPseudoLabel:
         target_out_targets = torch.tensor(target_out_np)
         target_shape = target_out_targets.shape
         if(target_shape[0] > 0 and target_shape[1] > 6):
-            for i, img in enumerate(target_imgs):
-                image_targets = target_out_targets[target_out_targets[:, 0] == i]
-                if isinstance(image_targets, torch.Tensor):
-                    image_targets = image_targets.cpu().numpy()
-                image_targets[:, 2:6] = xywh2xyxy(image_targets[:, 2:6])
-                M_select = M_s[M_s[:, 0] == i, :]  # image targets
-                M = M_select[0][1:10].reshape([3,3]).cpu().numpy()
-                s = float(M_select[0][10])
-                ud = int(M_select[0][11])
-                lr = int(M_select[0][12])
-                # img, image_targets_random = online_label_transform(img, copy.deepcopy(image_targets[:, 1:]),  M[i][0], M[i][1])
-                img, image_targets_random = online_label_transform(img, copy.deepcopy(image_targets[:, 1:]),  M, s)
-                
-                image_targets = np.array(image_targets_random)
-                # target_imgs[i] = torch.from_numpy(img.transpose(2, 0, 1)/255.0).to(self.device)
-                if image_targets.shape[0] != 0:
-                    image_targets = np.concatenate((np.array(np.ones([image_targets.shape[0], 1]) * i), np.array(image_targets)), 1)
-                    image_targets[:, 2:6] = xyxy2xywh(image_targets[:, 2:6])  # convert xyxy to xywh
-                    image_targets[:, [3, 5]] /= height # normalized height 0-1
-                    image_targets[:, [2, 4]] /= width # normalized width 0-1
-                    if ud == 1:
-                        image_targets[:, 3] = 1 - image_targets[:, 3]
-                    if lr == 1:
-                        image_targets[:, 2] = 1 - image_targets[:, 2]
-                    target_out_targets_perspective.extend(image_targets.tolist())
-            target_out_targets_perspective = torch.from_numpy(np.array(target_out_targets_perspective))
+            # one batched transform through every image's M_s row instead of a loop over images
+            target_out_targets_perspective = warp_pseudo_labels(target_out_targets, M_s, (height, width))
         if target_shape[0] > 0 and len(target_out_targets_perspective) > 0:
             invalid_target_shape = False
             if self.debug:
@@ -0,0 +1,71 @@
+# EfficientTeacher by Alibaba Cloud
+"""
+Ring of preallocated shared-memory batch buffers that dataloader workers collate straight into
+
+With the stock collate_fn a worker stacks its samples into a fresh batch tensor, the batch is moved into a new shared
+memory segment to cross the worker queue and pin_memory copies it once more into page-locked memory. SharedBatchCollate
+allocates the batch buffers once, before the workers fork. A worker copies every sample image into a slot of the ring
+and only the slot index crosses the queue next to the small label tensors, the main process hands out a view of the
+slot. With pin=True the ring is page-locked in place (cudaHostRegister), views of it copy to the GPU non-blocking.
+
+Slot ownership is static: worker w uses slots [w * k, (w + 1) * k) round robin, k = prefetch_factor + held. The
+DataLoader dispatches batches to its workers round robin with at most prefetch_factor batches in flight per worker, so
+a slot is only written again after 'held' later batches of the same worker were handed to the training loop. 'held' is
+the number of batches the consumer keeps alive at once, the current batch and the Dataset.prefetch batches staged on
+the device. The device copies out of the ring are asynchronous, so before fetching a batch InfiniteDataLoader also
+waits for the copy of the batch whose slot the fetch frees (DevicePrefetcher reports the copy events).
+"""
+
+import logging
+from collections import namedtuple
+
+import torch
+
+SharedSlot = namedtuple('SharedSlot', 'field slot n')  # placeholder of a batch field, resolved in the main process
+EMPTY = torch.empty(0, dtype=torch.uint8)
+
+
+class SharedBatchCollate:
+    """ collate_fn wrapper writing the uint8 image fields {field: per-sample shape} of a batch into a shared ring """
+
+    def __init__(self, collate_fn, shapes, batch_size, workers, prefetch_factor=2, held=2, pin=False, prefix=''):
+        self.collate_fn = collate_fn
+        self.held = held  # batches handed out whose slots stay untouched
+        self.k = prefetch_factor + held  # slots per worker
+        slots = max(workers, 1) * self.k
+        self.buffers = {f: torch.empty((slots, batch_size, *s), dtype=torch.uint8).share_memory_()
+                        for f, s in shapes.items()}
+        self.count = 0  # batches collated by this process, every forked worker counts its own
+        self.pinned = pin and torch.cuda.is_available() and self.pin()
+        gb = sum(b.numel() for b in self.buffers.values()) / 1E9
+        logging.info(f'{prefix}Collating into {slots} shared batch slots ({gb:.1f}GB{", pinned" if self.pinned else ""})')
+
+    def pin(self):
+        # Page-lock the ring in place, returns False if the driver refuses (e.g. RLIMIT_MEMLOCK)
+        try:
+            for b in self.buffers.values():
+                torch.cuda.check_error(torch.cuda.cudart().cudaHostRegister(b.data_ptr(), b.numel(), 0))
+        except RuntimeError as e:
+            logging.info(f'WARNING: shared batch ring not pinned: {e}')
+            return False
+        return True
+
+    def __call__(self, batch):
+        # Worker side: sample images into the next slot of this worker, everything else through collate_fn
+        info = torch.utils.data.get_worker_info()
+        slot = (info.id if info is not None else 0) * self.k + self.count % self.k
+        self.count += 1
+        batch = [list(x) for x in batch]
+        for f, buf in self.buffers.items():
+            for i, x in enumerate(batch):
+                assert x[f].shape == buf.shape[2:], f'shared collate expects {tuple(buf.shape[2:])}, got {tuple(x[f].shape)}'
+                buf[slot, i].copy_(x[f])
+                x[f] = EMPTY  # collate_fn stacks empty tensors instead
+        out = list(self.collate_fn(batch))
+        for f in self.buffers:
+            out[f] = SharedSlot(f, slot, len(batch)) if info is not None else self.buffers[f][slot, :len(batch)]
+        return tuple(out)
+
+    def resolve(self, batch):
+        # Main process side: replace the slot placeholders of a collated batch by views of the ring
+        return tuple(self.buffers[x.field][x.slot, :x.n] if isinstance(x, SharedSlot) else x for x in batch)
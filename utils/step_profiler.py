@@ -0,0 +1,111 @@
+# EfficientTeacher by Alibaba Cloud
+"""
+Per-phase timing of training steps
+
+The training loops call lap(phase) at the end of every phase of a step (data, h2d, forward, loss, backward, optimizer,
+ema and for SSOD teacher, nms, pseudo_label, unsup_loss) and step(ni) at its end, which charges the rest to 'log'. A
+lap is the time since the previous lap, so the 'data' lap at the top of the loop body covers everything between two
+steps, including the wait for the prefetcher. 'h2d' is the prefetcher preprocessing when it runs in the loop's thread.
+With sync=True the device is synchronized before every lap so asynchronous CUDA work is charged to the phase that queued
+it, at the cost of the overlap it would otherwise have. Every 'period' steps the p50/p90/p99 of the last 'window' steps
+are sent to the 'on_train_step_profile' callbacks and appended to a CSV or JSONL file.
+
+Disabled profiling uses NullProfiler, whose methods do nothing.
+"""
+
+import csv
+import json
+import time
+from collections import deque
+
+import numpy as np
+import torch
+
+PERCENTILES = (50, 90, 99)
+
+
+class NullProfiler:
+    """ Disabled StepProfiler """
+    enabled = False
+
+    def start(self):
+        pass
+
+    def lap(self, phase):
+        pass
+
+    def timed(self, phase, fn):
+        return fn
+
+    def step(self, ni, callbacks=None, phase='log'):
+        pass
+
+
+class StepProfiler(NullProfiler):
+    """ Rolling per-phase step times in ms, see the module docstring """
+    enabled = True
+
+    def __init__(self, device, period=50, window=200, sync=True, save_path=None):
+        self.sync = sync and device.type == 'cuda'
+        self.device, self.period, self.window, self.save_path = device, period, window, save_path
+        self.rows = deque(maxlen=window)  # {phase: ms} of the last steps
+        self.current, self.t, self.steps = {}, None, 0
+
+    def start(self):
+        # Reset the lap timer, before the first batch of a loop
+        if self.sync:
+            torch.cuda.synchronize(self.device)
+        self.t = time.perf_counter()
+
+    def lap(self, phase):
+        # Charge the time since the previous lap to 'phase', repeated phases of a step add up
+        if self.sync:
+            torch.cuda.synchronize(self.device)
+        t = time.perf_counter()
+        self.current[phase] = self.current.get(phase, 0.0) + (t - self.t) * 1E3
+        self.t = t
+
+    def timed(self, phase, fn):
+        # fn with its own lap, i.e. the prefetcher preprocessing when it runs in the loop's thread
+        def wrapper(*args, **kwargs):
+            self.lap('data')
+            out = fn(*args, **kwargs)
+            self.lap(phase)
+            return out
+        return wrapper
+
+    def step(self, ni, callbacks=None, phase='log'):
+        # Close the step with a last lap, every 'period' steps report the percentiles of the window
+        self.lap(phase)
+        self.current['total'] = sum(self.current.values())
+        self.rows.append(self.current)
+        self.current = {}
+        self.steps += 1
+        if self.steps % self.period == 0:
+            stats = self.stats()
+            if callbacks is not None:
+                callbacks.run('on_train_step_profile', ni, stats)
+            if self.save_path is not None:
+                self.save(ni, stats)
+
+    def stats(self):
+        # {phase: {'mean', 'p50', 'p90', 'p99'}} in ms over the window, steps without a phase count as 0
+        phases = list(dict.fromkeys(k for r in self.rows for k in r))
+        x = np.array([[r.get(k, 0.0) for k in phases] for r in self.rows])
+        p = np.percentile(x, PERCENTILES, axis=0)
+        return {k: {'mean': float(x[:, j].mean()), **{f'p{q}': float(p[i, j]) for i, q in enumerate(PERCENTILES)}}
+                for j, k in enumerate(phases)}
+
+    def save(self, ni, stats):
+        # One row per phase to .csv, one record per report to .jsonl
+        if self.save_path.suffix == '.jsonl':
+            with open(self.save_path, 'a') as f:
+                f.write(json.dumps({'iter': ni, 'steps': len(self.rows), **stats}) + '\n')
+            return
+        new = not self.save_path.exists()
+        with open(self.save_path, 'a', newline='') as f:
+            w = csv.writer(f)
+            if new:
+                w.writerow(['iter', 'phase', 'mean', *(f'p{q}' for q in PERCENTILES)])
+            for k, v in stats.items():
+                w.writerow([ni, k, *(f'{x:.3f}' for x in v.values())])
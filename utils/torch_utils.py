@@ -10,6 +10,7 @@ import os
 import platform
 import subprocess
 import time
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from copy import deepcopy
 from pathlib import Path
@@ -305,7 +306,150 @@ class EarlyStopping:
         return stop
 
 
-class ModelEMA:
+_HOST_EMA_WORKER = None  # thread of the offloaded EMA blends, shared so that they run in submission order
+
+
+def host_ema_worker():
+    # Single thread executor of the host EMA blends, a semi EMA blended from an offloaded EMA runs after it
+    global _HOST_EMA_WORKER
+    if _HOST_EMA_WORKER is None:
+        _HOST_EMA_WORKER = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ema')
+    return _HOST_EMA_WORKER
+
+
+class FusedEMA:
+    """ Update engine of the EMA classes below. The floating point tensors of the EMA and of the source model are
+    gathered into two flat lists and blended with torch._foreach_mul_ / _foreach_add_, a few kernel launches per
+    update instead of two per tensor. With every=k the blend runs on every k-th update only, with the product of the
+    decays of the k updates, which matches k single updates towards an unchanged model. fused_state() holds this
+    progress for iteration checkpoints.
+
+    offload=device keeps the EMA in pinned host memory. A blend copies the device source tensors to pinned staging
+    buffers (the only device work) and runs on a host thread, the next blend waits for it. device_model() is the copy
+    to run on the device: with refresh=k a compute copy is kept and refreshed from the host EMA every k blends, it lags
+    by up to (k + 1) * every updates, see lag. With refresh=0 no device copy is kept. device_model(fresh=True) is always
+    a temporary current copy, validation converts the module it gets in place. wait() before reading the host EMA.
+    """
+
+    def init_fused(self, every=1, offload=None, refresh=0):
+        self.every = max(int(every), 1)  # updates per blend
+        self.pending = 1.0  # product of the decays since the last blend
+        self.calls = 0
+        self.device = offload if offload is not None and offload.type == 'cuda' else None  # offloaded from
+        self.refresh, self.blends = max(int(refresh), 0), 0  # blends per compute copy refresh, blends queued
+        self.job, self.job_calls, self.done_calls = None, 0, 0  # queued host blend, updates it includes
+        self.staging, self.h2d = None, None  # pinned copies of the device sources, last compute copy refresh
+        self.compute, self.compute_calls = None, 0
+        if self.device is not None:
+            self.ema.cpu()
+            for v in self.floating(self.ema):
+                v.data = v.data.pin_memory()
+
+    @property
+    def lag(self):
+        # Updates the device compute copy of an offloaded EMA is behind
+        return self.calls - self.compute_calls if self.device is not None else 0
+
+    def resolve(self, model):
+        # (ema tensors, model tensors), gathered on every blend: Module._apply (i.e. the .half() / .float() of
+        # val.run) replaces the buffers of a module, cached tensors would no longer be its own
+        m = model.module if is_parallel(model) else model
+        msd, esd = m.state_dict(keep_vars=True), self.ema.state_dict(keep_vars=True)
+        keys = [k for k, v in esd.items() if v.dtype.is_floating_point]
+        return [esd[k] for k in keys], [msd[k] for k in keys]
+
+    def fused_state(self):
+        # Updates since the last blend, restored by load_fused_state() to resume exactly with every > 1
+        return {'calls': self.calls, 'pending': self.pending}
+
+    def load_fused_state(self, state):
+        self.calls, self.pending = state['calls'], state['pending']
+        self.done_calls = self.compute_calls = self.calls
+
+    def blend(self, model, d):
+        # ema = d * ema + (1 - d) * model
+        self.pending *= d
+        self.calls += 1
+        if self.calls % self.every:
+            return
+        d, self.pending = self.pending, 1.0
+        e, m = self.resolve(model)
+        if self.device is not None:
+            self.queue(e, m, d)
+            return
+        with torch.no_grad():
+            torch._foreach_mul_(e, d)
+            torch._foreach_add_(e, m, alpha=1. - d)
+
+    def queue(self, e, m, d):
+        # Offloaded blend: stage the device sources, refresh the compute copy when due, blend on the host thread
+        self.wait()
+        self.blends += 1
+        if self.compute is not None and self.blends % self.refresh == 0:
+            self.refresh_compute()
+        copied = None
+        if m[0].is_cuda:
+            if self.staging is None or [(s.shape, s.dtype) for s in self.staging] != [(x.shape, x.dtype) for x in m]:
+                self.staging = [torch.empty(x.shape, dtype=x.dtype, pin_memory=True) for x in m]
+            with torch.no_grad():
+                for s, x in zip(self.staging, m):
+                    s.copy_(x, non_blocking=True)
+            copied = torch.cuda.Event()
+            copied.record()
+            m = self.staging
+        self.job, self.job_calls = host_ema_worker().submit(self.host_blend, e, m, d, copied, self.h2d), self.calls
+
+    @staticmethod
+    def host_blend(e, m, d, *events):
+        # Runs on the host thread, after the staging copy and the last read of the host EMA by the device
+        for event in events:
+            if event is not None:
+                event.synchronize()
+        with torch.no_grad():
+            torch._foreach_mul_(e, d)
+            torch._foreach_add_(e, m, alpha=1. - d)
+
+    def wait(self):
+        # Block until the queued host blend is done, the host EMA is then current
+        if self.job is not None:
+            self.job.result()
+            self.job, self.done_calls = None, self.job_calls
+
+    def refresh_compute(self):
+        # Copy the host EMA into the compute copy, asynchronously from pinned memory
+        with torch.no_grad():
+            for c, x in zip(self.floating(self.compute), self.floating(self.ema)):
+                c.copy_(x, non_blocking=True)
+        self.h2d = torch.cuda.Event()
+        self.h2d.record()
+        self.compute_calls = self.done_calls
+
+    @staticmethod
+    def floating(module):
+        # Floating point state tensors of a module, in resolve() order
+        return [v for v in module.state_dict(keep_vars=True).values() if v.dtype.is_floating_point]
+
+    def device_model(self, fresh=False):
+        # EMA module to run on the device, for an offloaded EMA its compute copy or with fresh=True a current temporary
+        # copy, e.g. for validation
+        if self.device is None:
+            return self.ema
+        if fresh or self.compute is None:
+            self.wait()
+            model = deepcopy(self.ema).to(self.device)
+            if fresh or not self.refresh:
+                return model
+            self.compute, self.compute_calls = model, self.done_calls
+        return self.compute
+
+    def update_attr(self, model, include=(), exclude=('process_group', 'reducer')):
+        # Update EMA attributes
+        copy_attr(self.ema, model, include, exclude)
+        if self.compute is not None:
+            copy_attr(self.compute, model, include, exclude)
+
+
+class ModelEMA(FusedEMA):
     """ Model Exponential Moving Average from https://github.com/rwightman/pytorch-image-models
     Keep a moving average of everything in the model state_dict (parameters and buffers).
     This is intended to allow functionality like
@@ -315,7 +459,7 @@ class ModelEMA:
     GPU assignment and distributed training wrappers.
     """
 
-    def __init__(self, model, decay=0.9999, updates=0):
+    def __init__(self, model, decay=0.9999, updates=0, every=1, offload=None, refresh=0):
         # Create EMA
         self.ema = deepcopy(model.module if is_parallel(model) else model).eval()  # FP32 EMA
         # if next(model.parameters()).device.type != 'cpu':
@@ -324,24 +468,15 @@ class ModelEMA:
         self.decay = lambda x: decay * (1 - math.exp(-x / 2000))  # decay exponential ramp (to help early epochs)
         for p in self.ema.parameters():
             p.requires_grad_(False)
+        self.init_fused(every, offload, refresh)
 
     def update(self, model):
         # Update EMA parameters
-        with torch.no_grad():
-            self.updates += 1
-            d = self.decay(self.updates)
+        self.updates += 1
+        self.blend(model, self.decay(self.updates))
 
-            msd = model.module.state_dict() if is_parallel(model) else model.state_dict()  # model state_dict
-            for k, v in self.ema.state_dict().items():
-                if v.dtype.is_floating_point:
-                    v *= d
-                    v += (1. - d) * msd[k].detach()
-
-    def update_attr(self, model, include=(), exclude=('process_group', 'reducer')):
-        # Update EMA attributes
-        copy_attr(self.ema, model, include, exclude)
 
-class SemiSupModelEMA:
+class SemiSupModelEMA(FusedEMA):
     """ Model Exponential Moving Average from https://github.com/rwightman/pytorch-image-models
     Keep a moving average of everything in the model state_dict (parameters and buffers).
     This is intended to allow functionality like
@@ -351,7 +486,7 @@ class SemiSupModelEMA:
     GPU assignment and distributed training wrappers.
     """
 
-    def __init__(self, model, decay=0.99, updates=0):
+    def __init__(self, model, decay=0.99, updates=0, every=1, offload=None, refresh=0):
         # Create EMA
         self.ema = deepcopy(model.module if is_parallel(model) else model).eval()  # FP32 EMA
         # if next(model.parameters()).device.type != 'cpu':
@@ -360,25 +495,15 @@ class SemiSupModelEMA:
         self.decay = decay   # decay exponential ramp (to help early epochs)
         for p in self.ema.parameters():
             p.requires_grad_(False)
+        self.init_fused(every, offload, refresh)
 
     def update(self, model):
         # Update EMA parameters
-        with torch.no_grad():
-            self.updates += 1
-            # d = self.decay(self.updates)
-            d = self.decay
-
-            msd = model.module.state_dict() if is_parallel(model) else model.state_dict()  # model state_dict
-            for k, v in self.ema.state_dict().items():
-                if v.dtype.is_floating_point:
-                    v *= d
-                    v += (1. - d) * msd[k].detach()
+        self.updates += 1
+        self.blend(model, self.decay)
 
-    def update_attr(self, model, include=(), exclude=('process_group', 'reducer')):
-        # Update EMA attributes
-        copy_attr(self.ema, model, include, exclude)
 
-class CosineEMA:
+class CosineEMA(FusedEMA):
     """ Model Exponential Moving Average from https://github.com/rwightman/pytorch-image-models
     Keep a moving average of everything in the model state_dict (parameters and buffers).
     This is intended to allow functionality like
@@ -388,7 +513,7 @@ class CosineEMA:
     GPU assignment and distributed training wrappers.
     """
 
-    def __init__(self, model, decay_start=0.99, decay_end=0.9999, total_epoch=0):
+    def __init__(self, model, decay_start=0.99, decay_end=0.9999, total_epoch=0, every=1, offload=None, refresh=0):
         # Create CosineEMA
         self.ema = deepcopy(model.module if is_parallel(model) else model).eval()  # FP32 EMA
         # if next(model.parameters()).device.type != 'cpu':
@@ -400,25 +525,13 @@ class CosineEMA:
         for p in self.ema.parameters():
             p.requires_grad_(False)
         self.updates = 0
+        self.init_fused(every, offload, refresh)
         # print('init self decay:', self.decay)
 
     def update(self, model):
         # Update EMA parameters
-        with torch.no_grad():
-            # self.updates += 1
-            # d = self.decay(self.updates)
-            d = self.decay
-
-            msd = model.module.state_dict() if is_parallel(model) else model.state_dict()  # model state_dict
-            for k, v in self.ema.state_dict().items():
-                if v.dtype.is_floating_point:
-                    v *= d
-                    v += (1. - d) * msd[k].detach()
+        self.blend(model, self.decay)
 
     def update_decay(self, cur_epoch):
         self.decay = self.decay_end - (self.decay_end - self.decay_start) * (np.cos(np.pi * cur_epoch/ self.total_epoch) + 1)/2
         # print('self decay:', self.decay)
-
-    def update_attr(self, model,  include=(), exclude=('process_group', 'reducer')):
-        # Update EMA attributes
-        copy_attr(self.ema, model, include, exclude)
@@ -44,6 +44,7 @@ from utils.general import coco80_to_coco91_class, check_dataset, check_img_size,
     check_suffix, check_yaml, box_iou, non_max_suppression, scale_coords, xyxy2xywh, xywh2xyxy, set_logging, \
     increment_path, colorstr, print_args, non_max_suppression_lmk_and_bbox, scale_coords_landmarks
 from utils.plots import plot_images
+from utils.prefetcher import DevicePrefetcher
 from utils.torch_utils import select_device, time_sync
 from utils.callbacks import Callbacks
 from utils.profile import profile
@@ -272,11 +273,8 @@ def run(data,
     # model_post.training = False
     # model_post.eval()
 
-    for batch_i, (img, targets, paths, shapes) in enumerate(tqdm(dataloader, desc=s)):
-        # 默认-1 则全部测试
-        if batch_i==eval_num:
-            break
-        t1 = time_sync()
+    def preprocess(batch):
+        img, targets, paths, shapes = batch
         img = img.to(device, non_blocking=True)
         img = img.half() if half else img.float()  # uint8 to fp16/32
         if pt:
@@ -285,10 +283,15 @@ def run(data,
             pass
         else:
             img /= 255.0   
-        targets = targets.to(device)
+        return img, targets.to(device), paths, shapes
+
+    prefetcher = DevicePrefetcher(dataloader, preprocess, device)  # next batch on the device during inference
+    for batch_i, (img, targets, paths, shapes) in enumerate(tqdm(prefetcher, desc=s, total=len(dataloader))):
+        # 默认-1 则全部测试
+        if batch_i==eval_num:
+            break
         nb, _, height, width = img.shape  # batch size, channels, height, width
         t2 = time_sync()
-        dt[0] += t2 - t1
 
         # Run model
         if val_ssod:
@@ -414,6 +417,7 @@ def run(data,
             print(pf % (names[c], seen, nt[c], p[i], r[i], ap50[i], ap[i]))
 
     # Print speeds
+    dt[0] = prefetcher.stats()[0]  # time waited for preprocessed batches
     t = tuple(x / seen * 1E3 for x in dt)  # speeds per image
     if not training:
         shape = (batch_size, 3, imgsz, imgsz)